@@ -0,0 +1,291 @@
+"""
+Estimation of the wavefront mesh and memory footprint along a beamline.
+
+The estimate follows the Use_PP range (zoom) and resolution (sampling) factors
+of every element without propagating, so it only needs the input mesh, which is
+read from the HDF5 header of the wavefront file. It is used to schedule batch
+runs and for the --dry-run of propagateSE.py.
+"""
+import os
+import math
+
+# arrEhor and arrEver, real and imaginary part, float32
+FIELD_BYTES_PER_POINT = 2 * 2 * 4
+# python, numpy, SRW and WPG of a worker process
+PROCESS_BASE_BYTES = 300 * 2**20
+# temporary arrays of SRW and the intensity arrays calculated in propagate()
+MEMORY_OVERHEAD = 1.3
+
+
+def read_mesh(fname):
+    """
+    Read wavefront mesh from the HDF5 header without loading the field
+
+    :param fname: wavefront file
+    :return: dict with nx, ny, nSlices, xMin, xMax, yMin, yMax
+    """
+    import h5py
+    mesh = {}
+    with h5py.File(fname, 'r') as h5:
+        for key in ['nx', 'ny', 'nSlices', 'xMin', 'xMax', 'yMin', 'yMax']:
+            mesh[key] = h5['params/Mesh/' + key][()]
+    for key in ['nx', 'ny', 'nSlices']:
+        mesh[key] = int(mesh[key])
+    return mesh
+
+
+# positions in the SRW propagation parameters list
+PP_INDEX = {'semi_analytical_treatment': 3, 'zoom_h': 5, 'sampling_h': 6, 'zoom_v': 7, 'sampling_v': 8}
+
+
+def pp_factors(pp):
+    """
+    Decode SRW propagation parameters as created by Use_PP
+
+    :param pp: propagation parameters list
+    :return: dict with semi_analytical_treatment, zoom_h, sampling_h, zoom_v, sampling_v
+    """
+    return dict((key, pp[i]) for key, i in PP_INDEX.items())
+
+
+def iter_elements(bl):
+    """
+    Iterate over optical elements of the beamline in propagation order
+
+    :param bl: Beamline
+    :return: iterator of (optical_element, propagation_parameters)
+    """
+    for propagation_option in bl.propagation_options:
+        for oe, pp in zip(propagation_option['optical_elements'],
+                          propagation_option['propagation_parameters']):
+            yield oe, pp
+
+
+def mesh_chain(bl, nx, ny):
+    """
+    Calculate wavefront mesh after every element of the beamline
+
+    :param bl: Beamline
+    :param nx: number of points in horizontal direction at the beamline entrance
+    :param ny: number of points in vertical direction at the beamline entrance
+    :return: list of dicts with element, pp, resized, nx_in, ny_in, nx, ny
+    """
+    chain = []
+    for oe, pp in iter_elements(bl):
+        f = pp_factors(pp)
+        resized = f['zoom_h'] != 1 or f['sampling_h'] != 1 or f['zoom_v'] != 1 or f['sampling_v'] != 1
+        nx_out = max(int(round(nx * f['zoom_h'] * f['sampling_h'])), 1)
+        ny_out = max(int(round(ny * f['zoom_v'] * f['sampling_v'])), 1)
+        chain.append({'element': oe.__class__.__name__, 'pp': f, 'resized': resized,
+                      'nx_in': nx, 'ny_in': ny, 'nx': nx_out, 'ny': ny_out})
+        nx, ny = nx_out, ny_out
+    return chain
+
+
+def transmission_bytes(bl):
+    """
+    Memory occupied by the transmission grids of WF_dist-like elements
+
+    :param bl: Beamline
+    :return: bytes
+    """
+    return sum(len(oe.arTr) * 8 for oe, pp in iter_elements(bl)
+               if getattr(oe, 'arTr', None) is not None)
+
+
+def _step_points(step):
+    # while an element resizes the mesh both the old and the new field are allocated
+    points = step['nx'] * step['ny']
+    if step['resized']:
+        points += step['nx_in'] * step['ny_in']
+    return points
+
+
+def estimate_peak_memory(bl, mesh):
+    """
+    Estimate peak memory of a worker propagating a wavefront through the beamline.
+
+    :param bl: Beamline
+    :param mesh: input mesh, dict from read_mesh
+    :return: bytes
+    """
+    nSlices = mesh['nSlices']
+    peak_points = mesh['nx'] * mesh['ny']
+    for step in mesh_chain(bl, mesh['nx'], mesh['ny']):
+        peak_points = max(peak_points, _step_points(step))
+    field_bytes = peak_points * nSlices * FIELD_BYTES_PER_POINT
+    return int(field_bytes * MEMORY_OVERHEAD) + transmission_bytes(bl) + PROCESS_BASE_BYTES
+
+
+def physical_memory():
+    """
+    Total physical memory of the node
+
+    :return: bytes, or None if unknown
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+# steps whose mesh grows by more than this factor in number of points are flagged
+GROWTH_WARNING = 4.
+# range increase with strong resolution decrease per axis is flagged as a risk of aliasing
+ZOOM_WARNING = 4.
+SAMPLING_WARNING = 1. / 8
+# meshes with more points per slice are flagged
+POINTS_WARNING = 2**24
+# rough default time per relative cost unit, used if no calibration from previous runs is available
+DEFAULT_SECONDS_PER_UNIT = 2e-8
+
+
+def _fft_cost(points):
+    return points * max(math.log(points, 2), 1.)
+
+
+def estimate_steps(bl, mesh):
+    """
+    Predict mesh, memory and relative computational cost at every element of the beamline.
+    Drifts are propagated with FFT (cost ~ N*log2(N) per slice), other elements are applied
+    point by point, resizing costs one pass over the old and the new mesh.
+
+    :param bl: Beamline
+    :param mesh: input mesh, dict from read_mesh
+    :return: list of dicts with element, nx, ny, points, memory [bytes], cost [relative units], warnings
+    """
+    nSlices = mesh['nSlices']
+    steps = []
+    for step in mesh_chain(bl, mesh['nx'], mesh['ny']):
+        f = step['pp']
+        points_in = step['nx_in'] * step['ny_in']
+        points = step['nx'] * step['ny']
+        if step['element'] == 'Drift':
+            cost = 2 * _fft_cost(points)
+        else:
+            cost = points
+        if step['resized']:
+            cost += points_in + points
+
+        warnings = []
+        if points > GROWTH_WARNING * points_in:
+            warnings.append('mesh grows {:.1f}x'.format(float(points) / points_in))
+        for axis in ['h', 'v']:
+            if f['zoom_' + axis] >= ZOOM_WARNING and f['sampling_' + axis] <= SAMPLING_WARNING:
+                warnings.append('zoom_{0}={1:g} with sampling_{0}={2:g}, risk of aliasing'.format(
+                    axis, f['zoom_' + axis], f['sampling_' + axis]))
+        if points > POINTS_WARNING:
+            warnings.append('{:.1f}M points per slice'.format(points / 1e6))
+
+        steps.append({'element': step['element'], 'pp': f,
+                      'nx': step['nx'], 'ny': step['ny'], 'points': points,
+                      'memory': _step_points(step) * nSlices * FIELD_BYTES_PER_POINT,
+                      'cost': cost * nSlices,
+                      'warnings': warnings})
+    return steps
+
+
+def total_cost(bl, mesh):
+    """
+    Relative computational cost of propagating a wavefront through the beamline
+
+    :param bl: Beamline
+    :param mesh: input mesh, dict from read_mesh
+    :return: cost [relative units]
+    """
+    return sum(s['cost'] for s in estimate_steps(bl, mesh))
+
+
+def format_steps(steps, mesh):
+    """
+    Format per-element estimate as a table
+
+    :param steps: list from estimate_steps
+    :param mesh: input mesh, dict from read_mesh
+    :return: string
+    """
+    total = sum(s['cost'] for s in steps) or 1.
+    lines = ['input mesh nx={} ny={} nSlices={}'.format(mesh['nx'], mesh['ny'], mesh['nSlices']),
+             '{:>3} {:<20} {:>6} {:>6} {:>6} {:>6} {:>10} {:>7}  {}'.format(
+                 '#', 'element', 'zoom', 'sampl', 'nx', 'ny', 'mem [GB]', 'cost %', 'warnings')]
+    for i, s in enumerate(steps):
+        lines.append('{:>3} {:<20} {:>6.3g} {:>6.3g} {:>6} {:>6} {:>10.2f} {:>7.1f}  {}'.format(
+            i, s['element'], s['pp']['zoom_h'], s['pp']['sampling_h'], s['nx'], s['ny'],
+            s['memory'] / 2.**30, 100. * s['cost'] / total, '; '.join(s['warnings'])))
+    return '\n'.join(lines)
+
+
+def calibrate(records, bl, bl_hash):
+    """
+    Calibrate seconds per cost unit from wall times of pulses already propagated with the same beamline
+
+    :param records: manifest records, see manifest.Manifest.records
+    :param bl: Beamline
+    :param bl_hash: beamline hash, see manifest.beamline_hash
+    :return: seconds per cost unit, or None if there are no usable records
+    """
+    ratios = []
+    for record in records:
+        if record['beamline_hash'] != bl_hash or not os.path.exists(record['in_fname']):
+            continue
+        try:
+            cost = total_cost(bl, read_mesh(record['in_fname']))
+        except (IOError, KeyError):
+            continue
+        if cost > 0:
+            ratios.append(record['wall_time'] / cost)
+    if not ratios:
+        return None
+    return sorted(ratios)[len(ratios) // 2]
+
+
+def dry_run(input_files, bl, cpu_number, memory_budget=None, seconds_per_unit=None):
+    """
+    Estimate mesh, memory and cost of propagating the input files without propagating them
+
+    :param input_files: list of input wavefront files
+    :param bl: Beamline
+    :param cpu_number: maximal number of pulses propagated at once on a node
+    :param memory_budget: memory available for all workers on a node [bytes], None for no limit
+    :param seconds_per_unit: time per cost unit, see calibrate, default DEFAULT_SECONDS_PER_UNIT
+    :return: dict with files, peak_memory [bytes], cost, concurrency, node_hours, warnings
+    """
+    calibrated = seconds_per_unit is not None
+    if not calibrated:
+        seconds_per_unit = DEFAULT_SECONDS_PER_UNIT
+
+    meshes = {}
+    for fname in input_files:
+        mesh = read_mesh(fname)
+        key = (mesh['nx'], mesh['ny'], mesh['nSlices'])
+        meshes.setdefault(key, [mesh, 0])[1] += 1
+
+    cost = 0.
+    peak_memory = 0
+    warnings = set()
+    for key in sorted(meshes, key=lambda k: k[0] * k[1] * k[2], reverse=True):
+        mesh, count = meshes[key]
+        steps = estimate_steps(bl, mesh)
+        print('{} file(s) with '.format(count) + format_steps(steps, mesh))
+        cost += count * sum(s['cost'] for s in steps)
+        peak_memory = max(peak_memory, estimate_peak_memory(bl, mesh))
+        for i, s in enumerate(steps):
+            for w in s['warnings']:
+                warnings.add('#{} {}: {}'.format(i, s['element'], w))
+
+    concurrency = cpu_number
+    if memory_budget is not None and peak_memory > 0:
+        concurrency = max(min(cpu_number, int(memory_budget // peak_memory)), 1)
+        if peak_memory > memory_budget:
+            warnings.add('estimated peak memory {:.1f} GB exceeds memory budget {:.1f} GB'.format(
+                peak_memory / 2.**30, memory_budget / 2.**30))
+    node_hours = cost * seconds_per_unit / concurrency / 3600.
+
+    print('Files: {}, peak memory per pulse: {:.2f} GB, pulses per node: {}'.format(
+        len(input_files), peak_memory / 2.**30, concurrency))
+    print('Estimated node-hours: {:.2f} ({})'.format(
+        node_hours, 'calibrated by previous runs' if calibrated else 'rough default calibration'))
+    for w in sorted(warnings):
+        print('WARNING ' + w)
+    return {'files': len(input_files), 'peak_memory': peak_memory, 'cost': cost,
+            'concurrency': concurrency, 'node_hours': node_hours, 'warnings': sorted(warnings)}
@@ -0,0 +1,106 @@
+"""
+Accuracy and throughput of the FFT engine (fft_engine) compared with SRW.
+
+Every beamline propagates the same input pulse with SRW and with the FFT
+engine. Reported are the wall times, the throughput in slices per second, FWHM
+of the frequency integrated intensity, the difference of its normalized
+projections (total variation distance, 0 is identical) and the ratio of the
+propagated energies.
+
+Usage:
+python bench_fft_engine.py --input-file FELsource_out_0000001.h5 --fft-threads 8
+"""
+import copy
+import json
+import time
+
+import wf_metrics
+
+BEAMLINES = [('built-in', None), ('my_beamline', 'my_beamline.py'), ('my_s2e_beamline', 'my_s2e_beamline.py')]
+
+
+def _summary(wf):
+    mesh = wf._srwl_wf.mesh
+    metrics = wf_metrics.metrics_from_wavefront(wf)
+    dx = (mesh.xFin - mesh.xStart) / max(mesh.nx - 1, 1)
+    dy = (mesh.yFin - mesh.yStart) / max(mesh.ny - 1, 1)
+    return {'image': metrics.image_total,
+            'x': (mesh.xStart, mesh.xFin), 'y': (mesh.yStart, mesh.yFin),
+            'fwhm': metrics.fwhm(mesh.xStart, mesh.xFin, mesh.yStart, mesh.yFin),
+            'energy': float(metrics.power_total.sum() * dx * dy)}
+
+
+def compare_engines(wf, bl, threads=None):
+    """
+    Propagate copies of the wavefront with SRW and with the FFT engine
+
+    :param wf: wavefront in frequency domain, not modified
+    :param bl: Beamline
+    :param threads: number of FFT threads
+    :return: dict with srw_time, fft_time, slices_per_s_srw, slices_per_s_fft, fwhm_x/y_srw, fwhm_x/y_fft,
+        profile_error_x, profile_error_y and energy_ratio (FFT / SRW)
+    """
+    import fft_engine
+    n_slices = wf._srwl_wf.mesh.ne
+
+    wf_srw = copy.deepcopy(wf)
+    t0 = time.time()
+    bl.propagate(wf_srw)
+    srw_time = time.time() - t0
+    srw = _summary(wf_srw)
+    del wf_srw
+
+    wf_fft = copy.deepcopy(wf)
+    fft_time = fft_engine.propagate(wf_fft, bl, threads)['wall_time']
+    fft = _summary(wf_fft)
+    del wf_fft
+
+    return {'srw_time': srw_time, 'fft_time': fft_time,
+            'slices_per_s_srw': n_slices / srw_time, 'slices_per_s_fft': n_slices / fft_time,
+            'fwhm_x_srw': srw['fwhm']['fwhm_x'], 'fwhm_y_srw': srw['fwhm']['fwhm_y'],
+            'fwhm_x_fft': fft['fwhm']['fwhm_x'], 'fwhm_y_fft': fft['fwhm']['fwhm_y'],
+            'profile_error_x': wf_metrics.projection_distance(fft['image'], fft['x'], srw['image'], srw['x'], 0),
+            'profile_error_y': wf_metrics.projection_distance(fft['image'], fft['y'], srw['image'], srw['y'], 1),
+            'energy_ratio': fft['energy'] / srw['energy'] if srw['energy'] else float('nan')}
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--input-file", dest="in_fname", help="Input wavefront file")
+    parser.add_option("--beamline-file", dest="beamline_files", action="append", default=None,
+                      help="Python file with get_beamline() definition, can be repeated, "
+                           "default the built-in beamline, my_beamline.py and my_s2e_beamline.py")
+    parser.add_option("--fft-threads", dest="fft_threads", type="int", default=None,
+                      help="Number of FFT threads of the FFT engine, -1 for all CPUs")
+    parser.add_option("--json", dest="json_fname", default=None, help="Save results to a JSON file")
+    (options, args) = parser.parse_args()
+    if not options.in_fname:
+        parser.error('Input filename not specified, use --input-file option')
+
+    import separable
+    from propagateSE import load_get_beamline, load_wavefront
+    beamlines = [(f, f) for f in options.beamline_files] if options.beamline_files else BEAMLINES
+    wf = load_wavefront(options.in_fname)
+
+    results = {}
+    print('{:<18} {:>9} {:>9} {:>9} {:>11} {:>11} {:>8} {:>8} {:>8}'.format(
+        'beamline', 'SRW [s]', 'FFT [s]', 'speedup', 'FWHM x SRW', 'FWHM x FFT', 'err x', 'err y', 'energy'))
+    for name, beamline_file in beamlines:
+        bl = load_get_beamline(beamline_file)()
+        try:
+            res = compare_engines(wf, bl, options.fft_threads)
+        except separable.UnsupportedElement as exc:
+            print('{:<18} not supported by the FFT engine: {}'.format(name, exc))
+            continue
+        results[name] = res
+        print('{:<18} {srw_time:>9.2f} {fft_time:>9.2f} {speedup:>9.2f} {fx_srw:>11.3e} {fx_fft:>11.3e} '
+              '{profile_error_x:>8.4f} {profile_error_y:>8.4f} {energy_ratio:>8.4f}'.format(
+                  name, speedup=res['srw_time'] / res['fft_time'], fx_srw=res['fwhm_x_srw'],
+                  fx_fft=res['fwhm_x_fft'], **res))
+    if options.json_fname:
+        with open(options.json_fname, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Benchmark of HDF5 output layouts for propagated wavefronts.
+
+Writes a synthetic SASE-like field of production size with every layout (see
+h5_layout) and reports write throughput, read throughput (reading chunks of
+slices as the diagnostics do) and compression ratio.
+
+Usage:
+python bench_h5_layout.py --nx 512 --ny 512 --nslices 400 --work-dir /path/on/shared/filesystem
+"""
+import os
+import shutil
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+import h5_layout
+
+LAYOUTS = [
+    ('contiguous', {}),
+    ('chunked16', {'chunk_slices': 16}),
+    ('lzf+shuffle', {'compression': 'lzf'}),
+    ('gzip1+shuffle', {'compression': 'gzip', 'compression_level': 1}),
+    ('gzip4+shuffle', {'compression': 'gzip', 'compression_level': 4}),
+    ('gzip4', {'compression': 'gzip', 'compression_level': 4, 'shuffle': False}),
+    ('blosc+shuffle', {'compression': 'blosc', 'compression_level': 5}),
+]
+
+
+def random_phase(nx, ny, rng):
+    """
+    Smooth random transverse phase, normalized to unit standard deviation
+
+    :param rng: numpy RandomState
+    :return: array [ny, nx]
+    """
+    x = np.linspace(-1., 1., nx)
+    y = np.linspace(-1., 1., ny)
+    xx, yy = np.meshgrid(x, y)
+    phase = np.fft.ifft2(np.fft.fft2(rng.randn(ny, nx)) * np.exp(-(xx**2 + yy**2) * 200.)).real
+    return phase / phase.std()
+
+
+def random_spikes(n_slices, rng):
+    """
+    Temporal structure of SASE pulses: random spikes, complex
+
+    :param rng: numpy RandomState
+    :return: array [n_slices]
+    """
+    noise = rng.randn(n_slices) + 1j * rng.randn(n_slices)
+    return np.fft.ifft(np.fft.fft(noise) * np.exp(-(np.fft.fftfreq(n_slices) * 20.)**2))
+
+
+def synthetic_field(nx, ny, n_slices, seed=0):
+    """
+    SASE-like field: gaussian transverse profile with a smooth random phase,
+    temporal structure of random spikes under a gaussian pulse envelope
+
+    :return: array [ny, nx, n_slices, 2] float32
+    """
+    rng = np.random.RandomState(seed)
+    x = np.linspace(-1., 1., nx)
+    y = np.linspace(-1., 1., ny)
+    xx, yy = np.meshgrid(x, y)
+    transverse = np.exp(-(xx**2 + yy**2) / (2 * 0.2**2)) * np.exp(1j * random_phase(nx, ny, rng))
+
+    t = np.linspace(-1., 1., n_slices)
+    temporal = random_spikes(n_slices, rng) * np.exp(-t**2 / (2 * 0.4**2)) * 1e6
+
+    field = (transverse[:, :, None] * temporal[None, None, :]).astype(np.complex64)
+    return field.view(np.float32).reshape(ny, nx, n_slices, 2)
+
+
+def write_file(fname, field, layout):
+    with h5py.File(fname, 'w') as h5:
+        h5['params/Mesh/nx'] = field.shape[1]
+        h5['params/Mesh/ny'] = field.shape[0]
+        h5['params/Mesh/nSlices'] = field.shape[2]
+        data = h5.create_group('data')
+        for name in h5_layout.FIELD_DATASETS:
+            if h5_layout.is_default(layout):
+                data[name] = field
+            else:
+                h5_layout.write_field(data, name, field, layout)
+
+
+def read_file(fname, chunk_slices=16):
+    total = 0.
+    with h5py.File(fname, 'r') as h5:
+        n_slices = h5['params/Mesh/nSlices'][()]
+        for name in h5_layout.FIELD_DATASETS:
+            dset = h5['data/' + name]
+            for i0 in range(0, n_slices, chunk_slices):
+                total += float(dset[:, :, i0:i0 + chunk_slices, :].sum())
+    return total
+
+
+def run(nx, ny, n_slices, work_dir, repeat=1):
+    """
+    Run the benchmark
+
+    :return: list of dicts with layout, write_mb_s, read_mb_s, ratio
+    """
+    field = synthetic_field(nx, ny, n_slices)
+    raw_mb = 2 * field.nbytes / 2.**20
+    print('Synthetic field nx={} ny={} nSlices={}, {:.0f} MB uncompressed'.format(nx, ny, n_slices, raw_mb))
+    print('{:<16} {:>12} {:>12} {:>8}'.format('layout', 'write MB/s', 'read MB/s', 'ratio'))
+    results = []
+    for name, layout in LAYOUTS:
+        fname = os.path.join(work_dir, 'bench_{}.h5'.format(name))
+        try:
+            write_time = read_time = 0.
+            for i in range(repeat):
+                t0 = time.time()
+                write_file(fname, field, layout)
+                write_time += time.time() - t0
+                t0 = time.time()
+                read_file(fname)
+                read_time += time.time() - t0
+        except ValueError as exc:  # missing optional filter
+            print('{:<16} skipped: {}'.format(name, exc))
+            continue
+        result = {'layout': name,
+                  'write_mb_s': repeat * raw_mb / write_time,
+                  'read_mb_s': repeat * raw_mb / read_time,
+                  'ratio': raw_mb * 2**20 / os.path.getsize(fname)}
+        os.remove(fname)
+        print('{layout:<16} {write_mb_s:>12.1f} {read_mb_s:>12.1f} {ratio:>8.2f}'.format(**result))
+        results.append(result)
+    return results
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--nx", dest="nx", type="int", default=256, help="Number of points in horizontal direction")
+    parser.add_option("--ny", dest="ny", type="int", default=256, help="Number of points in vertical direction")
+    parser.add_option("--nslices", dest="nslices", type="int", default=200, help="Number of slices")
+    parser.add_option("--repeat", dest="repeat", type="int", default=1, help="Number of repetitions")
+    parser.add_option("--work-dir", dest="work_dir", default=None,
+                      help="Directory for the test files, use the filesystem of the production outputs, "
+                           "default is a temporary directory")
+    (options, args) = parser.parse_args()
+
+    work_dir = options.work_dir or tempfile.mkdtemp()
+    try:
+        run(options.nx, options.ny, options.nslices, work_dir, options.repeat)
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""
+Throughput benchmark of the propagation with synthetic input pulses.
+
+Gaussian or SASE-like (gaussian with random temporal spikes and a smooth random
+transverse phase) wavefronts of the given size are generated with WPG, so no
+FELsource files are needed, and propagated with propagate() through the
+built-in beamline, my_beamline.py and my_s2e_beamline.py. Every pulse runs in a
+fresh process, so that its peak memory is not affected by the previous runs.
+Reported are pulses per hour (propagate() with loading and storing) and the
+peak memory of unprofiled runs, and the time of every element (see profiling)
+from a separate profiled run of every pulse, so the profiling overhead does not
+affect the throughput.
+
+The results can be saved as a baseline JSON and later runs (e.g. after a WPG/SRW
+upgrade or a beamline edit) compared to it: a beamline with throughput lower or
+peak memory higher by more than the threshold, or an element taking a notable
+part of the time, which became slower by more than the threshold, is a
+regression and the exit status is 1.
+
+Usage:
+python bench_propagation.py --nx 256 --ny 256 --nslices 100 --save-baseline baseline.json
+python bench_propagation.py --nx 256 --ny 256 --nslices 100 --baseline baseline.json --threshold 0.1
+"""
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import bench_h5_layout
+import profiling
+from bench_fft_engine import BEAMLINES
+
+DEFAULT_THRESHOLD = 0.1
+# elements with a smaller fraction of the baseline time are not checked for regressions
+MIN_ELEMENT_FRACTION = 0.05
+# representative FELsource output at the undulator exit
+DEFAULT_PHOTON_ENERGY = 5.  # [keV]
+DEFAULT_RANGE = 200e-6  # full width of the mesh [m]
+DEFAULT_SIGMA = 15e-6  # rms size of the beam [m]
+DEFAULT_PULSE_DURATION = 10e-15  # rms duration [s]
+DEFAULT_DISTANCE_TO_WAIST = 10.  # [m]
+
+
+def synthetic_wavefront(nx, ny, n_slices, kind='gaussian', photon_energy=DEFAULT_PHOTON_ENERGY,
+                        xy_range=DEFAULT_RANGE, sigma=DEFAULT_SIGMA, pulse_duration=DEFAULT_PULSE_DURATION,
+                        distance_to_waist=DEFAULT_DISTANCE_TO_WAIST, seed=0):
+    """
+    Synthetic input pulse in time domain
+
+    :param nx: number of points in horizontal direction
+    :param ny: number of points in vertical direction
+    :param n_slices: number of time slices
+    :param kind: 'gaussian' or 'sase', gaussian multiplied by random spikes in time and a smooth random phase
+        in space (see bench_h5_layout.random_spikes and random_phase)
+    :param photon_energy: photon energy [keV]
+    :param xy_range: full width of the mesh in both directions [m]
+    :param sigma: rms size of the beam [m]
+    :param pulse_duration: rms duration of the pulse [s]
+    :param distance_to_waist: distance from the waist of the beam [m]
+    :param seed: random seed of the SASE structure
+    :return: Wavefront
+    """
+    from wpg import Wavefront
+    from wpg.generators import build_gauss_wavefront
+    srwl_wf = build_gauss_wavefront(nx, ny, n_slices, photon_energy, -xy_range / 2., xy_range / 2.,
+                                    -xy_range / 2., xy_range / 2., pulse_duration, sigma, sigma, distance_to_waist)
+    if kind == 'sase':
+        rng = np.random.RandomState(seed)
+        spikes = bench_h5_layout.random_spikes(n_slices, rng)
+        spikes /= np.sqrt(np.mean(np.abs(spikes)**2))
+        modulation = (np.exp(1j * bench_h5_layout.random_phase(nx, ny, rng))[:, :, None] *
+                      spikes[None, None, :]).astype(np.complex64)
+        for arr in [srwl_wf.arEx, srwl_wf.arEy]:
+            np.frombuffer(arr, dtype=np.float32).view(np.complex64).reshape(ny, nx, n_slices)[:] *= modulation
+    return Wavefront(srwl_wf)
+
+
+def _peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def write_pulse(params):
+    """
+    Generate a synthetic pulse and store it, run in a pool process
+
+    :param params: (file name, dict of synthetic_wavefront arguments)
+    """
+    fname, wavefront_options = params
+    synthetic_wavefront(**wavefront_options).store_hdf5(fname)
+
+
+def run_pulse(params):
+    """
+    Propagate one pulse with propagate(), run in a fresh pool process
+
+    :param params: (input file, output file, beamline file or None, output level, profile)
+    :return: dict with wall_time (propagate() with loading and storing), peak_rss [bytes] and report
+        (see profiling.propagate_profiled, None without profile)
+    """
+    in_fname, out_fname, beamline_file, output_level, profile = params
+    from propagateSE import load_get_beamline, propagate
+    bl = load_get_beamline(beamline_file)()
+    t0 = time.time()
+    report = propagate(in_fname, out_fname, bl, profile=profile, output_options={'level': output_level})
+    wall_time = time.time() - t0
+    os.remove(out_fname)
+    return {'wall_time': wall_time, 'peak_rss': _peak_rss(), 'report': report}
+
+
+def summarize(runs, profiled_runs):
+    """
+    Reduce the runs of one beamline
+
+    :param runs: list of results of run_pulse without profile
+    :param profiled_runs: list of results of run_pulse with profile
+    :return: dict with pulses, wall_time_mean, pulses_per_hour, peak_rss (maximum) of the runs and elements
+        (index, element, wall_time_mean, wall_time_fraction) of the profiled runs
+    """
+    wall_time = sum(r['wall_time'] for r in runs) / len(runs)
+    elements = profiling.aggregate_profiles([r['report'] for r in profiled_runs])['elements']
+    return {'pulses': len(runs), 'wall_time_mean': wall_time, 'pulses_per_hour': 3600. / wall_time,
+            'peak_rss': max(r['peak_rss'] for r in runs),
+            'elements': [dict((key, e[key]) for key in ['index', 'element', 'wall_time_mean', 'wall_time_fraction'])
+                         for e in elements]}
+
+
+def versions():
+    """
+    :return: dict with the versions of python, numpy and wpg, and the host name
+    """
+    res = {'python': platform.python_version(), 'numpy': np.__version__, 'host': platform.node()}
+    try:
+        import wpg
+        res['wpg'] = getattr(wpg, '__version__', None)
+    except ImportError:
+        res['wpg'] = None
+    return res
+
+
+def run(config, beamlines, work_dir):
+    """
+    Run the benchmark
+
+    :param config: dict with nx, ny, nSlices, kind, pulses, output_level (see propagateSE.save_wavefront)
+        and optionally the other arguments of synthetic_wavefront
+    :param beamlines: list of (name, beamline file or None)
+    :param work_dir: directory for the input and output files
+    :return: dict with config, versions and beamlines: name: summary (see summarize)
+    """
+    wavefront_options = dict((key, value) for key, value in config.items()
+                             if key not in ['nx', 'ny', 'nSlices', 'pulses', 'output_level'])
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        in_fnames = []
+        for seed in range(config['pulses']):
+            fname = os.path.join(work_dir, 'bench_in_{}.h5'.format(seed))
+            pool.apply(write_pulse, ((fname, dict(wavefront_options, nx=config['nx'], ny=config['ny'],
+                                                  n_slices=config['nSlices'], seed=seed)),))
+            in_fnames.append(fname)
+
+        results = {}
+        for name, beamline_file in beamlines:
+            runs, profiled_runs = [
+                [pool.apply(run_pulse, ((fname, os.path.join(work_dir, 'bench_out.h5'), beamline_file,
+                                         config['output_level'], profile),))
+                 for fname in in_fnames]
+                for profile in [False, True]]
+            results[name] = summarize(runs, profiled_runs)
+            print(profiling.format_profile(profiled_runs[-1]['report']))
+    finally:
+        pool.close()
+        pool.join()
+    return {'config': config, 'versions': versions(), 'beamlines': results}
+
+
+def compare_baseline(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Find regressions with respect to a baseline
+
+    :param results: result of run
+    :param baseline: result of an earlier run with the same config
+    :param threshold: relative change considered a regression
+    :return: list of (beamline, message)
+    """
+    regressions = []
+    for name, res in sorted(results['beamlines'].items()):
+        base = baseline['beamlines'].get(name)
+        if base is None:
+            continue
+        if res['pulses_per_hour'] < (1 - threshold) * base['pulses_per_hour']:
+            regressions.append((name, 'throughput {:.1f} pulses/h, baseline {:.1f}'.format(
+                res['pulses_per_hour'], base['pulses_per_hour'])))
+        if res['peak_rss'] > (1 + threshold) * base['peak_rss']:
+            regressions.append((name, 'peak memory {:.0f} MB, baseline {:.0f} MB'.format(
+                res['peak_rss'] / 2.**20, base['peak_rss'] / 2.**20)))
+        if [e['element'] for e in res['elements']] != [e['element'] for e in base['elements']]:
+            continue  # beamline edited, elements cannot be matched
+        for e, b in zip(res['elements'], base['elements']):
+            if b['wall_time_fraction'] >= MIN_ELEMENT_FRACTION and \
+                    e['wall_time_mean'] > (1 + threshold) * b['wall_time_mean']:
+                regressions.append((name, 'element {} ({}) {:.2f} s, baseline {:.2f} s'.format(
+                    e['index'], e['element'], e['wall_time_mean'], b['wall_time_mean'])))
+    return regressions
+
+
+def format_results(results, baseline=None):
+    """
+    :param results: result of run
+    :param baseline: optional result of an earlier run
+    :return: table of throughput and peak memory, with the relative change to the baseline
+    """
+    lines = ['{:<18} {:>10} {:>10} {:>9} {:>10} {:>10} {:>9}'.format(
+        'beamline', 'pulses/h', 'baseline', 'change', 'peak [MB]', 'baseline', 'change')]
+    for name, res in sorted(results['beamlines'].items()):
+        base = (baseline or {}).get('beamlines', {}).get(name)
+        if base is None:
+            lines.append('{:<18} {:>10.1f} {:>10} {:>9} {:>10.0f} {:>10} {:>9}'.format(
+                name, res['pulses_per_hour'], '-', '-', res['peak_rss'] / 2.**20, '-', '-'))
+            continue
+        lines.append('{:<18} {:>10.1f} {:>10.1f} {:>+9.1%} {:>10.0f} {:>10.0f} {:>+9.1%}'.format(
+            name, res['pulses_per_hour'], base['pulses_per_hour'],
+            res['pulses_per_hour'] / base['pulses_per_hour'] - 1,
+            res['peak_rss'] / 2.**20, base['peak_rss'] / 2.**20, float(res['peak_rss']) / base['peak_rss'] - 1))
+    return '\n'.join(lines)
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--nx", dest="nx", type="int", default=256, help="Number of points in horizontal direction")
+    parser.add_option("--ny", dest="ny", type="int", default=256, help="Number of points in vertical direction")
+    parser.add_option("--nslices", dest="nslices", type="int", default=100, help="Number of slices")
+    parser.add_option("--kind", dest="kind", choices=['gaussian', 'sase'], default='sase',
+                      help="Synthetic pulse: gaussian or sase (default)")
+    parser.add_option("--pulses", dest="pulses", type="int", default=1,
+                      help="Number of pulses per beamline, SASE pulses differ in the random seed")
+    parser.add_option("--photon-energy", dest="photon_energy", type="float", default=DEFAULT_PHOTON_ENERGY,
+                      help="Photon energy [keV], default %default")
+    parser.add_option("--beamline-file", dest="beamline_files", action="append", default=None,
+                      help="Python file with get_beamline() definition, can be repeated, "
+                           "default the built-in beamline, my_beamline.py and my_s2e_beamline.py")
+    parser.add_option("--output-level", dest="output_level", choices=['full', 'intensity', 'summary'],
+                      default='full', help="Output level of the propagated files, default %default")
+    parser.add_option("--work-dir", dest="work_dir", default=None,
+                      help="Directory for the input and output files, default is a temporary directory")
+    parser.add_option("--json", dest="json_fname", default=None, help="Save results to a JSON file")
+    parser.add_option("--save-baseline", dest="save_baseline", default=None,
+                      help="Save results as the baseline JSON file")
+    parser.add_option("--baseline", dest="baseline", default=None, help="Compare results to the baseline JSON file")
+    parser.add_option("--threshold", dest="threshold", type="float", default=DEFAULT_THRESHOLD,
+                      help="Relative slowdown or memory growth reported as regression, default %default")
+    (options, args) = parser.parse_args()
+
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    config = {'nx': options.nx, 'ny': options.ny, 'nSlices': options.nslices, 'kind': options.kind,
+              'pulses': options.pulses, 'photon_energy': options.photon_energy, 'output_level': options.output_level}
+    if baseline is not None and baseline['config'] != config:
+        parser.error('Configuration differs from the baseline: {}'.format(baseline['config']))
+    beamlines = [(f, f) for f in options.beamline_files] if options.beamline_files else BEAMLINES
+
+    work_dir = options.work_dir or tempfile.mkdtemp()
+    try:
+        results = run(config, beamlines, work_dir)
+    finally:
+        if not options.work_dir:
+            shutil.rmtree(work_dir)
+
+    print(format_results(results, baseline))
+    for fname in [options.json_fname, options.save_baseline]:
+        if fname:
+            with open(fname, 'w') as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+    if baseline is not None:
+        regressions = compare_baseline(results, baseline, options.threshold)
+        for name, message in regressions:
+            print('Regression {}: {}'.format(name, message))
+        if regressions:
+            sys.exit(1)
+        print('No regressions against {}'.format(options.baseline))
+
+if __name__ == "__main__":
+    main()
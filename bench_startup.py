@@ -0,0 +1,218 @@
+"""
+Startup benchmark of the propagation scripts.
+
+Measured in fresh processes, the median of --repeat runs:
+
+    import time of numpy, h5py, WPG/SRW, pylab, propagateSE and diagnostics
+    propagateSE.py --help
+    first pulse of a single-file run (--input-file), from start to exit
+    first pulse and whole batch of a batch run (--input-directory), the first
+    pulse is the time to its 'Done' line in the output
+
+The pulses are synthetic (see bench_propagation). The results can be saved as a
+baseline JSON and later runs compared to it, a time longer by more than the
+threshold is a regression and the exit status is 1.
+
+Usage:
+python bench_startup.py --nx 128 --ny 128 --nslices 20 --save-baseline startup.json
+python bench_startup.py --nx 128 --ny 128 --nslices 20 --baseline startup.json
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import bench_threads
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROPAGATE_SCRIPT = os.path.join(PACKAGE_DIR, 'propagateSE.py')
+IMPORTED_MODULES = ['numpy', 'h5py', 'wpg', 'wpg.srwlib', 'pylab', 'propagateSE', 'diagnostics']
+DEFAULT_THRESHOLD = 0.2
+# shorter times are not compared with the baseline, they are dominated by noise
+MIN_COMPARED_TIME = 0.05
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    return values[n // 2] if n % 2 else 0.5 * (values[n // 2 - 1] + values[n // 2])
+
+
+def import_time(module):
+    """
+    :param module: module name
+    :return: time of the import in a fresh interpreter [s], None if the module can not be imported
+    """
+    code = 'import sys, time; sys.path.insert(0, {!r}); t0 = time.time(); import {}; print(time.time() - t0)'.format(
+        PACKAGE_DIR, module)
+    process = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        return None
+    return float(out.decode().strip().splitlines()[-1])
+
+
+def run_time(args):
+    """
+    :param args: arguments of propagateSE.py
+    :return: wall time of the run [s], None if it failed
+    """
+    with open(os.devnull, 'w') as devnull:
+        t0 = time.time()
+        status = subprocess.call([sys.executable, PROPAGATE_SCRIPT] + args, stdout=devnull, stderr=subprocess.STDOUT)
+    return time.time() - t0 if status == 0 else None
+
+
+def batch_times(args):
+    """
+    :param args: arguments of propagateSE.py
+    :return: (time to the first finished pulse, wall time of the run) [s], (None, None) if it failed
+    """
+    t0 = time.time()
+    first = None
+    process = subprocess.Popen([sys.executable, '-u', PROPAGATE_SCRIPT] + args, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    for line in iter(process.stdout.readline, b''):
+        if first is None and b'Done:' in line:
+            first = time.time() - t0
+    process.wait()
+    if process.returncode != 0 or first is None:
+        return None, None
+    return first, time.time() - t0
+
+
+def run(config, work_dir, repeat):
+    """
+    :param config: dict with nx, ny, nSlices, kind, pulses, output_level
+    :param work_dir: directory for the input and output files
+    :param repeat: number of runs of every measurement
+    :return: dict with config, times (name: median time [s] or None) and python version
+    """
+    times = {}
+    for module in IMPORTED_MODULES:
+        runs = [import_time(module) for i in range(repeat)]
+        times['import ' + module] = None if None in runs else median(runs)
+        print('import {}: {}'.format(module, 'failed' if times['import ' + module] is None
+                                     else '{:.3f} s'.format(times['import ' + module])))
+    runs = [run_time(['--help']) for i in range(repeat)]
+    times['--help'] = None if None in runs else median(runs)
+
+    in_dname, pulses = bench_threads.prepare_input(
+        work_dir, config['pulses'],
+        wavefront_options={'nx': config['nx'], 'ny': config['ny'], 'n_slices': config['nSlices'],
+                           'kind': config['kind']})
+    in_fname = os.path.join(in_dname, sorted(os.listdir(in_dname))[0])
+    output_args = ['--output-level', config['output_level']]
+    runs = []
+    for i in range(repeat):
+        out_fname = os.path.join(work_dir, 'single', 'prop_out.h5')
+        runs.append(run_time(['--input-file', in_fname, '--output-file', out_fname] + output_args))
+        shutil.rmtree(os.path.dirname(out_fname), ignore_errors=True)
+    times['single file'] = None if None in runs else median(runs)
+    print('single file: {}'.format('failed' if times['single file'] is None
+                                   else '{:.2f} s'.format(times['single file'])))
+
+    firsts, totals = [], []
+    for i in range(repeat):
+        out_dname = os.path.join(work_dir, 'batch')
+        first, total = batch_times(['--input-directory', in_dname, '--output-directory', out_dname,
+                                    '--cpu-number', str(pulses)] + output_args)
+        shutil.rmtree(out_dname, ignore_errors=True)
+        firsts.append(first)
+        totals.append(total)
+    times['batch first pulse'] = None if None in firsts else median(firsts)
+    times['batch'] = None if None in totals else median(totals)
+    print('batch: first pulse {}'.format(times['batch first pulse']))
+    return {'config': config, 'times': times, 'python': sys.version.split()[0]}
+
+
+def compare_baseline(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    :param results: result of run
+    :param baseline: result of an earlier run with the same config
+    :param threshold: relative slowdown considered a regression
+    :return: list of (name, message)
+    """
+    regressions = []
+    for name, value in sorted(results['times'].items()):
+        base = baseline['times'].get(name)
+        if value is None or base is None or base < MIN_COMPARED_TIME:
+            continue
+        if value > (1 + threshold) * base:
+            regressions.append((name, '{:.3f} s, baseline {:.3f} s'.format(value, base)))
+    return regressions
+
+
+def format_results(results, baseline=None):
+    """
+    :param results: result of run
+    :param baseline: result of an earlier run, its times are shown for comparison
+    :return: text table
+    """
+    lines = ['python {}'.format(results['python']),
+             '{:<30} {:>10} {:>10}'.format('', 'time [s]', 'baseline' if baseline else '')]
+    for name in sorted(results['times']):
+        value = results['times'][name]
+        base = baseline['times'].get(name) if baseline else None
+        lines.append('{:<30} {:>10} {:>10}'.format(name, 'failed' if value is None else '{:.3f}'.format(value),
+                                                   '' if base is None else '{:.3f}'.format(base)))
+    return '\n'.join(lines)
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--nx", dest="nx", type="int", default=128, help="Number of points in horizontal direction")
+    parser.add_option("--ny", dest="ny", type="int", default=128, help="Number of points in vertical direction")
+    parser.add_option("--nslices", dest="nslices", type="int", default=20, help="Number of slices")
+    parser.add_option("--kind", dest="kind", choices=['gaussian', 'sase'], default='gaussian',
+                      help="Synthetic pulse: gaussian (default) or sase")
+    parser.add_option("--pulses", dest="pulses", type="int", default=2,
+                      help="Number of pulses of the batch runs, all propagated at once, default %default")
+    parser.add_option("--output-level", dest="output_level", choices=['full', 'intensity', 'summary'],
+                      default='summary', help="Output level of the propagated files, default %default")
+    parser.add_option("--repeat", dest="repeat", type="int", default=3,
+                      help="Number of runs of every measurement, the median is reported, default %default")
+    parser.add_option("--work-dir", dest="work_dir", default=None,
+                      help="Directory for the input and output files, default is a temporary directory")
+    parser.add_option("--json", dest="json_fname", default=None, help="Save results to a JSON file")
+    parser.add_option("--save-baseline", dest="save_baseline", default=None,
+                      help="Save results as the baseline JSON file")
+    parser.add_option("--baseline", dest="baseline", default=None, help="Compare results to the baseline JSON file")
+    parser.add_option("--threshold", dest="threshold", type="float", default=DEFAULT_THRESHOLD,
+                      help="Relative slowdown reported as regression, default %default")
+    (options, args) = parser.parse_args()
+
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    config = {'nx': options.nx, 'ny': options.ny, 'nSlices': options.nslices, 'kind': options.kind,
+              'pulses': options.pulses, 'output_level': options.output_level}
+    if baseline is not None and baseline['config'] != config:
+        parser.error('Configuration differs from the baseline: {}'.format(baseline['config']))
+
+    work_dir = tempfile.mkdtemp(dir=options.work_dir)
+    try:
+        results = run(config, work_dir, options.repeat)
+    finally:
+        shutil.rmtree(work_dir)
+
+    print(format_results(results, baseline))
+    for fname in [options.json_fname, options.save_baseline]:
+        if fname:
+            with open(fname, 'w') as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+    if baseline is not None:
+        regressions = compare_baseline(results, baseline, options.threshold)
+        for name, message in regressions:
+            print('Regression {}: {}'.format(name, message))
+        if regressions:
+            sys.exit(1)
+        print('No regressions against {}'.format(options.baseline))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Sweep of the split of the CPU cores between worker processes and threads per worker.
+
+The same batch of pulses is propagated with propagateSE.py for every split
+workers x threads (by default all splits with workers * threads = number of
+cores and no more workers than pulses). Every run is a separate process, so
+that the threads are set before SRW is loaded (see thread_budget). Reported are
+pulses per hour of every split and the best one, to be used with --cpu-number
+and --threads-per-worker of propagateSE.py.
+
+The pulses are the first files of an input directory or synthetic pulses (see
+bench_propagation).
+
+Usage:
+python bench_threads.py --input-directory FELsource --pulses 16
+python bench_threads.py --nx 256 --ny 256 --nslices 100 --beamline-file my_beamline.py
+"""
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from glob import glob
+
+PROPAGATE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'propagateSE.py')
+# lines of the output of a failed run printed
+LOG_TAIL_LINES = 20
+
+
+def default_splits(cores, pulses):
+    """
+    :param cores: number of cores
+    :param pulses: number of pulses in the batch
+    :return: list of (workers, threads) with workers * threads = cores and workers <= pulses
+    """
+    return [(workers, cores // workers) for workers in range(1, cores + 1)
+            if cores % workers == 0 and workers <= pulses]
+
+
+def parse_splits(text):
+    """
+    :param text: comma separated workers x threads, e.g. '8x1,4x2'
+    :return: list of (workers, threads)
+    """
+    return [tuple(int(n) for n in item.split('x')) for item in text.split(',')]
+
+
+def run_split(in_dname, workers, threads, work_dir, extra_args=()):
+    """
+    Propagate all pulses of the directory with propagateSE.py
+
+    :param in_dname: input directory
+    :param workers: number of worker processes (--cpu-number)
+    :param threads: threads per worker (--threads-per-worker)
+    :param work_dir: directory for the output and the log of the run
+    :param extra_args: further arguments of propagateSE.py
+    :return: wall time [s], None if propagateSE.py failed
+    """
+    out_dname = tempfile.mkdtemp(dir=work_dir)
+    log_fname = os.path.join(work_dir, 'bench_threads_{}x{}.log'.format(workers, threads))
+    cmd = [sys.executable, PROPAGATE_SCRIPT, '--input-directory', in_dname, '--output-directory', out_dname,
+           '--cpu-number', str(workers), '--threads-per-worker', str(threads)] + list(extra_args)
+    try:
+        with open(log_fname, 'w') as log:
+            t0 = time.time()
+            status = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT)
+            wall_time = time.time() - t0
+    finally:
+        shutil.rmtree(out_dname)
+    if status != 0:
+        with open(log_fname) as log:
+            print('{}x{} failed:\n{}'.format(workers, threads, ''.join(log.readlines()[-LOG_TAIL_LINES:])))
+        return None
+    return wall_time
+
+
+def prepare_input(work_dir, pulses, in_dname=None, wavefront_options=None):
+    """
+    Directory with the pulses of the benchmark
+
+    :param work_dir: working directory
+    :param pulses: number of pulses
+    :param in_dname: directory with FELsource_out*.h5 files, the first ones are linked, None for synthetic pulses
+    :param wavefront_options: arguments of bench_propagation.synthetic_wavefront for synthetic pulses
+    :return: (directory, number of pulses)
+    """
+    dname = os.path.join(work_dir, 'input')
+    os.mkdir(dname)
+    if in_dname is not None:
+        for fname in sorted(glob(os.path.join(in_dname, 'FELsource_out*.h5')))[:pulses]:
+            os.symlink(os.path.abspath(fname), os.path.join(dname, os.path.basename(fname)))
+        return dname, len(os.listdir(dname))
+    import bench_propagation
+    # generated in a pool process, so that SRW is not loaded here
+    pool = multiprocessing.Pool(1)
+    try:
+        for seed in range(pulses):
+            fname = os.path.join(dname, 'FELsource_out_{:07d}.h5'.format(seed))
+            pool.apply(bench_propagation.write_pulse, ((fname, dict(wavefront_options, seed=seed)),))
+    finally:
+        pool.close()
+        pool.join()
+    return dname, pulses
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--input-directory", dest="in_dname", default=None,
+                      help="Directory with FELsource_out*.h5 files, default synthetic pulses")
+    parser.add_option("--pulses", dest="pulses", type="int", default=multiprocessing.cpu_count(),
+                      help="Number of pulses in the batch, default the number of cores")
+    parser.add_option("--nx", dest="nx", type="int", default=256, help="Synthetic pulses: points in horizontal direction")
+    parser.add_option("--ny", dest="ny", type="int", default=256, help="Synthetic pulses: points in vertical direction")
+    parser.add_option("--nslices", dest="nslices", type="int", default=100, help="Synthetic pulses: number of slices")
+    parser.add_option("--kind", dest="kind", choices=['gaussian', 'sase'], default='sase',
+                      help="Synthetic pulses: gaussian or sase (default)")
+    parser.add_option("--cores", dest="cores", type="int", default=multiprocessing.cpu_count(),
+                      help="Number of cores shared by workers and threads, default all")
+    parser.add_option("--splits", dest="splits", default=None,
+                      help="Comma separated WORKERSxTHREADS to try, e.g. 8x1,4x2,2x4, "
+                           "default all splits of the cores")
+    parser.add_option("--beamline-file", dest="beamline_file", default=None,
+                      help="Python file with get_beamline() definition, default is the built-in beamline")
+    parser.add_option("--engine", dest="engine", choices=['srw', 'fft'], default='srw',
+                      help="Propagation engine: srw (default) or fft")
+    parser.add_option("--output-level", dest="output_level", choices=['full', 'intensity', 'summary'],
+                      default='full', help="Output level of the propagated files, default %default")
+    parser.add_option("--work-dir", dest="work_dir", default=None,
+                      help="Directory for the input and output files, default is a temporary directory")
+    parser.add_option("--json", dest="json_fname", default=None, help="Save results to a JSON file")
+    (options, args) = parser.parse_args()
+
+    extra_args = ['--output-level', options.output_level, '--engine', options.engine]
+    if options.beamline_file:
+        extra_args += ['--beamline-file', os.path.abspath(options.beamline_file)]
+    work_dir = tempfile.mkdtemp(dir=options.work_dir)
+    results = []
+    try:
+        in_dname, pulses = prepare_input(work_dir, options.pulses, options.in_dname,
+                                         {'nx': options.nx, 'ny': options.ny, 'n_slices': options.nslices,
+                                          'kind': options.kind})
+        splits = parse_splits(options.splits) if options.splits else default_splits(options.cores, pulses)
+        print('{} pulses, splits {}'.format(pulses, ', '.join('{}x{}'.format(*s) for s in splits)))
+        print('{:>8} {:>8} {:>10} {:>10}'.format('workers', 'threads', 'wall [s]', 'pulses/h'))
+        for workers, threads in splits:
+            wall_time = run_split(in_dname, workers, threads, work_dir, extra_args)
+            if wall_time is None:
+                continue
+            res = {'workers': workers, 'threads': threads, 'wall_time': wall_time,
+                   'pulses_per_hour': 3600. * pulses / wall_time}
+            print('{workers:>8} {threads:>8} {wall_time:>10.1f} {pulses_per_hour:>10.1f}'.format(**res))
+            results.append(res)
+    finally:
+        shutil.rmtree(work_dir)
+
+    if results:
+        best = max(results, key=lambda r: r['pulses_per_hour'])
+        print('Best split: --cpu-number {workers} --threads-per-worker {threads} '
+              '({pulses_per_hour:.1f} pulses/h)'.format(**best))
+    if options.json_fname:
+        with open(options.json_fname, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
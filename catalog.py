@@ -0,0 +1,419 @@
+"""
+Catalog of the propagated pulses of an output directory.
+
+propagate() appends one row per pulse to a JSON-lines shard in the directory
+of the output file: input and output paths, beamline hash, mesh, pulse energy,
+FWHM, centroid and timings. Every process writes its own shard
+prop_catalog.<host>_<pid>.jsonl, like the per-node manifests, so workers and
+nodes sharing the output directory on a network filesystem never write the
+same file. query and rebuild merge the shards into an indexed SQLite database
+on the local disk (the temporary directory by default, --database), new lines
+of the shards are read incrementally, so thousands of pulses are filtered and
+aggregated without opening a wavefront file:
+
+python catalog.py query --output-directory prop --where "fwhm_x > 5e-6" --columns out_fname,fwhm_x
+python catalog.py query --output-directory prop --columns "count(*),sum(pulse_energy)" --group-by beamline_hash
+python catalog.py rebuild --output-directory prop --cpu-number 8
+
+rebuild backfills the catalog from existing prop_out*.h5 files in parallel
+(unchanged files with a row are skipped), e.g. for outputs of older versions or
+of runs which could not write the catalog. Beamline hash, input file and wall
+time of rebuilt rows come from the manifest, if it has a record of the file.
+The rows are appended to a shard of the rebuild process, so they reach every
+local database. The catalog is only an index of the output files, a row which
+could not be written is reported and left to rebuild.
+"""
+import os
+import json
+import hashlib
+import socket
+import sqlite3
+import tempfile
+import time
+from glob import glob
+
+# shards of the output directory, one per writing process
+SHARD_PREFIX = 'prop_catalog.'
+SHARD_SUFFIX = '.jsonl'
+# seconds to wait for the lock of another process using the local database
+LOCK_TIMEOUT = 60.
+# (name, SQL type) of the columns
+COLUMNS = [('out_fname', 'TEXT PRIMARY KEY'), ('in_fname', 'TEXT'), ('beamline_hash', 'TEXT'),
+           ('out_size', 'INTEGER'), ('out_mtime', 'REAL'),
+           ('nx', 'INTEGER'), ('ny', 'INTEGER'), ('nSlices', 'INTEGER'),
+           ('xMin', 'REAL'), ('xMax', 'REAL'), ('yMin', 'REAL'), ('yMax', 'REAL'),
+           ('sliceMin', 'REAL'), ('sliceMax', 'REAL'), ('photonEnergy', 'REAL'),
+           ('pulse_energy', 'REAL'), ('fwhm_x', 'REAL'), ('fwhm_y', 'REAL'),
+           ('centroid_x', 'REAL'), ('centroid_y', 'REAL'),
+           ('engine', 'TEXT'), ('output_level', 'TEXT'),
+           ('load_time', 'REAL'), ('propagation_time', 'REAL'), ('save_time', 'REAL'), ('wall_time', 'REAL'),
+           ('finished', 'REAL'), ('host', 'TEXT')]
+COLUMN_NAMES = [name for name, sql_type in COLUMNS]
+# rows appended at once by rebuild
+REBUILD_BATCH_ROWS = 100
+INDEXED = ['in_fname', 'beamline_hash', 'pulse_energy', 'fwhm_x', 'fwhm_y', 'finished']
+
+
+def make_row(in_fname, out_fname, bl_hash, mesh, metrics, timings=None, engine=None, output_level=None):
+    """
+    Build a catalog row of a propagated pulse
+
+    :param in_fname: input wavefront file, None if unknown
+    :param out_fname: output wavefront file, must exist
+    :param bl_hash: beamline hash (see manifest.beamline_hash), None if unknown
+    :param mesh: dict with nx, ny, nSlices, xMin, xMax, yMin, yMax, sliceMin, sliceMax, photonEnergy of the output
+    :param metrics: dict with pulse_energy, fwhm_x, fwhm_y, centroid_x, centroid_y
+    :param timings: dict with load_time, propagation_time, save_time, wall_time [s]
+    :param engine: propagation engine, 'srw' or 'fft'
+    :param output_level: output level of the file, see h5_layout
+    :return: dict with COLUMN_NAMES keys
+    """
+    st = os.stat(out_fname)
+    row = dict((name, None) for name in COLUMN_NAMES)
+    row.update({'out_fname': os.path.abspath(out_fname),
+                'in_fname': os.path.abspath(in_fname) if in_fname else None,
+                'beamline_hash': bl_hash, 'out_size': st.st_size, 'out_mtime': st.st_mtime,
+                'engine': engine, 'output_level': output_level,
+                'finished': time.time(), 'host': socket.gethostname()})
+    for source in [mesh, metrics, timings or {}]:
+        for key, value in source.items():
+            if key in row:
+                row[key] = value
+    for key in ['nx', 'ny', 'nSlices', 'out_size']:
+        row[key] = int(row[key])
+    for key, sql_type in COLUMNS:
+        if sql_type == 'REAL' and row[key] is not None:
+            row[key] = float(row[key])
+    return row
+
+
+def shard_name(owner=None):
+    """
+    :param owner: name of the writing process, default host_pid
+    :return: name of the shard appended by the process
+    """
+    owner = owner or '{}_{}'.format(socket.gethostname(), os.getpid())
+    return SHARD_PREFIX + owner.replace(os.sep, '_').replace(':', '_') + SHARD_SUFFIX
+
+
+def local_database(out_dname):
+    """
+    :param out_dname: output directory name
+    :return: default local database of the output directory, in the temporary directory
+    """
+    key = hashlib.sha1(os.path.realpath(out_dname).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), 'prop_catalog_{}.sqlite'.format(key))
+
+
+class Catalog(object):
+    """
+    Local SQLite database of the pulse catalog of an output directory
+    """
+
+    def __init__(self, out_dname, fname=None):
+        """
+        :param out_dname: output directory name
+        :param fname: database file on the local disk, default local_database(out_dname)
+        """
+        self.out_dname = out_dname
+        self.fname = fname or local_database(out_dname)
+        self.connection = sqlite3.connect(self.fname, timeout=LOCK_TIMEOUT)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS pulses ({})'.format(
+                ', '.join('{} {}'.format(name, sql_type) for name, sql_type in COLUMNS)))
+            for column in INDEXED:
+                self.connection.execute('CREATE INDEX IF NOT EXISTS pulses_{0} ON pulses ({0})'.format(column))
+            # bytes of every shard already merged
+            self.connection.execute('CREATE TABLE IF NOT EXISTS shards (fname TEXT PRIMARY KEY, offset INTEGER)')
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, rows):
+        """
+        Insert the rows in one transaction, replacing rows of the same output file unless they are newer
+
+        :param rows: list of dicts from make_row
+        """
+        with self.connection:
+            self._add(rows)
+
+    def _add(self, rows):
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO pulses ({}) SELECT {} WHERE NOT EXISTS '
+            '(SELECT 1 FROM pulses WHERE out_fname = ? AND finished > ?)'.format(
+                ', '.join(COLUMN_NAMES), ', '.join('?' * len(COLUMN_NAMES))),
+            [[row[name] for name in COLUMN_NAMES] + [row['out_fname'], row['finished']] for row in rows])
+
+    def merge(self):
+        """
+        Insert the rows appended to the shards of the output directory since the last merge
+
+        :return: number of rows read
+        """
+        offsets = dict(self.connection.execute('SELECT fname, offset FROM shards'))
+        merged = 0
+        for fname in sorted(glob(os.path.join(self.out_dname, SHARD_PREFIX + '*' + SHARD_SUFFIX))):
+            key = os.path.basename(fname)
+            offset = offsets.get(key, 0)
+            if os.path.getsize(fname) < offset:  # rewritten
+                offset = 0
+            with open(fname, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+            # a last line without newline is still being written
+            data = data[:data.rfind(b'\n') + 1]
+            rows = []
+            for line in data.splitlines():
+                try:
+                    rows.append(json.loads(line.decode('utf-8')))
+                except ValueError:  # truncated line of a killed process
+                    continue
+            with self.connection:
+                self._add(rows)
+                self.connection.execute('INSERT OR REPLACE INTO shards (fname, offset) VALUES (?, ?)',
+                                        (key, offset + len(data)))
+            merged += len(rows)
+        return merged
+
+    def signatures(self):
+        """
+        :return: dict output file: (size, modification time) of all rows
+        """
+        return dict((fname, (size, mtime)) for fname, size, mtime in
+                    self.connection.execute('SELECT out_fname, out_size, out_mtime FROM pulses'))
+
+    def query(self, columns='*', where=None, group_by=None, order_by=None, limit=None, params=()):
+        """
+        Select from the pulses table
+
+        :param columns: SQL expressions of the result columns, e.g. 'count(*), sum(pulse_energy)'
+        :param where: SQL condition, e.g. 'fwhm_x > 5e-6', ? placeholders are filled from params
+        :param group_by: SQL GROUP BY expressions
+        :param order_by: SQL ORDER BY expressions
+        :param limit: maximal number of rows
+        :param params: values of the placeholders
+        :return: (column names, list of row tuples)
+        """
+        sql = 'SELECT {} FROM pulses'.format(columns)
+        if where:
+            sql += ' WHERE ' + where
+        if group_by:
+            sql += ' GROUP BY ' + group_by
+        if order_by:
+            sql += ' ORDER BY ' + order_by
+        if limit is not None:
+            sql += ' LIMIT {:d}'.format(limit)
+        cursor = self.connection.execute(sql, params)
+        return [d[0] for d in cursor.description], cursor.fetchall()
+
+
+def append_rows(dname, rows, name=None):
+    """
+    Append rows to the shard of this process
+
+    :param dname: output directory
+    :param rows: list of dicts from make_row
+    :param name: name of the shard, default shard_name()
+    """
+    with open(os.path.join(dname, name or shard_name()), 'a') as f:
+        for row in rows:
+            f.write(json.dumps(row, sort_keys=True) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def add_row(row):
+    """
+    Append a row to the catalog of the directory of the output file, failures are reported only
+
+    :param row: dict from make_row
+    :return: True if the row was written
+    """
+    try:
+        append_rows(os.path.dirname(row['out_fname']), [row])
+    except (IOError, OSError) as exc:
+        print('Catalog row of {} not written, use catalog.py rebuild: {}'.format(row['out_fname'], exc))
+        return False
+    return True
+
+
+def _in_fname_from_history(h5):
+    # parent file recorded by history.add_history_linked or propagateSE.add_history
+    import history
+    if history.PROVENANCE in h5:
+        return h5[history.PROVENANCE].attrs['parent']
+    link = h5.get('history/parent/detail/data', getlink=True)
+    return getattr(link, 'filename', None)
+
+
+def row_from_file(params):
+    """
+    Read a catalog row from an output file, run in a pool process
+
+    :param params: (output file, manifest record of the file or None)
+    :return: (output file, row or None, error or None)
+    """
+    out_fname, record = params
+    try:
+        import h5py
+        import wf_metrics
+        record = record or {}
+        with h5py.File(out_fname, 'r') as h5:
+            mesh = wf_metrics.read_params(h5)
+            misc = h5['misc'] if 'misc' in h5 else {}
+            metrics = {}
+            for key, path in [('pulse_energy', 'pulse_energy'), ('fwhm_x', 'xFWHM'), ('fwhm_y', 'yFWHM'),
+                              ('centroid_x', 'xCentroid'), ('centroid_y', 'yCentroid')]:
+                if path in misc:
+                    metrics[key] = misc[path][()]
+            data = h5['data']
+            output_level = 'full' if 'arrEhor' in data else 'intensity' if 'intensity' in data else 'summary'
+            in_fname = record.get('in_fname') or _in_fname_from_history(h5)
+        if 'pulse_energy' not in metrics or 'centroid_x' not in metrics:
+            # outputs of older versions
+            mesh, field_metrics = wf_metrics.metrics_from_hdf5(out_fname)
+            box = (mesh['xMin'], mesh['xMax'], mesh['yMin'], mesh['yMax'])
+            centroid = field_metrics.centroid(*box)
+            computed = field_metrics.fwhm(*box)
+            computed.update(centroid_x=centroid['x'], centroid_y=centroid['y'],
+                            pulse_energy=field_metrics.pulse_energy(*(box + (mesh['sliceMin'], mesh['sliceMax']))))
+            computed.update(metrics)
+            metrics = computed
+        row = make_row(in_fname, out_fname, record.get('beamline_hash'), mesh, metrics,
+                       {'wall_time': record.get('wall_time')}, output_level=output_level)
+        row['finished'] = row['out_mtime']
+        row['host'] = None
+        return (out_fname, row, None)
+    except Exception:
+        import traceback
+        return (out_fname, None, traceback.format_exc())
+
+
+def rebuild(out_dname, cpu_number, force=False, recursive=False):
+    """
+    Add rows of the output files missing in the catalog or changed since their row was written
+
+    :param out_dname: output directory
+    :param cpu_number: number of processes reading the files
+    :param force: read all files
+    :param recursive: also the prop_out*.h5 files of the subdirectories, e.g. of a parameter scan, every
+        directory gets its own catalog
+    :return: (number of rows written, list of (file, error) of files which could not be read)
+    """
+    import multiprocessing
+    import manifest
+    if recursive:
+        dnames = sorted(set(dname for dname, subdirs, files in os.walk(out_dname)
+                            if any(f.startswith('prop_out') and f.endswith('.h5') for f in files)))
+    else:
+        dnames = [out_dname]
+    written = 0
+    failed = []
+    pool = multiprocessing.Pool(cpu_number)
+    try:
+        for dname in dnames:
+            catalog = Catalog(dname)
+            try:
+                catalog.merge()
+                known = {} if force else catalog.signatures()
+                records = manifest.Manifest(dname).records
+                todo = []
+                for fname in sorted(glob(os.path.join(dname, 'prop_out*.h5'))):
+                    fname = os.path.abspath(fname)
+                    st = os.stat(fname)
+                    if known.get(fname) != (st.st_size, st.st_mtime):
+                        todo.append((fname, records.get(fname)))
+                rows = []
+                dname_written = 0
+                for fname, row, error in pool.imap_unordered(row_from_file, todo):
+                    if error is not None:
+                        failed.append((fname, error))
+                        print('Failed {}:\n{}'.format(fname, error))
+                        continue
+                    rows.append(row)
+                    if len(rows) == REBUILD_BATCH_ROWS:
+                        append_rows(dname, rows)
+                        dname_written += len(rows)
+                        rows = []
+                append_rows(dname, rows)
+                dname_written += len(rows)
+                written += dname_written
+                catalog.merge()
+                print('{}: {} rows written'.format(dname, dname_written))
+            finally:
+                catalog.close()
+        pool.close()
+    except BaseException:  # join() of a running pool would raise and hide the error
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return written, failed
+
+
+def format_table(names, rows, csv=False):
+    """
+    :param names: column names
+    :param rows: row tuples
+    :param csv: comma separated instead of aligned columns
+    :return: text
+    """
+    def text(value):
+        return '{:.6g}'.format(value) if isinstance(value, float) else str(value)
+    lines = [[str(name) for name in names]] + [[text(value) for value in row] for row in rows]
+    if csv:
+        return '\n'.join(','.join(line) for line in lines)
+    widths = [max(len(line[i]) for line in lines) for i in range(len(names))]
+    return '\n'.join(' '.join(value.rjust(width) for value, width in zip(line, widths)) for line in lines)
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage='%prog query|rebuild --output-directory DIR [options]')
+    parser.add_option("--output-directory", dest="out_dname", help="Output directory of propagateSE.py")
+    parser.add_option("--database", dest="database", default=None,
+                      help="query: SQLite database merged from the catalog shards, on a local disk, "
+                           "default in the temporary directory")
+    parser.add_option("--columns", dest="columns", default='out_fname,pulse_energy,fwhm_x,fwhm_y,wall_time',
+                      help="query: comma separated columns or SQL expressions, default %default")
+    parser.add_option("--where", dest="where", default=None, help="query: SQL condition, e.g. 'fwhm_x > 5e-6'")
+    parser.add_option("--group-by", dest="group_by", default=None, help="query: SQL GROUP BY, e.g. beamline_hash")
+    parser.add_option("--order-by", dest="order_by", default=None, help="query: SQL ORDER BY, e.g. 'fwhm_x DESC'")
+    parser.add_option("--limit", dest="limit", type="int", default=None, help="query: maximal number of rows")
+    parser.add_option("--csv", dest="csv", action="store_true", default=False, help="query: comma separated output")
+    parser.add_option("-n", "--cpu-number", dest="cpu_number", type="int", default=None,
+                      help="rebuild: number of processes reading files, default all cores")
+    parser.add_option("--force", dest="force", action="store_true", default=False,
+                      help="rebuild: read all files, also unchanged files with a row")
+    parser.add_option("--recursive", dest="recursive", action="store_true", default=False,
+                      help="rebuild: also the subdirectories, e.g. of a parameter scan")
+    (options, args) = parser.parse_args()
+    if len(args) != 1 or args[0] not in ['query', 'rebuild']:
+        parser.error('Command query or rebuild expected')
+    if not options.out_dname:
+        parser.error('Output directory not specified, use --output-directory option')
+
+    if args[0] == 'rebuild':
+        import multiprocessing
+        written, failed = rebuild(options.out_dname, options.cpu_number or multiprocessing.cpu_count(),
+                                  options.force, options.recursive)
+        print('{} rows written, {} files failed'.format(written, len(failed)))
+        return
+    if not glob(os.path.join(options.out_dname, SHARD_PREFIX + '*' + SHARD_SUFFIX)):
+        parser.error('No catalog in {}, use rebuild'.format(options.out_dname))
+    catalog = Catalog(options.out_dname, options.database)
+    try:
+        catalog.merge()
+        t0 = time.time()
+        names, rows = catalog.query(options.columns, options.where, options.group_by, options.order_by,
+                                    options.limit)
+        elapsed = time.time() - t0
+    finally:
+        catalog.close()
+    print(format_table(names, rows, options.csv))
+    if not options.csv:
+        print('{} rows in {:.1f} ms'.format(len(rows), elapsed * 1e3))
+
+if __name__ == "__main__":
+    main()
@@ -5,13 +5,15 @@ import sys
 sys.path.insert(0,'/data/S2E/packages/WPG/')
 
 import os
-import pylab as plt
 
+import h5py
 import numpy as np
-from wpg import Wavefront
 
+import wf_metrics
+import history
 
-def show_diagnostics(prop_out_number):
+
+def show_diagnostics(prop_out_number, chunk_slices=wf_metrics.DEFAULT_CHUNK_SLICES):
     # read prop_out_.h5
     if not prop_out_number == 'prop_out_1.h5':
         #prop_out_file = "prop_out_{}.h5".format(prop_out_number.zfill(7))
@@ -23,23 +25,32 @@ def show_diagnostics(prop_out_number):
         print 'Input file {} not found.'.format(prop_out_file)
         return
 
-    wf = Wavefront()
-    wf.load_hdf5(prop_out_file)
+    # all field reductions in one pass over the file, reading chunk_slices slices at once
+    mesh, metrics = wf_metrics.metrics_from_hdf5(prop_out_file, chunk_slices)
+    # history may be copied or linked to the parent files, the resolver handles both
+    temporal_struct = history.read(prop_out_file, 'history/parent/parent/misc/temporal_struct')
+    with h5py.File(prop_out_file, 'r') as h5:
+        sz0 = h5['misc/spectrum0'][()]
+        sz1 = h5['misc/spectrum1'][()]
+    fwhm = metrics.fwhm(mesh['xMin'], mesh['xMax'], mesh['yMin'], mesh['yMax'])
+    print 'FWHM x: {:.2f} um, y: {:.2f} um'.format(fwhm['fwhm_x']*1e6, fwhm['fwhm_y']*1e6)
+
+    # pylab is slow to import, only needed for the figures
+    import pylab as plt
+
     # show two figures window 1: image of I(x,y) integral intensity, with real
     # x and y axis and title with file name
     J2eV = 6.24150934e18
-    mesh = wf.params.Mesh
-    tmin = mesh.sliceMin
-    tmax = mesh.sliceMax
-    dt = (tmax - tmin) / (mesh.nSlices - 1)
-    dx = (mesh.xMax - mesh.xMin) / (mesh.nx - 1)
-    dy = (mesh.yMax - mesh.yMin) / (mesh.ny - 1)
-
-    wf_intensity = wf.get_intensity(polarization='horizontal')
-    total_intensity = wf_intensity.sum(axis=-1)
+    tmin = mesh['sliceMin']
+    tmax = mesh['sliceMax']
+    dt = (tmax - tmin) / (mesh['nSlices'] - 1)
+    dx = (mesh['xMax'] - mesh['xMin']) / (mesh['nx'] - 1)
+    dy = (mesh['yMax'] - mesh['yMin']) / (mesh['ny'] - 1)
+
+    total_intensity = metrics.image_hor
     data = total_intensity * dt
     plt.figure()
-    plt.imshow(data*dx*dy*1e6*J2eV/wf.params.photonEnergy,extent=[mesh.xMin*1e6,mesh.xMax*1e6,mesh.yMin*1e6,mesh.yMax * 1e6])
+    plt.imshow(data*dx*dy*1e6*J2eV/mesh['photonEnergy'],extent=[mesh['xMin']*1e6,mesh['xMax']*1e6,mesh['yMin']*1e6,mesh['yMax'] * 1e6])
     title = 'Number of photons per %.2f x %.2f $nm ^2$ pixel'  %  (dx*1e9, dx*1e9)
     plt.title(title)
     plt.colorbar()
@@ -47,7 +58,6 @@ def show_diagnostics(prop_out_number):
 
     # window 2: plot of 2 curves:
     #(1) history/parent/parent/temporal_struct - before propagating
-    temporal_struct = wf.custom_fields['history']['parent']['parent']['misc']['temporal_struct']
     t0 = (temporal_struct[:, 0].max() + temporal_struct[:, 0].min()) / 2
 
     plt.figure()
@@ -55,8 +65,8 @@ def show_diagnostics(prop_out_number):
     plt.hold(True)
     #(2) integral intensity I(t) after propagating
 
-    t = np.linspace(tmin, tmax, wf.params.Mesh.nSlices)
-    pulse_energy = wf.get_intensity().sum(axis=0).sum(axis=0) #check it
+    t = np.linspace(tmin, tmax, mesh['nSlices'])
+    pulse_energy = metrics.power_total #check it
     plt.plot(t * 1e15, pulse_energy*dx*dy*1e6*1e-9,'r', label = 'propag')
 
     title = 'The propagated pulse energy %.2f %s ' % (pulse_energy.sum(axis=0) * dx * dy * 1e6 * dt * 1e3, 'mJ')
@@ -66,8 +76,6 @@ def show_diagnostics(prop_out_number):
     plt.legend()
     plt.grid(True)
 
-    sz0 = wf.custom_fields['misc']['spectrum0']
-    sz1 = wf.custom_fields['misc']['spectrum1']
     plt.figure()
     plt.plot(sz0[:,0],sz0[:,1], label='before propagating')
     plt.hold(True)
@@ -84,13 +92,15 @@ def main():
     from optparse import OptionParser
     parser = OptionParser()
     parser.add_option("--input-file", dest="in_fname", default="prop_out_1.h5",help="Input wavefront file: prop_out_***.h5")
+    parser.add_option("--chunk-slices", dest="chunk_slices", type="int", default=wf_metrics.DEFAULT_CHUNK_SLICES,
+                      help="Number of slices read at once, limits memory usage")
     (options, args) = parser.parse_args()
 
     if not options.in_fname :   # if filename is not given
         parser.error('Input filename not specified, use --input-file options')
         return
 
-    show_diagnostics(options.in_fname)
+    show_diagnostics(options.in_fname, options.chunk_slices)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,448 @@
+"""
+Streaming statistics over an ensemble of propagated pulses.
+
+The prop_out*.h5 files of a directory are reduced in parallel, every file in
+one pass over its field (see wf_metrics), and the results are merged into
+running accumulators as they arrive:
+
+    mean and variance of the integrated intensity (Welford)
+    mean and variance of the spectrum after propagation (/misc/spectrum1)
+    pulse energy and FWHM of every pulse, for histograms
+    mutual intensity along the horizontal and the vertical cut through the
+    center of the mesh, summed over slices, polarizations and pulses, from
+    which the degree of transverse coherence is calculated
+
+Memory does not grow with the number of pulses, only a few numbers per pulse
+are kept. The accumulators are saved in a state file (default
+prop_ensemble.h5 in the input directory) every few pulses and at the end; a
+later run continues from the state and reduces only the new files, so it can
+be run again as new files arrive, or keep watching the directory (--watch).
+Files of another mesh than the first one are skipped, the mutual intensity is
+accumulated only from files with the field (output level full).
+
+Usage:
+python ensemble.py --input-directory prop --cpu-number 8 --plot
+"""
+import multiprocessing
+import os
+import time
+from glob import glob
+
+import h5py
+import numpy as np
+
+import watch
+import wf_metrics
+
+STATE_NAME = 'prop_ensemble.h5'
+DEFAULT_SAVE_EVERY = 20
+DEFAULT_BINS = 20
+MESH_KEYS = ['nx', 'ny', 'nSlices', 'xMin', 'xMax', 'yMin', 'yMax', 'sliceMin', 'sliceMax']
+PULSE_KEYS = ['pulse_energy', 'fwhm_x', 'fwhm_y']
+
+
+def file_signature(fname):
+    """
+    :return: (size, modification time) of the file
+    """
+    st = os.stat(fname)
+    return (st.st_size, st.st_mtime)
+
+
+def reduce_file(params):
+    """
+    Reduce one propagated pulse, run in a pool process
+
+    :param params: (file name, chunk_slices)
+    :return: dict with fname, signature, mesh, image (integrated intensity), spectrum ([n, 2] or None),
+        pulse_energy, fwhm_x, fwhm_y, jx and jy (mutual intensity cuts or None), or with fname and error
+    """
+    fname, chunk_slices = params
+    try:
+        signature = file_signature(fname)
+        cuts = {}
+
+        def add_cuts(ehor, ever, i0):
+            # E*(x1) E(x2) summed over the slices of the chunk, along the central row and column
+            for field in [ehor, ever]:
+                ny, nx = field.shape[:2]
+                for axis, line in [('jx', field[ny // 2, :, :, :]), ('jy', field[:, nx // 2, :, :])]:
+                    c = line[..., 0].astype(np.float64) + 1j * line[..., 1]
+                    j = np.dot(np.conj(c), c.T)
+                    cuts[axis] = cuts[axis] + j if axis in cuts else j
+
+        mesh, metrics = wf_metrics.metrics_from_hdf5(fname, chunk_slices, add_cuts)
+        with h5py.File(fname, 'r') as h5:
+            spectrum = h5['misc/spectrum1'][()] if 'misc/spectrum1' in h5 else None
+        dt = (mesh['sliceMax'] - mesh['sliceMin']) / max(mesh['nSlices'] - 1, 1)
+        res = {'fname': os.path.abspath(fname), 'signature': signature,
+               'mesh': dict((key, mesh[key]) for key in MESH_KEYS),
+               'image': metrics.image_total * dt, 'spectrum': spectrum,
+               'pulse_energy': metrics.pulse_energy(mesh['xMin'], mesh['xMax'], mesh['yMin'], mesh['yMax'],
+                                                    mesh['sliceMin'], mesh['sliceMax']),
+               'jx': cuts.get('jx'), 'jy': cuts.get('jy')}
+        res.update(metrics.fwhm(mesh['xMin'], mesh['xMax'], mesh['yMin'], mesh['yMax']))
+        return res
+    except Exception:
+        import traceback
+        return {'fname': os.path.abspath(fname), 'error': traceback.format_exc()}
+
+
+def _welford(mean, m2, count, x):
+    # add sample x to the running mean and sum of squared deviations of count samples (count includes x)
+    delta = x - mean
+    mean += delta / count
+    m2 += delta * (x - mean)
+
+
+def degree_of_coherence(j):
+    """
+    Degree of transverse coherence from the mutual intensity J(x1, x2) on a uniform mesh
+
+    :param j: mutual intensity [n, n]
+    :return: sum |J|^2 / (sum I)^2, 1 for a fully coherent beam
+    """
+    total = np.real(np.trace(j))
+    return float(np.sum(np.abs(j)**2) / total**2) if total > 0 else float('nan')
+
+
+class EnsembleStats(object):
+    """
+    Running statistics of an ensemble of pulses with the same mesh
+    """
+
+    def __init__(self):
+        self.mesh = None
+        self.count = 0
+        self.image_mean = self.image_m2 = None
+        self.spectrum_energy = None
+        self.spectrum_count = 0
+        self.spectrum_mean = self.spectrum_m2 = None
+        self.coherence_count = 0
+        self.jx = self.jy = None
+        self.pulses = []  # dicts with fname, size, mtime and PULSE_KEYS
+        self.skipped = {}  # file name: reason
+
+    def processed(self):
+        """
+        :return: dict file name: signature of the merged files
+        """
+        return dict((p['fname'], (p['size'], p['mtime'])) for p in self.pulses)
+
+    def incompatible(self, res):
+        """
+        :param res: result of reduce_file
+        :return: reason why the result can not be merged, None if it can
+        """
+        if self.mesh is None:
+            return None
+        for key in MESH_KEYS:
+            if not np.isclose(res['mesh'][key], self.mesh[key]):
+                return 'mesh {} {} differs from {}'.format(key, res['mesh'][key], self.mesh[key])
+        if res['spectrum'] is not None and self.spectrum_mean is not None and \
+                len(res['spectrum']) != len(self.spectrum_mean):
+            return 'spectrum with {} points instead of {}'.format(len(res['spectrum']), len(self.spectrum_mean))
+        return None
+
+    def add(self, res):
+        """
+        Merge the reduction of a pulse
+
+        :param res: result of reduce_file, see incompatible
+        """
+        if self.mesh is None:
+            self.mesh = res['mesh']
+            self.image_mean = np.zeros_like(res['image'], dtype='float64')
+            self.image_m2 = np.zeros_like(self.image_mean)
+        self.count += 1
+        _welford(self.image_mean, self.image_m2, self.count, res['image'])
+        if res['spectrum'] is not None:
+            if self.spectrum_mean is None:
+                self.spectrum_energy = res['spectrum'][:, 0].astype('float64')
+                self.spectrum_mean = np.zeros(len(self.spectrum_energy))
+                self.spectrum_m2 = np.zeros(len(self.spectrum_energy))
+            self.spectrum_count += 1
+            _welford(self.spectrum_mean, self.spectrum_m2, self.spectrum_count, res['spectrum'][:, 1])
+        if res['jx'] is not None:
+            if self.jx is None:
+                self.jx, self.jy = np.zeros_like(res['jx']), np.zeros_like(res['jy'])
+            self.jx += res['jx']
+            self.jy += res['jy']
+            self.coherence_count += 1
+        pulse = {'fname': res['fname'], 'size': res['signature'][0], 'mtime': res['signature'][1]}
+        pulse.update((key, res[key]) for key in PULSE_KEYS)
+        self.pulses.append(pulse)
+
+    def image_std(self):
+        """
+        :return: standard deviation of the integrated intensity over the pulses
+        """
+        return np.sqrt(self.image_m2 / max(self.count - 1, 1))
+
+    def spectrum_std(self):
+        """
+        :return: standard deviation of the spectrum over the pulses
+        """
+        return np.sqrt(self.spectrum_m2 / max(self.spectrum_count - 1, 1))
+
+    def coherence(self):
+        """
+        :return: {'x': degree of coherence along x, 'y': along y}, None without the field
+        """
+        if self.jx is None:
+            return None
+        return {'x': degree_of_coherence(self.jx), 'y': degree_of_coherence(self.jy)}
+
+    def values(self, key):
+        """
+        :param key: one of PULSE_KEYS
+        :return: array of the quantity of all pulses
+        """
+        return np.array([p[key] for p in self.pulses], dtype='float64')
+
+    def histogram(self, key, bins=DEFAULT_BINS):
+        """
+        :param key: one of PULSE_KEYS
+        :param bins: number of bins
+        :return: (counts, bin edges), see numpy.histogram
+        """
+        return np.histogram(self.values(key), bins)
+
+    def save(self, fname):
+        """
+        Save the accumulators, written to a temporary file and renamed, so a killed run keeps the last state
+
+        :param fname: state file
+        """
+        tmp_fname = fname + '.partial'
+        with h5py.File(tmp_fname, 'w') as h5:
+            h5.attrs['count'] = self.count
+            h5.attrs['spectrum_count'] = self.spectrum_count
+            h5.attrs['coherence_count'] = self.coherence_count
+            if self.mesh is not None:
+                for key in MESH_KEYS:
+                    h5['mesh/' + key] = self.mesh[key]
+                h5['image/mean'] = self.image_mean
+                h5['image/m2'] = self.image_m2
+            if self.spectrum_mean is not None:
+                h5['spectrum/energy'] = self.spectrum_energy
+                h5['spectrum/mean'] = self.spectrum_mean
+                h5['spectrum/m2'] = self.spectrum_m2
+            if self.jx is not None:
+                h5['coherence/jx'] = self.jx
+                h5['coherence/jy'] = self.jy
+            h5['pulses/fname'] = np.array([p['fname'] for p in self.pulses], dtype='S')
+            for key in ['size', 'mtime'] + PULSE_KEYS:
+                h5['pulses/' + key] = np.array([p[key] for p in self.pulses], dtype='float64')
+            h5['skipped/fname'] = np.array(sorted(self.skipped), dtype='S')
+            h5['skipped/reason'] = np.array([self.skipped[f] for f in sorted(self.skipped)], dtype='S')
+        os.rename(tmp_fname, fname)
+
+    @classmethod
+    def load(cls, fname):
+        """
+        :param fname: state file written by save
+        :return: EnsembleStats
+        """
+        stats = cls()
+        with h5py.File(fname, 'r') as h5:
+            stats.count = int(h5.attrs['count'])
+            stats.spectrum_count = int(h5.attrs['spectrum_count'])
+            stats.coherence_count = int(h5.attrs['coherence_count'])
+            if 'mesh' in h5:
+                stats.mesh = dict((key, h5['mesh/' + key][()]) for key in MESH_KEYS)
+                stats.image_mean = h5['image/mean'][()]
+                stats.image_m2 = h5['image/m2'][()]
+            if 'spectrum' in h5:
+                stats.spectrum_energy = h5['spectrum/energy'][()]
+                stats.spectrum_mean = h5['spectrum/mean'][()]
+                stats.spectrum_m2 = h5['spectrum/m2'][()]
+            if 'coherence' in h5:
+                stats.jx = h5['coherence/jx'][()]
+                stats.jy = h5['coherence/jy'][()]
+            names = [n.decode() if isinstance(n, bytes) else n for n in h5['pulses/fname'][()]]
+            columns = dict((key, h5['pulses/' + key][()]) for key in ['size', 'mtime'] + PULSE_KEYS)
+            for i, name in enumerate(names):
+                pulse = {'fname': name}
+                pulse.update((key, float(columns[key][i])) for key in columns)
+                pulse['size'] = int(pulse['size'])
+                stats.pulses.append(pulse)
+            for name, reason in zip(h5['skipped/fname'][()], h5['skipped/reason'][()]):
+                stats.skipped[name.decode() if isinstance(name, bytes) else name] = \
+                    reason.decode() if isinstance(reason, bytes) else reason
+        return stats
+
+
+def process(fnames, stats, state_fname, cpu_number, chunk_slices=wf_metrics.DEFAULT_CHUNK_SLICES,
+            save_every=DEFAULT_SAVE_EVERY):
+    """
+    Reduce the files in parallel and merge them into the statistics, files already merged are skipped
+
+    :param fnames: prop_out files
+    :param stats: EnsembleStats, updated
+    :param state_fname: state file, saved every save_every pulses and at the end
+    :param cpu_number: number of processes
+    :param chunk_slices: number of slices read at once
+    :param save_every: number of merged pulses between saves of the state
+    :return: number of merged pulses
+    """
+    processed = stats.processed()
+    todo = []
+    for fname in fnames:
+        name = os.path.abspath(fname)
+        if name in processed:
+            if processed[name] != file_signature(fname):
+                print('Changed after it was merged, skipping: {}'.format(fname))
+            continue
+        if name not in stats.skipped:
+            todo.append(name)
+    if not todo:
+        return 0
+    merged = 0
+    pool = multiprocessing.Pool(min(cpu_number, len(todo)))
+    try:
+        for res in pool.imap_unordered(reduce_file, [(fname, chunk_slices) for fname in todo]):
+            if 'error' in res:
+                # not remembered, the file may be incomplete and is tried again by the next run
+                print('Failed {}:\n{}'.format(res['fname'], res['error']))
+                continue
+            reason = stats.incompatible(res)
+            if reason is not None:
+                stats.skipped[res['fname']] = reason
+                print('Skipped {}: {}'.format(res['fname'], reason))
+                continue
+            stats.add(res)
+            merged += 1
+            print('[{}] {}'.format(stats.count, res['fname']))
+            if merged % save_every == 0:
+                stats.save(state_fname)
+        pool.close()
+    except BaseException:  # join() of a running pool would raise and hide the error
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        stats.save(state_fname)
+    return merged
+
+
+def format_stats(stats, bins=DEFAULT_BINS):
+    """
+    :param stats: EnsembleStats
+    :param bins: number of histogram bins
+    :return: summary text with the histograms of pulse energy and FWHM
+    """
+    lines = ['{} pulses, {} skipped'.format(stats.count, len(stats.skipped))]
+    if not stats.count:
+        return '\n'.join(lines)
+    for key, scale, unit in [('pulse_energy', 1e3, 'mJ'), ('fwhm_x', 1e6, 'um'), ('fwhm_y', 1e6, 'um')]:
+        values = stats.values(key) * scale
+        lines.append('{}: mean {:.4g} {}, std {:.4g} {}'.format(key, values.mean(), unit, values.std(), unit))
+        counts, edges = np.histogram(values, bins)
+        for count, low, high in zip(counts, edges[:-1], edges[1:]):
+            lines.append('  {:>10.4g} - {:<10.4g} {:>6} {}'.format(low, high, count, '#' * int(
+                40 * count / max(counts.max(), 1))))
+    coherence = stats.coherence()
+    if coherence is not None:
+        lines.append('Degree of transverse coherence ({} pulses): x {:.3f}, y {:.3f}'.format(
+            stats.coherence_count, coherence['x'], coherence['y']))
+    return '\n'.join(lines)
+
+
+def show_stats(stats, bins=DEFAULT_BINS):
+    """
+    Plot mean and standard deviation of the integrated intensity, the mean spectrum and the histograms
+
+    :param stats: EnsembleStats
+    :param bins: number of histogram bins
+    """
+    import pylab as plt
+    mesh = stats.mesh
+    extent = [mesh['xMin'] * 1e6, mesh['xMax'] * 1e6, mesh['yMin'] * 1e6, mesh['yMax'] * 1e6]
+    for image, title in [(stats.image_mean, 'Mean integrated intensity'),
+                         (stats.image_std(), 'Standard deviation of the integrated intensity')]:
+        plt.figure()
+        plt.imshow(image, extent=extent)
+        plt.title('{} ({} pulses)'.format(title, stats.count))
+        plt.colorbar()
+        plt.xlabel(r'[$\mu$m]')
+    if stats.spectrum_mean is not None:
+        plt.figure()
+        plt.plot(stats.spectrum_energy, stats.spectrum_mean, label='mean')
+        plt.fill_between(stats.spectrum_energy, stats.spectrum_mean - stats.spectrum_std(),
+                         stats.spectrum_mean + stats.spectrum_std(), alpha=0.3, label='std')
+        plt.grid(True)
+        plt.title('Mean spectrum (x=y=0)')
+        plt.xlabel('[eV]')
+        plt.legend()
+    for key, scale, label in [('pulse_energy', 1e3, 'Pulse energy [mJ]'), ('fwhm_x', 1e6, r'FWHM x [$\mu$m]'),
+                              ('fwhm_y', 1e6, r'FWHM y [$\mu$m]')]:
+        plt.figure()
+        plt.hist(stats.values(key) * scale, bins)
+        plt.xlabel(label)
+        plt.ylabel('Pulses')
+    plt.show()
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--input-directory", dest="in_dname", help="Directory with prop_out*.h5 files")
+    parser.add_option("--state-file", dest="state_fname", default=None,
+                      help="File with the accumulated statistics, default INPUT_DIRECTORY/" + STATE_NAME)
+    parser.add_option("--restart", dest="restart", action="store_true", default=False,
+                      help="Start from scratch instead of continuing the state file")
+    parser.add_option("-n", "--cpu-number", dest="cpu_number", type="int",
+                      default=int((multiprocessing.cpu_count() + 1) / 2),
+                      help="Number of processes reading files, default value NUMBER_OF_CPU/2")
+    parser.add_option("--chunk-slices", dest="chunk_slices", type="int", default=wf_metrics.DEFAULT_CHUNK_SLICES,
+                      help="Number of slices read at once, limits memory usage")
+    parser.add_option("--save-every", dest="save_every", type="int", default=DEFAULT_SAVE_EVERY,
+                      help="Save the state file after this many pulses, default %default")
+    parser.add_option("--bins", dest="bins", type="int", default=DEFAULT_BINS,
+                      help="Number of histogram bins, default %default")
+    parser.add_option("--watch", dest="watch", action="store_true", default=False,
+                      help="Merge files as they are written by propagateSE.py, until the sentinel file appears "
+                           "or the timeout expires")
+    parser.add_option("--watch-interval", dest="watch_interval", type="float", default=watch.DEFAULT_POLL_INTERVAL,
+                      help="Time between scans of the directory [s], default %default")
+    parser.add_option("--watch-stable-time", dest="watch_stable_time", type="float",
+                      default=watch.DEFAULT_STABLE_TIME,
+                      help="Time without change of size and modification time of a complete file [s], "
+                           "default %default")
+    parser.add_option("--watch-sentinel", dest="watch_sentinel", default=None,
+                      help="Name of the file in the input directory, which signals the end of propagation")
+    parser.add_option("--watch-timeout", dest="watch_timeout", type="float", default=3600.,
+                      help="End watching if no new file was complete for this time [s], default %default")
+    parser.add_option("--plot", dest="plot", action="store_true", default=False,
+                      help="Show mean and standard deviation images, mean spectrum and histograms")
+    (options, args) = parser.parse_args()
+    if not options.in_dname:
+        parser.error('Input directory not specified, use --input-directory option')
+
+    state_fname = options.state_fname or os.path.join(options.in_dname, STATE_NAME)
+    if os.path.exists(state_fname) and not options.restart:
+        stats = EnsembleStats.load(state_fname)
+        print('Continuing {} with {} pulses'.format(state_fname, stats.count))
+    else:
+        stats = EnsembleStats()
+
+    if options.watch:
+        watcher = watch.DirectoryWatcher(options.in_dname, 'prop_out*.h5', options.watch_interval,
+                                         options.watch_stable_time, options.watch_sentinel, options.watch_timeout)
+        while not watcher.finished():
+            fnames = watcher.poll()
+            if fnames:
+                process(fnames, stats, state_fname, options.cpu_number, options.chunk_slices, options.save_every)
+            else:
+                time.sleep(1.)
+    else:
+        process(glob(os.path.join(options.in_dname, 'prop_out*.h5')), stats, state_fname, options.cpu_number,
+                options.chunk_slices, options.save_every)
+
+    print(format_stats(stats, options.bins))
+    if options.plot and stats.count:
+        show_stats(stats, options.bins)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+NumPy/FFT propagation engine, an alternative to SRW for drifts, apertures, lenses,
+elliptical mirrors (as thin lenses) and WF_dist phase screens.
+
+All frequency slices and both polarizations are propagated at once as one
+array [slices, ny, nx] in single precision. Drifts, resizing and lenses act on
+x and y separately with the operators of the separable engine (see separable),
+which follow the Use_PP semantics: the mesh range (zoom) and resolution
+(sampling) are changed before the element, drifts with
+semi_analytical_treatment=1 keep the quadratic phase of the wavefront
+analytically. Non-rectangular apertures and obstacles, and WF_dist
+transmission grids are applied as 2D masks and phase screens. FFTs use several
+threads with scipy.fft, see separable.set_fft_threads.
+
+propagate() works on a WPG wavefront in frequency domain and stores the result
+back into its SRW structure, so the rest of propagateSE (back to time domain,
+diagnostics, storing) is unchanged. The field is converted once, the SRW
+buffers are released meanwhile to keep the peak memory at about two copies of
+the field.
+"""
+import time
+from array import array
+
+import numpy as np
+
+import beamline_cost
+import separable
+
+# slices multiplied by a transmission grid at once
+TRANSMISSION_CHUNK_SLICES = 16
+
+
+class Field2D(object):
+    """
+    Field [slices, ny, nx] with the meshes and the analytic curvature of both axes
+    """
+
+    def __init__(self, w, xmin, xmax, ymin, ymax, wavelengths):
+        """
+        :param w: complex array [slices, ny, nx]
+        :param xmin: first horizontal point of the mesh [m]
+        :param xmax: last horizontal point of the mesh [m]
+        :param ymin: first vertical point of the mesh [m]
+        :param ymax: last vertical point of the mesh [m]
+        :param wavelengths: wavelength of every slice [m]
+        """
+        self.w = w
+        self.axes = {'x': separable.Field1D(None, xmin, xmax, wavelengths),
+                     'y': separable.Field1D(None, ymin, ymax, wavelengths)}
+
+    def along(self, axis, func, *args):
+        """
+        Apply a separable operator to the field along an axis
+
+        :param axis: 'x' or 'y'
+        :param func: function of Field1D and args, e.g. separable.apply_operation
+        """
+        f = self.axes[axis]
+        f.w = self.w if axis == 'x' else self.w.swapaxes(1, 2)
+        try:
+            func(f, *args)
+            self.w = f.w if axis == 'x' else f.w.swapaxes(1, 2)
+        finally:
+            f.w = None
+
+    def coords(self):
+        """
+        :return: (x, y) coordinates of the mesh
+        """
+        ny, nx = self.w.shape[1:]
+        return (np.linspace(self.axes['x'].xmin, self.axes['x'].xmax, nx),
+                np.linspace(self.axes['y'].xmin, self.axes['y'].xmax, ny))
+
+
+def apply_mask(field, desc):
+    """
+    Apply a rectangular or elliptical (shape 'c') aperture ('a') or obstacle ('o')
+
+    :param field: Field2D
+    :param desc: aperture from separable.describe_element
+    """
+    x, y = field.coords()
+    dx = (x[None, :] - desc['x']) / (desc['Dx'] / 2.)
+    dy = (y[:, None] - desc['y']) / (desc['Dy'] / 2.)
+    if desc['shape'] == 'r':
+        inside = (np.abs(dx) <= 1) & (np.abs(dy) <= 1)
+    else:
+        inside = dx**2 + dy**2 <= 1
+    field.w[:, ~inside if desc['ap_or_ob'] == 'a' else inside] = 0
+
+
+def _interp_grid(xs, ys, values, x, y):
+    # bilinear interpolation of values [len(ys), len(xs)] on the mesh (y, x), constant outside
+    x = np.clip(x, xs[0], xs[-1])
+    y = np.clip(y, ys[0], ys[-1])
+    res = separable.interp_rows(xs, values, x)
+    return separable.interp_rows(ys, res.T, y).T
+
+
+def apply_transmission(field, desc):
+    """
+    Apply a transmission grid (WF_dist): amplitude and phase screen exp(i k opd)
+
+    :param field: Field2D
+    :param desc: transmission from separable.describe_element
+    """
+    x, y = field.coords()
+    amplitude = _interp_grid(desc['x'], desc['y'], desc['amplitude'], x, y)
+    opd = _interp_grid(desc['x'], desc['y'], desc['opd'], x, y)
+    if desc['outside_zero']:
+        amplitude[:, (x < desc['x'][0]) | (x > desc['x'][-1])] = 0
+        amplitude[(y < desc['y'][0]) | (y > desc['y'][-1]), :] = 0
+    wave_numbers = 2 * np.pi / field.axes['x'].wavelengths
+    for i0 in range(0, field.w.shape[0], TRANSMISSION_CHUNK_SLICES):
+        i1 = min(i0 + TRANSMISSION_CHUNK_SLICES, field.w.shape[0])
+        screen = amplitude * np.exp(1j * wave_numbers[i0:i1, None, None] * opd)
+        field.w[i0:i1] *= screen.astype(field.w.dtype)
+
+
+def propagate_field(field, bl):
+    """
+    Propagate the field through the beamline
+
+    :param field: Field2D
+    :param bl: Beamline
+    :raise separable.UnsupportedElement: for elements other than drift, aperture, lens, elliptical mirror
+        and transmission
+    """
+    for oe, pp in beamline_cost.iter_elements(bl):
+        desc = separable.describe_element(oe)
+        f = beamline_cost.pp_factors(pp)
+        field.along('x', separable.resize, f['zoom_h'], f['sampling_h'])
+        field.along('y', separable.resize, f['zoom_v'], f['sampling_v'])
+        if desc['type'] == 'transmission':
+            apply_transmission(field, desc)
+        elif desc['type'] == 'aperture' and (desc['shape'], desc['ap_or_ob']) != ('r', 'a'):
+            apply_mask(field, desc)
+        else:
+            ops_x, ops_y = separable.axis_operations(desc)
+            for op in ops_x:
+                field.along('x', separable.apply_operation, op, f['semi_analytical_treatment'])
+            for op in ops_y:
+                field.along('y', separable.apply_operation, op, f['semi_analytical_treatment'])
+
+
+def _field_view(arr, mesh):
+    # SRW field [y][x][slice][re, im] float32 as complex64 [y, x, slice]
+    return np.frombuffer(arr, dtype=np.float32).view(np.complex64).reshape(mesh.ny, mesh.nx, mesh.ne)
+
+
+def propagate(wfr, bl, threads=None):
+    """
+    Propagate WPG wavefront in frequency domain through the beamline in place
+
+    :param wfr: wavefront in frequency domain
+    :param bl: Beamline
+    :param threads: number of FFT threads, default see separable.set_fft_threads
+    :return: dict with wall_time, nx, ny, nSlices
+    """
+    t0 = time.time()
+    if threads is not None:
+        separable.set_fft_threads(threads)
+    # fail before the field is converted
+    for oe, pp in beamline_cost.iter_elements(bl):
+        separable.describe_element(oe)
+
+    srwl_wf = wfr._srwl_wf
+    mesh = srwl_wf.mesh
+    ne = mesh.ne
+    wavelengths = separable.HC_EV_M / np.linspace(mesh.eStart, mesh.eFin, ne)
+    # both polarizations are propagated together, as slices of one field
+    w = np.empty((2 * ne, mesh.ny, mesh.nx), dtype=np.complex64)
+    w[:ne] = _field_view(srwl_wf.arEx, mesh).transpose(2, 0, 1)
+    w[ne:] = _field_view(srwl_wf.arEy, mesh).transpose(2, 0, 1)
+    srwl_wf.arEx, srwl_wf.arEy = array('f'), array('f')
+    field = Field2D(w, mesh.xStart, mesh.xFin, mesh.yStart, mesh.yFin, np.concatenate([wavelengths, wavelengths]))
+
+    propagate_field(field, bl)
+
+    radius = {}
+    for axis in ['x', 'y']:
+        inv_r = field.axes[axis].inv_r
+        radius[axis] = 1. / inv_r if inv_r != 0 else 1e23
+        field.along(axis, separable.apply_curvature)
+    ny, nx = field.w.shape[1:]
+    x, y = field.coords()
+    srwl_wf.allocate(ne, nx, ny)
+    mesh = srwl_wf.mesh
+    mesh.xStart, mesh.xFin, mesh.yStart, mesh.yFin = x[0], x[-1], y[0], y[-1]
+    srwl_wf.Rx, srwl_wf.Ry = radius['x'], radius['y']
+    _field_view(srwl_wf.arEx, mesh)[:] = field.w[:ne].transpose(1, 2, 0)
+    _field_view(srwl_wf.arEy, mesh)[:] = field.w[ne:].transpose(1, 2, 0)
+    return {'wall_time': time.time() - t0, 'nx': nx, 'ny': ny, 'nSlices': ne}
@@ -0,0 +1,271 @@
+"""
+Chunked and compressed HDF5 layout of the wavefront field.
+
+Wavefront.store_hdf5 writes the field uncompressed and contiguous. For the full
+level store() writes the wavefront with WPG to a scratch file on the local disk first and then
+copies it to the output file with the field datasets (/data/arrEhor,
+/data/arrEver) chunked along slices, so that reading a range of slices touches
+whole chunks, and optionally compressed. Only the compressed file
+goes to the (shared) output filesystem.
+
+Output levels:
+
+    full       the complex field of both polarizations, /data/arrEhor and /data/arrEver
+    intensity  total intensity cube [ny, nx, nSlices], /data/intensity
+    summary    integrated intensity [ny, nx], /data/integrated_intensity, and power per slice,
+               /misc/power, only
+
+Reduced levels are float32 and keep /params, /misc and /history of the full file.
+They are calculated from the field in memory, the full field is not written.
+
+Layout options (dict, see DEFAULT_LAYOUT):
+
+    compression        None, 'gzip', 'lzf' or 'blosc' (needs the hdf5plugin package)
+    compression_level  gzip level 0-9 or blosc clevel
+    shuffle            byte shuffle filter before compression
+    chunk_slices       slices per chunk, None for chunks of about CHUNK_BYTES
+
+The field of WPG is float32 already, it is stored as it is.
+"""
+import os
+import tempfile
+from array import array
+
+import h5py
+import numpy as np
+
+import wf_metrics
+
+FIELD_DATASETS = ['arrEhor', 'arrEver']
+OUTPUT_LEVELS = ['full', 'intensity', 'summary']
+CHUNK_BYTES = 4 * 2**20
+# the field is read and written in blocks of about this size
+COPY_BYTES = 256 * 2**20
+
+DEFAULT_LAYOUT = {'compression': None,
+                  'compression_level': 4,
+                  'shuffle': True,
+                  'chunk_slices': None}
+
+
+def is_default(layout):
+    """
+    Check if the layout is the plain one of Wavefront.store_hdf5
+
+    :param layout: layout options
+    :return: True if no chunking or compression is requested
+    """
+    layout = dict(DEFAULT_LAYOUT, **layout)
+    return layout['compression'] is None and layout['chunk_slices'] is None
+
+
+def filter_options(layout):
+    """
+    Keyword arguments of h5py create_dataset for the compression filters
+
+    :param layout: layout options
+    :return: dict
+    """
+    layout = dict(DEFAULT_LAYOUT, **layout)
+    compression = layout['compression']
+    if compression is None:
+        return {}
+    if compression == 'blosc':
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ValueError('blosc compression requires the hdf5plugin package')
+        shuffle = hdf5plugin.Blosc.SHUFFLE if layout['shuffle'] else hdf5plugin.Blosc.NOSHUFFLE
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=layout['compression_level'], shuffle=shuffle))
+    options = {'compression': compression, 'shuffle': layout['shuffle']}
+    if compression == 'gzip':
+        options['compression_opts'] = layout['compression_level']
+    return options
+
+
+def chunk_shape(shape, itemsize, chunk_slices=None):
+    """
+    Chunk shape of a field [ny, nx, nSlices, 2] or intensity [ny, nx, nSlices] dataset:
+    whole slices, CHUNK_BYTES per chunk by default
+
+    :param shape: dataset shape
+    :param itemsize: size of an element in bytes
+    :param chunk_slices: number of slices per chunk
+    :return: chunk shape
+    """
+    ny, nx, n_slices = shape[:3]
+    slice_bytes = ny * nx * int(np.prod(shape[3:])) * itemsize
+    if chunk_slices is None:
+        chunk_slices = CHUNK_BYTES // max(slice_bytes, 1)
+    chunk_slices = int(min(max(chunk_slices, 1), n_slices))
+    return (ny, nx, chunk_slices) + tuple(shape[3:])
+
+
+def write_field(group, name, source, layout):
+    """
+    Write a field dataset with the layout, copying the source block by block along slices
+
+    :param group: h5py group to write to
+    :param name: dataset name
+    :param source: array-like [ny, nx, nSlices, 2], numpy array or h5py dataset
+    :param layout: layout options
+    :return: h5py dataset
+    """
+    layout = dict(DEFAULT_LAYOUT, **layout)
+    dtype = np.dtype(source.dtype)
+    chunks = chunk_shape(source.shape, dtype.itemsize, layout['chunk_slices'])
+    dset = group.create_dataset(name, shape=source.shape, dtype=dtype, chunks=chunks,
+                                **filter_options(layout))
+    ny, nx, n_slices, n_re_im = source.shape
+    # whole chunks per block, so every chunk is compressed once
+    block = max(COPY_BYTES // max(ny * nx * n_re_im * dtype.itemsize * chunks[2], 1), 1) * chunks[2]
+    for i0 in range(0, n_slices, block):
+        i1 = min(i0 + block, n_slices)
+        dset[:, :, i0:i1, :] = np.asarray(source[:, :, i0:i1, :], dtype=dtype)
+    return dset
+
+
+def write_intensity(group, name, ehor, ever, layout):
+    """
+    Write total intensity cube of the field, calculated block by block along slices
+
+    :param group: h5py group to write to
+    :param name: dataset name
+    :param ehor: horizontal polarization field [ny, nx, nSlices, 2], numpy array or h5py dataset
+    :param ever: vertical polarization field [ny, nx, nSlices, 2], numpy array or h5py dataset
+    :param layout: layout options
+    :return: h5py dataset
+    """
+    layout = dict(DEFAULT_LAYOUT, **layout)
+    shape = ehor.shape[:3]
+    chunks = chunk_shape(shape, 4, layout['chunk_slices'])
+    dset = group.create_dataset(name, shape=shape, dtype='float32', chunks=chunks, **filter_options(layout))
+    block = max(COPY_BYTES // max(shape[0] * shape[1] * 4 * chunks[2], 1), 1) * chunks[2]
+    for i0 in range(0, shape[2], block):
+        i1 = min(i0 + block, shape[2])
+        intens = wf_metrics.intensity(np.asarray(ehor[:, :, i0:i1, :], dtype='float32'))
+        intens += wf_metrics.intensity(np.asarray(ever[:, :, i0:i1, :], dtype='float32'))
+        dset[:, :, i0:i1] = intens
+    return dset
+
+
+def write_summary(dst, ehor, ever):
+    """
+    Write integrated intensity and power per slice of the field
+
+    :param dst: h5py file to write to
+    :param ehor: horizontal polarization field [ny, nx, nSlices, 2], numpy array or h5py dataset
+    :param ever: vertical polarization field [ny, nx, nSlices, 2], numpy array or h5py dataset
+    """
+    ny, nx, n_slices = ehor.shape[:3]
+    metrics = wf_metrics.FieldMetrics(nx, ny, n_slices)
+    for i0 in range(0, n_slices, wf_metrics.DEFAULT_CHUNK_SLICES):
+        i1 = min(i0 + wf_metrics.DEFAULT_CHUNK_SLICES, n_slices)
+        metrics.add(ehor[:, :, i0:i1, :], ever[:, :, i0:i1, :], i0)
+    dst['data/integrated_intensity'] = metrics.image_total.astype('float32')
+    dst['misc/power'] = metrics.power_total.astype('float32')
+
+
+def copy_file(src_fname, dst_fname, layout, level='full'):
+    """
+    Copy wavefront file with the field datasets rewritten in the layout or reduced to the output level
+
+    :param src_fname: wavefront file written by Wavefront.store_hdf5
+    :param dst_fname: output file
+    :param layout: layout options
+    :param level: output level, one of OUTPUT_LEVELS
+    """
+    with h5py.File(src_fname, 'r') as src:
+        with h5py.File(dst_fname, 'w') as dst:
+            for key, value in src.attrs.items():
+                dst.attrs[key] = value
+            for key in src:
+                if key != 'data':
+                    src.copy(key, dst)
+                    continue
+                data = dst.create_group('data')
+                for key_data, value in src['data'].attrs.items():
+                    data.attrs[key_data] = value
+                data.attrs['output_level'] = level
+                for name in src['data']:
+                    if name in FIELD_DATASETS and level != 'full':
+                        continue
+                    if name in FIELD_DATASETS:
+                        dset = write_field(data, name, src['data'][name], layout)
+                        for key_attr, value in src['data'][name].attrs.items():
+                            dset.attrs[key_attr] = value
+                    else:
+                        src['data'].copy(name, data)
+            # after the copy of /misc, the summary adds to it
+            if level == 'intensity':
+                write_intensity(dst['data'], 'intensity', src['data/arrEhor'], src['data/arrEver'], layout)
+            elif level == 'summary':
+                write_summary(dst, src['data/arrEhor'], src['data/arrEver'])
+
+
+def store_reduced(wf, fname, layout, level):
+    """
+    Store wavefront with the field reduced to the output level, calculated from the field in memory.
+    WPG writes the groups besides the field with a one point field standing in for the field, the field
+    datasets are then replaced by the intensity or the summary, so the full field is never written.
+
+    :param wf: wavefront
+    :param fname: output file
+    :param layout: layout options
+    :param level: 'intensity' or 'summary'
+    """
+    srwl_wf = wf._srwl_wf
+    mesh = srwl_wf.mesh
+    saved = srwl_wf.arEx, srwl_wf.arEy, mesh.nx, mesh.ny, mesh.ne
+    shape = (mesh.ny, mesh.nx, mesh.ne, 2)
+    ehor = np.frombuffer(srwl_wf.arEx, dtype=np.float32).reshape(shape)
+    ever = np.frombuffer(srwl_wf.arEy, dtype=np.float32).reshape(shape)
+    srwl_wf.arEx, srwl_wf.arEy = array('f', [0., 0.]), array('f', [0., 0.])
+    mesh.nx = mesh.ny = mesh.ne = 1
+    try:
+        wf.store_hdf5(fname)
+    finally:
+        srwl_wf.arEx, srwl_wf.arEy, mesh.nx, mesh.ny, mesh.ne = saved
+    with h5py.File(fname, 'a') as h5:
+        for key, value in [('nx', shape[1]), ('ny', shape[0]), ('nSlices', shape[2])]:
+            path = 'params/Mesh/' + key
+            dset = h5[path]
+            dtype, attrs = dset.dtype, dict(dset.attrs.items())
+            del h5[path]
+            h5[path] = np.array(value, dtype=dtype)
+            for key_attr, value_attr in attrs.items():
+                h5[path].attrs[key_attr] = value_attr
+        data = h5['data']
+        for name in FIELD_DATASETS:
+            if name in data:
+                del data[name]
+        data.attrs['output_level'] = level
+        if level == 'intensity':
+            write_intensity(data, 'intensity', ehor, ever, layout)
+        else:
+            write_summary(h5, ehor, ever)
+
+
+def store(wf, fname, layout, level='full'):
+    """
+    Store wavefront with the layout
+
+    :param wf: wavefront
+    :param fname: output file
+    :param layout: layout options
+    :param level: output level, one of OUTPUT_LEVELS
+    """
+    if level != 'full':
+        store_reduced(wf, fname, layout, level)
+        return
+    if is_default(layout):
+        wf.store_hdf5(fname)
+        return
+    # scratch on the local disk, TMPDIR can point to a node-local directory
+    fd, scratch_fname = tempfile.mkstemp(suffix='.h5')
+    os.close(fd)
+    try:
+        wf.store_hdf5(scratch_fname)
+        copy_file(scratch_fname, fname, layout, level)
+    finally:
+        os.remove(scratch_fname)
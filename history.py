@@ -0,0 +1,119 @@
+"""
+Reference-based wavefront history.
+
+add_history in propagateSE copies all metadata of the parent file (and its whole
+history chain) into /history/parent of the output, so every S2E stage duplicates
+the upstream metadata again. add_history_linked attaches the same layout with
+HDF5 external links instead:
+
+    /history/parent/detail  -> parent file, /
+    /history/parent/parent  -> parent file, /history/parent
+
+so paths like history/parent/parent/misc/temporal_struct are resolved by HDF5
+itself, in constant time and space per stage. A small provenance index
+(/history/parent/provenance attributes: parent path, checksum, stage name, time)
+records where the parent was. If the links are broken because files were moved,
+read() follows the provenance index instead.
+"""
+import os
+import hashlib
+import time
+
+import h5py
+
+PROVENANCE = 'history/parent/provenance'
+QUICK_CHECKSUM_BLOCK = 2**20
+
+
+def quick_checksum(fname):
+    """
+    Checksum of the file size and modification time, the first and the last MB of the file.
+    Cheap for multi-GB wavefront files, but detects a replaced or truncated parent.
+
+    :param fname: file name
+    :return: hex digest
+    """
+    st = os.stat(fname)
+    sha = hashlib.sha1(repr((st.st_size, st.st_mtime)).encode('ascii'))
+    with open(fname, 'rb') as f:
+        sha.update(f.read(QUICK_CHECKSUM_BLOCK))
+        if st.st_size > QUICK_CHECKSUM_BLOCK:
+            f.seek(-QUICK_CHECKSUM_BLOCK, os.SEEK_END)
+            sha.update(f.read(QUICK_CHECKSUM_BLOCK))
+    return sha.hexdigest()
+
+
+def add_history_linked(wf_file_name, history_file_name, stage_name='prop'):
+    """
+    Add history from parent file to propagated file using external links and a provenance index
+
+    :param wf_file_name: output file
+    :param history_file_name: parent file
+    :param stage_name: name of the simulation stage, which produced the output file
+    """
+    # HDF5 looks for relative link targets in the directory of the linking file
+    parent_relpath = os.path.relpath(os.path.abspath(history_file_name),
+                                     os.path.dirname(os.path.abspath(wf_file_name)))
+    with h5py.File(history_file_name, 'r') as history_h5:
+        parent_has_history = 'history/parent' in history_h5
+
+    with h5py.File(wf_file_name, 'a') as wf_h5:
+        if 'history' in wf_h5:
+            del wf_h5['history']
+        parent = wf_h5.create_group('/history/parent')
+        parent['detail'] = h5py.ExternalLink(parent_relpath, '/')
+        if parent_has_history:
+            parent['parent'] = h5py.ExternalLink(parent_relpath, '/history/parent')
+
+        provenance = wf_h5.create_group(PROVENANCE)
+        provenance.attrs['parent'] = os.path.abspath(history_file_name)
+        provenance.attrs['parent_relpath'] = parent_relpath
+        provenance.attrs['checksum'] = quick_checksum(history_file_name)
+        provenance.attrs['stage'] = stage_name
+        provenance.attrs['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def parent_file(fname):
+    """
+    Find the parent file using the provenance index
+
+    :param fname: wavefront file with linked history
+    :return: parent file name, or None if the file has no provenance index or the parent is not found
+    """
+    with h5py.File(fname, 'r') as h5:
+        if PROVENANCE not in h5:
+            return None
+        attrs = h5[PROVENANCE].attrs
+        candidates = [os.path.join(os.path.dirname(os.path.abspath(fname)), attrs['parent_relpath']),
+                      attrs['parent']]
+    for candidate in candidates:
+        if not isinstance(candidate, str):
+            candidate = candidate.decode('utf-8')
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def read(fname, path):
+    """
+    Read a dataset from the wavefront file, following its history transparently.
+    Works for copied and linked history, and for linked history of moved files.
+
+    :param fname: wavefront file
+    :param path: dataset path, e.g. 'history/parent/parent/misc/temporal_struct'
+    :return: dataset content
+    """
+    path = path.strip('/')
+    with h5py.File(fname, 'r') as h5:
+        try:
+            return h5[path][()]
+        except KeyError:
+            pass
+
+    for prefix, parent_prefix in [('history/parent/detail/', ''),
+                                  ('history/parent/parent/', 'history/parent/')]:
+        if path.startswith(prefix):
+            parent = parent_file(fname)
+            if parent is not None:
+                return read(parent, parent_prefix + path[len(prefix):])
+    raise KeyError('{} not found in {} or its history'.format(path, fname))
@@ -0,0 +1,151 @@
+"""
+Completion manifest for batch propagation.
+
+The manifest is a JSON-lines file in the output directory with one record per
+finished pulse. A rerun of the batch skips pulses whose record matches the
+current input file, the current beamline and settings (see beamline_hash) and
+the size and modification time of the output file on disk (or its checksum with
+verify, records without a checksum do not count then), so only missing, stale or
+corrupted outputs are recomputed.
+
+Nodes sharing an output directory (see work_queue) append to their own
+prop_manifest.<node>.jsonl files, all manifest files are read.
+"""
+import os
+import json
+import hashlib
+from glob import glob
+
+MANIFEST_NAME = 'prop_manifest.jsonl'
+
+
+def file_checksum(fname, block_size=2**22):
+    """
+    Calculate SHA1 checksum of the file content
+
+    :param fname: file name
+    :param block_size: size of the block read at once
+    :return: hex digest
+    """
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def beamline_hash(bl, settings=None):
+    """
+    Calculate hash of the beamline: printout of all elements and propagation parameters
+    plus the transmission grids of WF_dist-like elements, which are not printed
+
+    :param bl: Beamline
+    :param settings: JSON serializable dict of other settings changing the output, e.g. the propagation engine
+        and the output options
+    :return: hex digest
+    """
+    sha = hashlib.sha1(str(bl).encode('utf-8'))
+    if settings:
+        sha.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+    for propagation_option in bl.propagation_options:
+        for oe in propagation_option['optical_elements']:
+            arTr = getattr(oe, 'arTr', None)
+            if arTr is not None:
+                to_bytes = getattr(arTr, 'tobytes', None) or arTr.tostring  # array.array in python 2
+                sha.update(to_bytes())
+    return sha.hexdigest()
+
+
+def make_record(in_fname, out_fname, bl_hash, out_checksum, wall_time):
+    """
+    Build a manifest record for a finished pulse
+
+    :param in_fname: input wavefront file
+    :param out_fname: output wavefront file
+    :param bl_hash: beamline hash, see beamline_hash
+    :param out_checksum: checksum of the output file (see file_checksum), None if not calculated
+    :param wall_time: propagation wall time [s]
+    :return: dict
+    """
+    st = os.stat(in_fname)
+    out_st = os.stat(out_fname)
+    return {'in_fname': os.path.abspath(in_fname),
+            'in_size': st.st_size,
+            'in_mtime': st.st_mtime,
+            'beamline_hash': bl_hash,
+            'out_fname': os.path.abspath(out_fname),
+            'out_size': out_st.st_size,
+            'out_mtime': out_st.st_mtime,
+            'out_checksum': out_checksum,
+            'wall_time': wall_time}
+
+
+class Manifest(object):
+    """
+    Completion manifest of an output directory
+    """
+
+    def __init__(self, out_dname, name=MANIFEST_NAME):
+        """
+        :param out_dname: output directory name
+        :param name: name of the manifest file appended by this process
+        """
+        self.out_dname = out_dname
+        self.fname = os.path.join(out_dname, name)
+        self.reload()
+
+    def reload(self):
+        """
+        Read the records of all manifest files of the output directory
+        """
+        self.records = {}
+        base, ext = os.path.splitext(MANIFEST_NAME)
+        for fname in sorted(glob(os.path.join(self.out_dname, base + '*' + ext))):
+            with open(fname) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:  # truncated line of a killed run
+                        continue
+                    self.records[record['out_fname']] = record
+
+    def is_done(self, in_fname, out_fname, bl_hash, verify=False):
+        """
+        Check if the pulse is already propagated with the same input and beamline
+
+        :param in_fname: input wavefront file
+        :param out_fname: output wavefront file
+        :param bl_hash: beamline hash, see beamline_hash
+        :param verify: compare the checksum of the output file with the recorded one instead of its size
+            and modification time, a record without a checksum is not done
+        :return: True if the output is up to date
+        """
+        record = self.records.get(os.path.abspath(out_fname))
+        if record is None or not os.path.exists(out_fname):
+            return False
+        st = os.stat(in_fname)
+        if (record['in_fname'] != os.path.abspath(in_fname) or
+                record['in_size'] != st.st_size or
+                record['in_mtime'] != st.st_mtime or
+                record['beamline_hash'] != bl_hash):
+            return False
+        # records of older versions have only the checksum
+        if 'out_size' not in record or verify:
+            return record['out_checksum'] is not None and record['out_checksum'] == file_checksum(out_fname)
+        out_st = os.stat(out_fname)
+        return record['out_size'] == out_st.st_size and record['out_mtime'] == out_st.st_mtime
+
+    def add(self, record):
+        """
+        Append a record to the manifest file
+
+        :param record: dict from make_record
+        """
+        self.records[record['out_fname']] = record
+        with open(self.fname, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
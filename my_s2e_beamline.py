@@ -4,6 +4,8 @@ from wpg import Wavefront
 import wpg.optical_elements
 from wpg.optical_elements import Use_PP
 
+import opd_cache
+
 #mirror_data_dir = '/data/S2E/modules/prop/data_common'
 mirror_data_dir = 'data_common'
 
@@ -19,11 +21,18 @@ def defineOPD(opTrErMirr, mdatafile, ncol, delim, orient, theta, scale=1., stret
     :param theta: mirror incidence angle
     :param scale: scaling factor for the mirror profile height errors
     :param stretching: scaling factor for the mirror profile x-axis (a hack, should be removed ASAP) 
+
+    The resulting transmission grid is cached on disk, see opd_cache.
     """
 
+    key = opd_cache.make_key(opTrErMirr, mdatafile, orient, theta, scale, stretching)
+    if opd_cache.load(key, opTrErMirr):
+        return
+
     heightProfData = np.loadtxt(mdatafile).T
     heightProfData[0,:] = heightProfData[0,:] * stretching
     wpg.useful_code.srwutils.AuxTransmAddSurfHeightProfileScaled(opTrErMirr, heightProfData, orient, theta, scale)
+    opd_cache.store(key, opTrErMirr)
     # if isIpynb:
     #     pylab.figure(); pylab.plot(heightProfData[0],heightProfData[ncol-1]*1e9)
     #     pylab.title('profile from %s' %mdatafile);pylab.xlabel('x (m)');pylab.ylabel('h (nm)')
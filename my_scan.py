@@ -0,0 +1,19 @@
+def get_beamlines():
+    """
+    This function will called in propagation script with --scan-file option.
+    Scan of the focus position: the last drift of my_s2e_beamline is varied, the upstream
+    beamline is the same for all variants and is propagated only once.
+    
+    :return: list of (name, Beamline).
+    """
+
+    import my_s2e_beamline
+
+    variants = []
+    for dz in [-2.e-3, -1.e-3, 0., 1.e-3, 2.e-3]:
+        bl0 = my_s2e_beamline.get_beamline()
+        drift_to_foc = bl0.propagation_options[-1]['optical_elements'][-1]
+        drift_to_foc.L += dz
+        variants.append(('dz_{:+.1f}mm'.format(dz*1e3), bl0))
+
+    return variants
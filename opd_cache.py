@@ -0,0 +1,178 @@
+"""
+Persistent on-disk cache for the transmission grids (arTr) of WF_dist elements
+built from mirror height profiles.
+
+A grid is keyed on the content of the profile file and on all parameters used
+to build it, so a changed profile or a changed beamline never hits a stale
+entry. Grids are stored as .npy files and copied into the array('d') of the
+element when loaded. The total size of the cache is limited, least recently
+used entries are evicted first.
+
+Configuration through environment variables:
+
+    PROP_OPD_CACHE_DIR     cache directory, empty string disables the cache
+                           (default ~/.cache/prop/opd)
+    PROP_OPD_CACHE_MAX_MB  size limit of the cache in MB (default 1024)
+"""
+import os
+import errno
+import hashlib
+from array import array
+
+import numpy as np
+
+CACHE_VERSION = 1
+CACHE_DIR = os.environ.get('PROP_OPD_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'prop', 'opd'))
+MAX_CACHE_BYTES = int(float(os.environ.get('PROP_OPD_CACHE_MAX_MB', 1024)) * 2**20)
+
+
+def file_digest(fname, block_size=2**20):
+    """
+    Calculate SHA1 digest of the file content
+
+    :param fname: file name
+    :param block_size: size of the block read at once
+    :return: hex digest
+    """
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def make_key(opTrErMirr, mdatafile, orient, theta, scale, stretching):
+    """
+    Build the cache key for a transmission grid
+
+    :param opTrErMirr: WF_dist element (only its mesh is used)
+    :param mdatafile: an ascii file with mirror profile data
+    :param orient: mirror orientation, 'x' (horizontal) or 'y' (vertical)
+    :param theta: mirror incidence angle
+    :param scale: scaling factor for the mirror profile height errors
+    :param stretching: scaling factor for the mirror profile x-axis
+    :return: hex string
+    """
+    mesh = opTrErMirr.mesh
+    params = (CACHE_VERSION, file_digest(mdatafile),
+              mesh.nx, mesh.ny, mesh.xStart, mesh.xFin, mesh.yStart, mesh.yFin,
+              orient, theta, scale, stretching)
+    return hashlib.sha1(repr(params).encode('ascii')).hexdigest()
+
+
+def _entry_name(key, cache_dir):
+    return os.path.join(cache_dir, key + '.npy')
+
+
+def load(key, opTrErMirr, cache_dir=None):
+    """
+    Fill opTrErMirr.arTr from the cache
+
+    :param key: cache key from make_key
+    :param opTrErMirr: WF_dist element to be filled
+    :param cache_dir: cache directory, default CACHE_DIR
+    :return: True if the grid was found in the cache
+    """
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    if not cache_dir:
+        return False
+    fname = _entry_name(key, cache_dir)
+    try:
+        data = np.load(fname)
+    except (IOError, OSError, ValueError):
+        return False
+    if data.dtype != np.float64 or data.size != len(opTrErMirr.arTr):
+        return False
+
+    arTr = array('d')
+    if hasattr(arTr, 'frombytes'):
+        arTr.frombytes(data.tobytes())
+    else:
+        arTr.fromstring(data.tostring())
+    opTrErMirr.arTr = arTr
+
+    try:
+        os.utime(fname, None)  # mark as recently used
+    except OSError:
+        pass
+    return True
+
+
+def store(key, opTrErMirr, cache_dir=None, max_bytes=None):
+    """
+    Store opTrErMirr.arTr in the cache and evict old entries if the cache is too big
+
+    :param key: cache key from make_key
+    :param opTrErMirr: WF_dist element with the grid already defined
+    :param cache_dir: cache directory, default CACHE_DIR
+    :param max_bytes: size limit of the cache, default MAX_CACHE_BYTES
+    """
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    max_bytes = MAX_CACHE_BYTES if max_bytes is None else max_bytes
+    if not cache_dir:
+        return
+    try:
+        os.makedirs(cache_dir)
+    except OSError as exc:
+        if not (exc.errno == errno.EEXIST and os.path.isdir(cache_dir)):
+            return
+
+    fname = _entry_name(key, cache_dir)
+    tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+    try:
+        with open(tmp_fname, 'wb') as f:
+            np.save(f, np.frombuffer(opTrErMirr.arTr, dtype=np.float64))
+        os.rename(tmp_fname, fname)  # atomic, concurrent workers may store the same key
+    except (IOError, OSError):
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        return
+
+    evict(cache_dir, max_bytes)
+
+
+def evict(cache_dir=None, max_bytes=None, suffix='.npy'):
+    """
+    Remove least recently used entries until the cache fits in max_bytes
+
+    :param cache_dir: cache directory, default CACHE_DIR
+    :param max_bytes: size limit of the cache, default MAX_CACHE_BYTES
+    :param suffix: file name suffix of the cache entries
+    """
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    max_bytes = MAX_CACHE_BYTES if max_bytes is None else max_bytes
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(suffix):
+            continue
+        fname = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(fname)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, fname))
+
+    total = sum(e[1] for e in entries)
+    for mtime, size, fname in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+        total -= size
+
+
+def clear(cache_dir=None):
+    """
+    Remove all entries from the cache
+
+    :param cache_dir: cache directory, default CACHE_DIR
+    """
+    evict(cache_dir, 0)
@@ -0,0 +1,161 @@
+"""
+Per-element profiling of beamline propagation.
+
+propagate_profiled steps through the beamline one element at a time and records
+wall time, CPU time, memory, mesh size and total intensity after each element.
+
+The memory is the current RSS after the element and the peak RSS of the process.
+A batch worker propagates many pulses, so the process peak may come from an earlier
+pulse, peak_rss_increase is the increase of the process peak during the pulse so far.
+The report can be stored in the output wavefront under /misc/profile and
+aggregated over a batch into a JSON summary.
+"""
+import json
+import resource
+import time
+
+import numpy as np
+import wpg
+
+import beamline_cost
+
+PROFILE_FIELDS = ['wall_time', 'cpu_time', 'rss', 'process_peak_rss', 'peak_rss_increase',
+                  'nx', 'ny', 'nSlices', 'total_intensity', 'transmission']
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _current_rss():
+    # resident pages are the second field of statm, 0 if unknown (no /proc)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        return 0
+
+
+def total_intensity(wfr):
+    """
+    Sum of intensity over all points and slices of both polarizations, without a temporary 3D array
+
+    :param wfr: wavefront
+    :return: total intensity [a.u.]
+    """
+    res = 0.
+    for arr in [wfr.data.arrEhor, wfr.data.arrEver]:
+        flat = np.ravel(arr)
+        res += float(np.dot(flat, flat))
+    return res
+
+
+def propagate_profiled(bl, wfr):
+    """
+    Propagate wavefront through the beamline element by element and profile every element
+
+    :param bl: Beamline
+    :param wfr: wavefront, propagated in place
+    :return: list of dicts, one per element, with element, wall_time [s], cpu_time [s],
+        rss [bytes, current after the element], process_peak_rss [bytes, process peak so far],
+        peak_rss_increase [bytes, increase of the process peak since the start of the pulse],
+        nx, ny, nSlices, total_intensity and transmission (total intensity relative to the beamline entrance)
+    """
+    report = []
+    peak_rss0 = _peak_rss()
+    intensity0 = total_intensity(wfr)
+    for oe, pp in beamline_cost.iter_elements(bl):
+        step = wpg.Beamline()
+        step.append(oe, pp)
+        wall0, cpu0 = time.time(), _cpu_time()
+        step.propagate(wfr)
+        wall1, cpu1 = time.time(), _cpu_time()
+        mesh = wfr.params.Mesh
+        intensity = total_intensity(wfr)
+        peak_rss = _peak_rss()
+        report.append({'element': oe.__class__.__name__,
+                       'wall_time': wall1 - wall0,
+                       'cpu_time': cpu1 - cpu0,
+                       'rss': _current_rss(),
+                       'process_peak_rss': peak_rss,
+                       'peak_rss_increase': peak_rss - peak_rss0,
+                       'nx': mesh.nx, 'ny': mesh.ny, 'nSlices': mesh.nSlices,
+                       'total_intensity': intensity,
+                       'transmission': intensity / intensity0 if intensity0 > 0 else 0.})
+    return report
+
+
+def store_profile(wfr, report, group='/misc/profile'):
+    """
+    Put profiling report to the wavefront custom fields, one dataset per quantity
+
+    :param wfr: wavefront
+    :param report: list from propagate_profiled
+    :param group: HDF5 group for the report
+    """
+    wfr.custom_fields[group + '/element'] = np.array([r['element'] for r in report], dtype='S')
+    for key in PROFILE_FIELDS:
+        wfr.custom_fields[group + '/' + key] = np.array([r[key] for r in report])
+
+
+def format_profile(report):
+    """
+    Format profiling report as a table
+
+    :param report: list from propagate_profiled
+    :return: string
+    """
+    lines = ['{:>3} {:<20} {:>9} {:>9} {:>10} {:>14} {:>6} {:>6} {:>7} {:>12}'.format(
+        '#', 'element', 'wall [s]', 'cpu [s]', 'rss [MB]', 'peak +[MB]', 'nx', 'ny', 'nSlices', 'transmission')]
+    for i, r in enumerate(report):
+        lines.append('{:>3} {:<20} {:>9.2f} {:>9.2f} {:>10.0f} {:>14.0f} {:>6} {:>6} {:>7} {:>12.4f}'.format(
+            i, r['element'], r['wall_time'], r['cpu_time'], r['rss']/2.**20, r['peak_rss_increase']/2.**20,
+            r['nx'], r['ny'], r['nSlices'], r['transmission']))
+    return '\n'.join(lines)
+
+
+def aggregate_profiles(reports):
+    """
+    Aggregate profiling reports of many pulses propagated through the same beamline
+
+    :param reports: list of reports from propagate_profiled
+    :return: dict with number of pulses, totals and per-element statistics
+    """
+    elements = []
+    for i in range(len(reports[0]) if reports else 0):
+        steps = [r[i] for r in reports]
+        wall = [s['wall_time'] for s in steps]
+        cpu = [s['cpu_time'] for s in steps]
+        elements.append({'index': i,
+                         'element': steps[0]['element'],
+                         'wall_time_total': sum(wall),
+                         'wall_time_mean': sum(wall) / len(wall),
+                         'wall_time_max': max(wall),
+                         'cpu_time_mean': sum(cpu) / len(cpu),
+                         'rss_max': max(s['rss'] for s in steps),
+                         'peak_rss_increase_max': max(s['peak_rss_increase'] for s in steps),
+                         'process_peak_rss_max': max(s['process_peak_rss'] for s in steps),
+                         'nx_max': max(s['nx'] for s in steps),
+                         'ny_max': max(s['ny'] for s in steps),
+                         'transmission_mean': sum(s['transmission'] for s in steps) / len(steps)})
+    wall_total = sum(e['wall_time_total'] for e in elements)
+    for e in elements:
+        e['wall_time_fraction'] = e['wall_time_total'] / wall_total if wall_total > 0 else 0.
+    return {'pulses': len(reports), 'wall_time_total': wall_total, 'elements': elements}
+
+
+def write_summary(fname, reports):
+    """
+    Write JSON summary of profiling reports of a batch
+
+    :param fname: output JSON file
+    :param reports: list of reports from propagate_profiled
+    """
+    with open(fname, 'w') as f:
+        json.dump(aggregate_profiles(reports), f, indent=2, sort_keys=True)
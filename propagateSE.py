@@ -13,6 +13,8 @@ isIpynb = False # True if ipython notebook, in python script should be false
 import sys
 import os
 import errno
+import socket
+import time
 
 if isS2E:
     sys.path.insert(0,'/home/packages/WPG/')
@@ -25,15 +27,15 @@ else:
 import multiprocessing
 from glob import glob
 
-import h5py
-import numpy as np
-
-#Import base wavefront class
-from wpg import Wavefront
-import wpg.optical_elements
-from wpg.optical_elements import Use_PP
-from wpg.useful_code import srwutils
-#from wpg.srwlib import srwl,SRWLOptD,SRWLOptA,SRWLOptC,SRWLOptT,SRWLOptL, SRWLOpt
+# numpy, h5py, WPG/SRW and the modules using them are imported by the functions which need them,
+# so that --help, --dry-run and the workers of the batch mode do not pay for unused imports
+import manifest
+import beamline_cost
+import watch
+import work_queue
+import thread_budget
+import catalog
+import scheduler
 
 
 # In[ ]:
@@ -67,11 +69,21 @@ def defineOPD(opTrErMirr, mdatafile, ncol, delim, orient, theta, scale=1., stret
     :param theta: mirror incidence angle
     :param scale: scaling factor for the mirror profile height errors
     :param stretching: scaling factor for the mirror profile x-axis (a hack, should be removed ASAP) 
+
+    The resulting transmission grid is cached on disk, see opd_cache.
     """
-    heightProfData = np.loadtxt(mdatafile).T
-    heightProfData[0,:] = heightProfData[0,:] * stretching
-    wpg.useful_code.srwutils.AuxTransmAddSurfHeightProfileScaled(opTrErMirr, heightProfData, orient, theta, scale)
+    import numpy as np
+    import wpg.useful_code.srwutils
+    import opd_cache
+    key = opd_cache.make_key(opTrErMirr, mdatafile, orient, theta, scale, stretching)
+    if not opd_cache.load(key, opTrErMirr):
+        heightProfData = np.loadtxt(mdatafile).T
+        heightProfData[0,:] = heightProfData[0,:] * stretching
+        wpg.useful_code.srwutils.AuxTransmAddSurfHeightProfileScaled(opTrErMirr, heightProfData, orient, theta, scale)
+        opd_cache.store(key, opTrErMirr)
     if isIpynb:
+        heightProfData = np.loadtxt(mdatafile).T
+        heightProfData[0,:] = heightProfData[0,:] * stretching
         pylab.figure(); pylab.plot(heightProfData[0],heightProfData[ncol-1]*1e9)
         pylab.title('profile from %s' %mdatafile);pylab.xlabel('x (m)');pylab.ylabel('h (nm)') 
 
@@ -85,6 +97,7 @@ def add_history(wf_file_name, history_file_name):
     :param wf_file_name: output file
     :param history_file_name: peraent file
     """
+    import h5py
     with h5py.File(wf_file_name) as wf_h5:
         with h5py.File(history_file_name) as history_h5:
             if 'history' in wf_h5:
@@ -115,20 +128,9 @@ def calculate_fwhm(wfr):
     :param wfr:  wavefront
     :return: {'fwhm_x':fwhm_x, 'fwhm_y': fwhm_y} in [m]
     """
-#    intens = wfr.get_intensity(polarization='total')
-    intens = wfr.get_intensity(polarization='total').sum(axis=-1);
-
-
+    import wf_metrics
     mesh = wfr.params.Mesh
-    dx = (mesh.xMax-mesh.xMin)/mesh.nx
-    dy = (mesh.yMax-mesh.yMin)/mesh.ny
-
-    x_center = intens[intens.shape[0]//2,:]
-    fwhm_x = len(x_center[x_center>x_center.max()/2])*dx
-
-    y_center = intens[:,intens.shape[1]//2]
-    fwhm_y = len(y_center[y_center>y_center.max()/2])*dy
-    return {'fwhm_x':fwhm_x, 'fwhm_y': fwhm_y}
+    return wf_metrics.metrics_from_wavefront(wfr).fwhm(mesh.xMin, mesh.xMax, mesh.yMin, mesh.yMax)
 
 
 # In[ ]:
@@ -140,30 +142,23 @@ def get_intensity_on_axis(wfr):
     :param wfr:  wavefront
     :return: [z,s0] in [a.u.] if frequency domain
     """
-
-    wf_intensity = wfr.get_intensity(polarization='horizontal')
-    mesh = wfr.params.Mesh;
-    zmin = mesh.sliceMin;
-    zmax = mesh.sliceMax;
-    sz = np.zeros((mesh.nSlices, 2), dtype='float64')
-    sz[:,0] = np.linspace(zmin, zmax, mesh.nSlices);
-    sz[:,1] = wf_intensity[mesh.nx/2, mesh.ny/2, :] / wf_intensity.max()
-
-    return sz
+    import wf_metrics
+    mesh = wfr.params.Mesh
+    return wf_metrics.metrics_from_wavefront(wfr).on_axis_spectrum(mesh.sliceMin, mesh.sliceMax)
 
 
 # In[ ]:
 
-def propagate(in_fname, out_fname):
+def get_beamline():
     """
-    Propagate wavefront
+    Built-in beamline definition, used if no --beamline-file is given
     
-    :param in_file: input wavefront file
-    :param out_file: output file
+    :return: Beamline.
     """
-    print('Start propagating:' + in_fname)
-    wf=Wavefront()
-    wf.load_hdf5(in_fname)
+    import numpy as np
+    import wpg.optical_elements
+    from wpg.optical_elements import Use_PP
+    
     distance0 = 300.
     distance1 = 630.
     distance = distance0 + distance1
@@ -232,16 +227,136 @@ def propagate(in_fname, out_fname):
     bl0.append(wf_dist_vfm, Use_PP())
     bl0.append(drift_to_foc, Use_PP(semi_analytical_treatment=1))
 
-    if isIpynb:
-        print bl0
+    return bl0
+
+
+# In[ ]:
+
+def load_get_beamline(beamline_file=None):
+    """
+    Get the beamline factory function
+    
+    :param beamline_file: python file with get_beamline() definition, if None the built-in beamline is used
+    :return: function returning a Beamline
+    """
+    if beamline_file is None:
+        return get_beamline
+    return load_module(beamline_file).get_beamline
+
+
+# In[ ]:
+
+def load_module(fname):
+    """
+    Load python module from file
+    
+    :param fname: python file
+    :return: module
+    """
+    import imp
+    module_name = os.path.splitext(os.path.basename(fname))[0]
+    # already loaded, e.g. inherited from the main process, see worker_context
+    module = sys.modules.get(module_name)
+    module_fname = getattr(module, '__file__', None)
+    if module_fname is not None and \
+            os.path.splitext(os.path.realpath(module_fname))[0] == os.path.splitext(os.path.realpath(fname))[0]:
+        return module
+    return imp.load_source(module_name, fname)
+
+
+# In[ ]:
+
+def load_wavefront(in_fname):
+    """
+    Load input wavefront and prepare it for propagation: convert to frequency domain
+    and store the spectrum before propagation
+    
+    :param in_fname: input wavefront file
+    :return: wavefront
+    """
+    import wpg.srwlib
+    from wpg import Wavefront
+    wf=Wavefront()
+    wf.load_hdf5(in_fname)
     
     wpg.srwlib.srwl.SetRepresElecField(wf._srwl_wf, 'f')
     
     sz0 = get_intensity_on_axis(wf);
     wf.custom_fields['/misc/spectrum0'] = sz0
+    return wf
+
+
+# In[ ]:
+
+def propagate_beamline(wf, bl0, profile=False, slice_processes=1, slice_chunk=None, engine='srw'):
+    """
+    Propagate prepared wavefront through the beamline
     
-    bl0.propagate(wf)
+    :param wf: wavefront from load_wavefront, propagated in place
+    :param bl0: beamline
+    :param profile: propagate element by element and store profiling report in /misc/profile
+    :param slice_processes: number of processes propagating chunks of frequency slices, see slice_parallel
+    :param slice_chunk: maximal number of slices in a chunk, default is an even split between the processes
+    :param engine: 'srw' or 'fft' for the NumPy/FFT engine, see fft_engine
+    :return: profiling report (see profiling.propagate_profiled) if profile is True, else None
+    """
+    report = None
+    if engine == 'fft':
+        import fft_engine
+        print('FFT engine: {wall_time:.1f} s, mesh {nx}x{ny}'.format(**fft_engine.propagate(wf, bl0)))
+        return report
+    if profile:
+        import profiling
+        report = profiling.propagate_profiled(bl0, wf)
+        profiling.store_profile(wf, report)
+        print(profiling.format_profile(report))
+    elif slice_processes > 1 or slice_chunk is not None:
+        import slice_parallel
+        slice_parallel.propagate_slices(wf, bl0, slice_processes, slice_chunk)
+    else:
+        bl0.propagate(wf)
+    return report
+
+
+# In[ ]:
+
+# options of the output file, see save_wavefront
+DEFAULT_OUTPUT_OPTIONS = {'history': 'copy', 'layout': {}, 'level': 'full'}
+
+def run_hash(bl0, engine='srw', output_options=None):
+    """
+    Hash identifying the outputs of a run in the manifest and the shared queue: the beamline,
+    the engine and the output options, see manifest.beamline_hash
     
+    :param bl0: beamline
+    :param engine: 'srw' or 'fft', see propagate_beamline
+    :param output_options: options of the output files, see save_wavefront
+    :return: hex digest
+    """
+    return manifest.beamline_hash(bl0, {'engine': engine,
+                                        'output': dict(DEFAULT_OUTPUT_OPTIONS, **(output_options or {}))})
+
+
+def save_wavefront(wf, bl0, in_fname, out_fname, output_options=None):
+    """
+    Convert propagated wavefront back to time domain, calculate diagnostics and store it with history
+    
+    :param wf: propagated wavefront
+    :param bl0: beamline, its printout is stored in the output file
+    :param in_fname: input wavefront file, the parent in the history
+    :param out_fname: output file
+    :param output_options: dict updating DEFAULT_OUTPUT_OPTIONS:
+        history - 'copy' parent metadata into the output file (add_history) or 'link' to the parent file
+        (history.add_history_linked)
+        layout - chunking, compression and dtype of the field datasets, see h5_layout
+        level - 'full' field, 'intensity' cube or 'summary' only (integrated intensity and power),
+        see h5_layout
+    """
+    import wpg.srwlib
+    import wf_metrics
+    import h5_layout
+    import history
+    options = dict(DEFAULT_OUTPUT_OPTIONS, **(output_options or {}))
     sz1 = get_intensity_on_axis(wf);
     wf.custom_fields['/misc/spectrum1'] = sz1
     
@@ -250,10 +365,18 @@ def propagate(in_fname, out_fname):
     #Resizing: decreasing Range of Horizontal and Vertical Position:
     wpg.srwlib.srwl.ResizeElecField(wf._srwl_wf, 'c', [0, 0.25, 1, 0.25,  1]);
     
-    fwhm = calculate_fwhm(wf)
+    # FWHM, centroid and pulse energy from one pass over the field
+    mesh = wf.params.Mesh
+    metrics = wf_metrics.metrics_from_wavefront(wf)
+    fwhm = metrics.fwhm(mesh.xMin, mesh.xMax, mesh.yMin, mesh.yMax)
+    centroid = metrics.centroid(mesh.xMin, mesh.xMax, mesh.yMin, mesh.yMax)
     
     wf.custom_fields['/misc/xFWHM'] = fwhm['fwhm_x']
     wf.custom_fields['/misc/yFWHM'] = fwhm['fwhm_y']
+    wf.custom_fields['/misc/xCentroid'] = centroid['x']
+    wf.custom_fields['/misc/yCentroid'] = centroid['y']
+    wf.custom_fields['/misc/pulse_energy'] = metrics.pulse_energy(
+        mesh.xMin, mesh.xMax, mesh.yMin, mesh.yMax, mesh.sliceMin, mesh.sliceMax)
     wf.custom_fields['/params/beamline/printout'] = str(bl0)
     
     wf.custom_fields['/info/contact'] = [
@@ -265,50 +388,491 @@ def propagate(in_fname, out_fname):
     
     print('Saving the wavefront data after propagation:' + out_fname)
     mkdir_p(os.path.dirname(out_fname))
-    wf.store_hdf5(out_fname)
-    add_history(out_fname, in_fname)
+    # write to a temporary name first, so a killed run never leaves a truncated file under the final name
+    tmp_fname = partial_name(out_fname)
+    h5_layout.store(wf, tmp_fname, options['layout'], options['level'])
+    if options['history'] == 'link':
+        history.add_history_linked(tmp_fname, in_fname)
+    else:
+        add_history(tmp_fname, in_fname)
+    os.rename(tmp_fname, out_fname)
     print('...done')
 
 
+# In[ ]:
+
+def partial_name(out_fname, writer=None):
+    """
+    Temporary name of the output file while it is written, unique for every writing process,
+    so that a node which took over a pulse (see work_queue) never renames the file of another node
+    
+    :param out_fname: output file
+    :param writer: host_pid of the writing process, default this process
+    :return: out_fname.<host>_<pid>.partial
+    """
+    writer = writer or '{}_{}'.format(socket.gethostname(), os.getpid())
+    return '{}.{}.partial'.format(out_fname, writer)
+
+
+def remove_partial(out_fname, max_age=work_queue.DEFAULT_LEASE_TIMEOUT):
+    """
+    Remove temporary files of killed runs, see save_wavefront: files of this process, of processes of this host
+    which are not running any more and of other hosts not modified for max_age
+    
+    :param out_fname: output file
+    :param max_age: time after which the temporary file of another host is stale [s], the lease timeout
+        of the shared queue
+    """
+    host = socket.gethostname()
+    for fname in glob(glob_escape(out_fname) + '*.partial'):
+        writer = fname[len(out_fname):-len('.partial')].lstrip('.')
+        writer_host, _, pid = writer.rpartition('_')
+        if writer_host == host and pid.isdigit():
+            if int(pid) != os.getpid() and pid_running(int(pid)):
+                continue
+        elif time.time() - os.path.getmtime(fname) < max_age:
+            continue
+        try:
+            os.remove(fname)
+            print('Removed stale ' + fname)
+        except OSError:
+            pass
+
+
+def glob_escape(fname):
+    # glob.escape of python 3
+    return ''.join('[{}]'.format(c) if c in '*?[' else c for c in fname)
+
+
+def pid_running(pid):
+    """
+    :param pid: process id on this host
+    :return: True if the process exists
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
+
+
+# In[ ]:
+
+def propagate(in_fname, out_fname, bl0=None, profile=False, slice_processes=1, slice_chunk=None,
+              output_options=None, engine='srw', add_to_catalog=True):
+    """
+    Propagate wavefront
+    
+    :param in_file: input wavefront file
+    :param out_file: output file
+    :param bl0: beamline, if None the built-in beamline from get_beamline() is used
+    :param profile: propagate element by element and store profiling report in /misc/profile
+    :param slice_processes: number of processes propagating chunks of frequency slices, see slice_parallel
+    :param slice_chunk: maximal number of slices in a chunk, default is an even split between the processes
+    :param output_options: options of the output file, see save_wavefront
+    :param engine: 'srw' or 'fft', see propagate_beamline
+    :param add_to_catalog: append a row of the pulse to the catalog of the output directory, see catalog
+    :return: profiling report (see profiling.propagate_profiled) if profile is True, else None
+    """
+    print('Start propagating:' + in_fname)
+    remove_partial(out_fname)
+    t0 = time.time()
+    wf = load_wavefront(in_fname)
+    if bl0 is None:
+        bl0 = get_beamline()
+
+    if isIpynb:
+        print bl0
+    
+    t1 = time.time()
+    report = propagate_beamline(wf, bl0, profile, slice_processes, slice_chunk, engine)
+    t2 = time.time()
+    save_wavefront(wf, bl0, in_fname, out_fname, output_options)
+    t3 = time.time()
+    if add_to_catalog:
+        catalog.add_row(catalog_row(wf, bl0, in_fname, out_fname, engine, output_options,
+                                    {'load_time': t1 - t0, 'propagation_time': t2 - t1, 'save_time': t3 - t2,
+                                     'wall_time': t3 - t0}))
+    return report
+
+
+def catalog_row(wf, bl0, in_fname, out_fname, engine='srw', output_options=None, timings=None):
+    """
+    Catalog row of a saved wavefront, with the quantities calculated by save_wavefront
+    
+    :param wf: wavefront after save_wavefront
+    :param bl0: beamline
+    :param in_fname: input wavefront file
+    :param out_fname: output file
+    :param engine: 'srw' or 'fft', see propagate_beamline
+    :param output_options: options of the output file, see save_wavefront
+    :param timings: dict with load_time, propagation_time, save_time, wall_time [s]
+    :return: row, see catalog.make_row
+    """
+    mesh = wf.params.Mesh
+    mesh_params = dict((key, getattr(mesh, key)) for key in
+                       ['nx', 'ny', 'nSlices', 'xMin', 'xMax', 'yMin', 'yMax', 'sliceMin', 'sliceMax'])
+    mesh_params['photonEnergy'] = wf.params.photonEnergy
+    metrics = dict((key, wf.custom_fields['/misc/' + path]) for key, path in
+                   [('pulse_energy', 'pulse_energy'), ('fwhm_x', 'xFWHM'), ('fwhm_y', 'yFWHM'),
+                    ('centroid_x', 'xCentroid'), ('centroid_y', 'yCentroid')])
+    level = dict(DEFAULT_OUTPUT_OPTIONS, **(output_options or {}))['level']
+    return catalog.make_row(in_fname, out_fname, run_hash(bl0, engine, output_options), mesh_params, metrics, timings,
+                            engine, level)
+
+
+# In[ ]:
+
+def scan_process(in_fname, out_dname, scan_file, profile=False, output_options=None):
+    """
+    Propagate wavefront through all beamline variants of a parameter scan.
+    The wavefront is propagated once through the longest common prefix of the variants and checkpointed
+    (see scan module), every variant propagates only its own tail from the checkpoint.
+    
+    :param in_fname: input wavefront file
+    :param out_dname: output directory, results are stored in out_dname/<variant name>/prop_out*.h5
+    :param scan_file: python file with get_beamlines() definition, the function returns a list of (name, beamline)
+    :param profile: profile propagation of the tail of every variant, see propagate()
+    :param output_options: options of the output files, see save_wavefront
+    :return: list of output files
+    """
+    import scan
+    variants = load_module(scan_file).get_beamlines()
+    beamlines = [bl for name, bl in variants]
+    n_prefix = scan.common_prefix_length(beamlines)
+    prefix = scan.split_beamline(beamlines[0], n_prefix)[0]
+    checkpoint = scan.checkpoint_name(in_fname, beamlines[0], n_prefix)
+    print 'Scan of {} variants, {} common elements'.format(len(variants), n_prefix)
+    
+    wf = None
+    if n_prefix > 0:
+        wf = scan.load_checkpoint(checkpoint)
+        if wf is None:
+            print 'Propagating common prefix:' + in_fname
+            wf = load_wavefront(in_fname)
+            propagate_beamline(wf, prefix)
+            scan.store_checkpoint(wf, checkpoint)
+        else:
+            print 'Common prefix loaded from checkpoint:' + checkpoint
+    
+    out_fnames = []
+    for name, bl in variants:
+        if wf is None and n_prefix > 0:
+            wf = scan.load_checkpoint(checkpoint)
+        if wf is None:  # no common prefix or the checkpoint was evicted
+            wf = load_wavefront(in_fname)
+            propagate_beamline(wf, prefix)
+        print 'Propagating variant {}'.format(name)
+        propagate_beamline(wf, scan.split_beamline(bl, n_prefix)[1], profile)
+        out_fname = os.path.join(out_dname, str(name),
+                                 os.path.basename(in_fname).replace('FELsource_out','prop_out'))
+        save_wavefront(wf, bl, in_fname, out_fname, output_options)
+        out_fnames.append(out_fname)
+        wf = None
+    return out_fnames
+
+
+# In[ ]:
+
+_worker_beamline = None
+_worker_profile = False
+_worker_output_options = None
+_worker_engine = 'srw'
+_worker_checksum = False
+
+def init_worker(beamline_file=None, profile=False, output_options=None, engine='srw', checksum=False):
+    """
+    Pool initializer: build the beamline once per worker process
+    
+    :param beamline_file: python file with get_beamline() definition, if None the built-in beamline is used
+    :param profile: profile propagation of every pulse, see propagate()
+    :param output_options: options of the output files, see save_wavefront
+    :param engine: 'srw' or 'fft', see propagate_beamline
+    :param checksum: calculate the checksum of every output file for the manifest, see manifest.is_done
+    """
+    global _worker_beamline, _worker_profile, _worker_output_options, _worker_engine, _worker_checksum
+    _worker_beamline = load_get_beamline(beamline_file)()
+    _worker_profile = profile
+    _worker_output_options = output_options
+    _worker_engine = engine
+    _worker_checksum = checksum
+
+
+# In[ ]:
+
+# imported by the main process before the pool is started, the forked workers inherit them
+WORKER_PRELOAD = ['numpy', 'h5py', 'wpg', 'wpg.srwlib', 'wpg.optical_elements',
+                  'opd_cache', 'wf_metrics', 'h5_layout', 'history', 'profiling']
+
+def worker_context(beamline_file=None):
+    """
+    Multiprocessing context of the batch workers. WPG/SRW, the modules used by the workers and the beamline
+    module are imported in the main process, every worker is forked with them loaded.
+    
+    :param beamline_file: python file with get_beamline() definition, found by load_module in the workers
+    :return: fork context, multiprocessing itself in python 2
+    """
+    import importlib
+    for module_name in WORKER_PRELOAD:
+        importlib.import_module(module_name)
+    if beamline_file is not None:
+        load_module(beamline_file)
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+
 # In[ ]:
 
 def propagate_wrapper(params):
     """
     Wrapper for passing parameters as a tupple from multiprocessing module
+    
+    :return: (in_fname, out_fname, error, stats), error is None on success or the traceback text,
+        stats is a dict with wall_time, out_checksum (None if not calculated, see init_worker) and profile
     """
     (in_fname, out_fname) = params
-    return propagate(in_fname, out_fname)
+    t0 = time.time()
+    try:
+        report = propagate(in_fname, out_fname, _worker_beamline, _worker_profile,
+                           output_options=_worker_output_options, engine=_worker_engine)
+        stats = {'wall_time': time.time() - t0,
+                 'out_checksum': manifest.file_checksum(out_fname) if _worker_checksum else None,
+                 'profile': report}
+    except Exception:
+        import traceback
+        return (in_fname, out_fname, traceback.format_exc(), None)
+    return (in_fname, out_fname, None, stats)
+
+
+# In[ ]:
+
+def auto_thread_split(input_files, cpu_number, beamline_file=None, memory_budget=None, pulses=None):
+    """
+    Workers and threads per worker for --threads-per-worker auto, see thread_budget.auto_split
+    
+    :param input_files: input files known so far, their meshes limit the threads and the memory the workers
+    :param cpu_number: maximal number of workers
+    :param beamline_file: python file with get_beamline() definition, if None the built-in beamline is used
+    :param memory_budget: memory budget for all running pulses [bytes], None for no limit
+    :param pulses: number of pulses to propagate, None if unknown
+    :return: (workers, threads)
+    """
+    meshes = []
+    for in_fname in input_files:
+        try:
+            meshes.append(beamline_cost.read_mesh(in_fname))
+        except (IOError, KeyError) as exc:
+            print 'Cannot read mesh of {}: {}'.format(in_fname, exc)
+    if not meshes:
+        return thread_budget.auto_split(cpu_number, pulses)
+    bl0 = load_get_beamline(beamline_file)()
+    memory_estimate = max(beamline_cost.estimate_peak_memory(bl0, mesh) for mesh in meshes)
+    points = max(step['nx'] * step['ny'] for mesh in meshes
+                 for step in beamline_cost.mesh_chain(bl0, mesh['nx'], mesh['ny']))
+    return thread_budget.auto_split(cpu_number, pulses, memory_estimate, memory_budget, points)
+
+
+# In[ ]:
+
+def batch_process(source, out_dname, cpu_number, beamline_file=None, bl_hash=None, done_manifest=None,
+                  memory_budget=None, profile=False, output_options=None, engine='srw',
+                  queue_size=None, profile_fname=None, verify=False):
+    """
+    Propagate the pulses of the source in a pool of workers, see scheduler.schedule.
+    Finished pulses are recorded in the manifest.
+    
+    :param source: pulse source, see scheduler.StaticSource
+    :param out_dname: ouput directory name
+    :param cpu_number: number of pulses propagated at once
+    :param beamline_file: python file with get_beamline() definition, if None the built-in beamline is used
+    :param bl_hash: hash of the beamline and settings recorded in the manifest, see run_hash
+    :param done_manifest: manifest.Manifest of the finished pulses
+    :param memory_budget: memory available for all workers [bytes], None for no limit
+    :param profile: profile propagation of every pulse
+    :param output_options: options of the output files, see save_wavefront
+    :param engine: 'srw' or 'fft', see propagate_beamline
+    :param queue_size: maximal number of pulses waiting for a worker, see scheduler.schedule
+    :param profile_fname: file of the profiling summary, None to keep the reports only in the output files
+    :param verify: record the checksums of the output files in the manifest, see manifest.Manifest.is_done
+    :return: (number of propagated pulses, list of (in_fname, out_fname, error) for failed pulses)
+    """
+    p=scheduler.start_pool(worker_context(beamline_file), cpu_number, init_worker,
+                           (beamline_file, profile, output_options, engine, verify))
+    n_done = 0
+    failed = []
+    profile_reports = []
+    try:
+        for i, (in_fname, out_fname, error, stats) in enumerate(
+                scheduler.schedule(p, propagate_wrapper, source, cpu_number, memory_budget, queue_size)):
+            progress = i+1 if source.total is None else '{}/{}'.format(i+1, source.total)
+            if error is None:
+                done_manifest.add(manifest.make_record(
+                    in_fname, out_fname, bl_hash, stats['out_checksum'], stats['wall_time']))
+                if stats['profile'] is not None:
+                    profile_reports.append(stats['profile'])
+                n_done += 1
+                print '[{}] Done: {}'.format(progress, out_fname)
+            else:
+                failed.append((in_fname, out_fname, error))
+                print '[{}] Failed: {}\n{}'.format(progress, in_fname, error)
+    finally:
+        # all pulses are finished, close() and join() would wait forever for pulses of dead workers
+        p.terminate()
+        p.join()
+    
+    if profile_reports and profile_fname is not None:
+        import profiling
+        profiling.write_summary(profile_fname, profile_reports)
+        print 'Profiling summary of {} pulses saved in {}'.format(len(profile_reports), profile_fname)
+    return n_done, failed
 
 
 # In[ ]:
 
-def directory_process(in_dname, out_dname, cpu_number):
+def directory_process(in_dname, out_dname, cpu_number, beamline_file=None, force=False,
+                      memory_budget=None, profile=False, output_options=None, engine='srw', verify=False):
     """
     Process directory with in_dname\FELsource_out*.h5 files and store it after propagation in out_dname\prop_out*.h5 files
     
+    Finished pulses are recorded in the manifest of the output directory, files already propagated
+    with the same input and beamline are skipped.
+    
     :param in_dname: input directory name
     :param out_dname: ouput directory name
     :param cpu_number: NUmber of CPUs for parallel computing
+    :param beamline_file: python file with get_beamline() definition, if None the built-in beamline is used
+    :param force: propagate all files, even if they are already done according to the manifest
+    :param memory_budget: memory available for all workers [bytes], None for no limit.
+        Pulses are scheduled largest-first so that their estimated peak memory fits the budget.
+    :param profile: profile propagation of every pulse and write summary to out_dname/prop_profile.json
+    :param output_options: options of the output files, see save_wavefront
+    :param engine: 'srw' or 'fft', see propagate_beamline
+    :param verify: skip only outputs with the checksum in the manifest, record checksums of the new outputs
+    :return: list of (in_fname, out_fname, error) for failed pulses
     
     """
-    input_dir = in_dname
-    input_files = glob(os.path.join(input_dir, 'FELsource_out*.h5'))
+    input_files = glob(os.path.join(in_dname, 'FELsource_out*.h5'))
     out_files = []
     for name in input_files:
-        in_file_name = os.path.split(name)[-1]
-        out_file_name = in_file_name.replace('FELsource_out','prop_out')
-        print 'out_file_name:',out_file_name
-        out_files.append(os.path.join(out_dname, out_file_name))
+        out_files.append(scheduler.output_name(name, out_dname))
+        print 'out_file_name:',os.path.split(out_files[-1])[-1]
     
     print 'Found {} HDF5 files in {}'.format(len(input_files), in_dname)
     
-    batch_params = zip(input_files, out_files)
+    mkdir_p(out_dname)
+    done_manifest = manifest.Manifest(out_dname)
+    bl0 = load_get_beamline(beamline_file)()
+    bl_hash = run_hash(bl0, engine, output_options)
+    pulses = []
+    for in_fname, out_fname in zip(input_files, out_files):
+        if not force and done_manifest.is_done(in_fname, out_fname, bl_hash, verify):
+            print 'Skipping, already done: {}'.format(out_fname)
+        else:
+            pulses.append((scheduler.estimate_memory(bl0, in_fname), (in_fname, out_fname)))
+    print '{} HDF5 files to propagate'.format(len(pulses))
+    if pulses:
+        print 'Estimated peak memory per pulse {:.2f}-{:.2f} GB, memory budget {}'.format(
+            min(pulses)[0]/2.**30, max(pulses)[0]/2.**30,
+            'unlimited' if memory_budget is None else '{:.2f} GB'.format(memory_budget/2.**30))
     
-    p=multiprocessing.Pool(processes=cpu_number)
-#     map(propagate_wrapper, batch_params)
-    p.map(propagate_wrapper, batch_params, chunksize=1)
-    p.close()
-    p.join()
+    n_done, failed = batch_process(scheduler.StaticSource(pulses), out_dname, cpu_number, beamline_file,
+                                   bl_hash, done_manifest, memory_budget, profile, output_options, engine,
+                                   profile_fname=os.path.join(out_dname, 'prop_profile.json'), verify=verify)
+    if failed:
+        print '{} of {} files failed'.format(len(failed), len(pulses))
+    return failed
+
+
+# In[ ]:
+
+def watch_process(in_dname, out_dname, cpu_number, beamline_file=None, force=False,
+                  memory_budget=None, profile=False, output_options=None, queue_size=None,
+                  poll_interval=watch.DEFAULT_POLL_INTERVAL, stable_time=watch.DEFAULT_STABLE_TIME,
+                  sentinel=watch.DEFAULT_SENTINEL, timeout=None, engine='srw', verify=False):
+    """
+    Propagate in_dname\FELsource_out*.h5 files as they are written by the upstream stage, see watch.DirectoryWatcher.
+    Complete files wait in a bounded queue for the workers, while it is full the directory is not scanned.
+    
+    :param in_dname: input directory name
+    :param out_dname: ouput directory name
+    :param cpu_number: number of pulses propagated at once
+    :param beamline_file: python file with get_beamline() definition, if None the built-in beamline is used
+    :param force: propagate all files, even if they are already done according to the manifest
+    :param memory_budget: memory available for all workers [bytes], None for no limit
+    :param profile: profile propagation of every pulse and write summary to out_dname/prop_profile.json
+    :param output_options: options of the output files, see save_wavefront
+    :param queue_size: maximal number of complete files waiting for a worker, default cpu_number
+    :param poll_interval: time between scans of the input directory [s]
+    :param stable_time: time without change of a complete input file [s]
+    :param sentinel: name of the file in in_dname, which signals the end of the upstream stage
+    :param timeout: stop if no new input file was complete for this time [s], None to wait for the sentinel
+    :param engine: 'srw' or 'fft', see propagate_beamline
+    :param verify: skip only outputs with the checksum in the manifest, record checksums of the new outputs
+    :return: list of (in_fname, out_fname, error) for failed pulses
+    """
+    watcher = watch.DirectoryWatcher(in_dname, poll_interval=poll_interval, stable_time=stable_time,
+                                     sentinel=sentinel, timeout=timeout)
+    print 'Watching {} for new HDF5 files, stop on {} or after {} s without new files'.format(
+        in_dname, sentinel, timeout)
+    
+    mkdir_p(out_dname)
+    done_manifest = manifest.Manifest(out_dname)
+    bl0 = load_get_beamline(beamline_file)()
+    bl_hash = run_hash(bl0, engine, output_options)
+    source = scheduler.WatchSource(
+        watcher, out_dname, bl0,
+        lambda in_fname, out_fname: not force and done_manifest.is_done(in_fname, out_fname, bl_hash, verify))
+    
+    n_done, failed = batch_process(source, out_dname, cpu_number, beamline_file, bl_hash, done_manifest,
+                                   memory_budget, profile, output_options, engine, queue_size,
+                                   profile_fname=os.path.join(out_dname, 'prop_profile.json'), verify=verify)
+    print 'Watching finished, {} files propagated, {} failed'.format(n_done, len(failed))
+    return failed
+
+
+# In[ ]:
+
+def queue_process(in_dname, out_dname, cpu_number, beamline_file=None, memory_budget=None,
+                  profile=False, output_options=None, lease_timeout=work_queue.DEFAULT_LEASE_TIMEOUT,
+                  poll_interval=30., engine='srw', verify=False):
+    """
+    Process directory like directory_process, sharing the pulses with other nodes running the same command,
+    see work_queue. The function returns when all pulses are done or failed, pulses of crashed nodes
+    are taken over after lease_timeout.
+    
+    :param in_dname: input directory name
+    :param out_dname: ouput directory name, on the filesystem shared by the nodes
+    :param cpu_number: number of pulses propagated at once on this node
+    :param beamline_file: python file with get_beamline() definition, if None the built-in beamline is used
+    :param memory_budget: memory available for all workers of this node [bytes], None for no limit
+    :param profile: profile propagation of every pulse, the report is stored in the output files
+    :param output_options: options of the output files, see save_wavefront
+    :param lease_timeout: time after which a pulse of a node not responding is taken over [s]
+    :param poll_interval: time between checks of pulses claimed by other nodes [s]
+    :param engine: 'srw' or 'fft', see propagate_beamline
+    :param verify: skip only outputs with the checksum in the manifest, record checksums of the new outputs
+    :return: list of (in_fname, out_fname, error) for pulses failed on this node
+    """
+    input_files = sorted(glob(os.path.join(in_dname, 'FELsource_out*.h5')))
+    print 'Found {} HDF5 files in {}'.format(len(input_files), in_dname)
+    mkdir_p(out_dname)
+    work = work_queue.WorkQueue(os.path.join(out_dname, work_queue.QUEUE_DIR_NAME), lease_timeout)
+    done_manifest = manifest.Manifest(out_dname, 'prop_manifest.{}.jsonl'.format(work.owner.replace(':', '_')))
+    bl0 = load_get_beamline(beamline_file)()
+    bl_hash = run_hash(bl0, engine, output_options)
+    source = scheduler.QueueSource(work, input_files, out_dname, bl0, bl_hash, done_manifest, poll_interval,
+                                   verify)
+    
+    work.start_heartbeat()
+    try:
+        n_done, failed = batch_process(source, out_dname, cpu_number, beamline_file, bl_hash, done_manifest,
+                                       memory_budget, profile, output_options, engine, verify=verify)
+    finally:
+        work.close()
+    
+    print '{} files propagated on this node, {} failed'.format(n_done, len(failed))
+    return failed
 
 
 # In[ ]:
@@ -323,6 +887,81 @@ def main():
     parser.add_option("--output-directory", dest="out_dname", help="Output directory with wavefront files")
     parser.add_option("-n", "--cpu-number", dest="cpu_number", default=int((multiprocessing.cpu_count()+1)/2),
                       help="Number of cores for batch wavefronts propagation, default value NUMBER_OF_CPU/2")
+    parser.add_option("--memory-budget", dest="memory_budget", type="float", default=None,
+                      help="Memory [GB] available for batch propagation, number of concurrent pulses is limited "
+                           "by their estimated memory, default value 80% of physical memory, 0 for no limit")
+    parser.add_option("--beamline-file", dest="beamline_file", default=None,
+                      help="Python file with get_beamline() definition, default is the built-in beamline")
+    parser.add_option("--profile", dest="profile", action="store_true", default=False,
+                      help="Profile every beamline element, report is stored in /misc/profile of the output file "
+                           "and in batch mode summarized in prop_profile.json of the output directory")
+    parser.add_option("--history", dest="history", type="choice", choices=['copy', 'link'], default='copy',
+                      help="copy: copy metadata of the input file into /history of the output file (default), "
+                           "link: refer to the input file with HDF5 external links and a provenance index")
+    parser.add_option("--compression", dest="compression", type="choice", choices=['gzip', 'lzf', 'blosc'],
+                      default=None, help="Compression of the field in the output file: gzip, lzf or blosc "
+                                         "(needs hdf5plugin), default no compression")
+    parser.add_option("--compression-level", dest="compression_level", type="int", default=4,
+                      help="Compression level for gzip (0-9) and blosc, default 4")
+    parser.add_option("--no-shuffle", dest="shuffle", action="store_false", default=True,
+                      help="Do not apply the byte shuffle filter before compression")
+    parser.add_option("--h5-chunk-slices", dest="h5_chunk_slices", type="int", default=None,
+                      help="Number of slices per HDF5 chunk of the field in the output file, "
+                           "default about 4 MB chunks if the field is compressed")
+    parser.add_option("--output-level", dest="output_level", type="choice", choices=['full', 'intensity', 'summary'],
+                      default='full',
+                      help="full: store the propagated field (default), intensity: store the intensity cube only, "
+                           "summary: store the integrated intensity, power, spectra and FWHM only")
+    parser.add_option("--force", dest="force", action="store_true", default=False,
+                      help="Propagate all files in batch mode, even if they are already done according to the manifest")
+    parser.add_option("--verify", dest="verify", action="store_true", default=False,
+                      help="Batch mode: check done files by the checksum in the manifest instead of their size and "
+                           "modification time, files without a checksum are propagated again, and record checksums "
+                           "of the new files (reads every output file)")
+    parser.add_option("--slice-processes", dest="slice_processes", type="int", default=1,
+                      help="Single file mode: number of processes propagating chunks of frequency slices in parallel")
+    parser.add_option("--slice-chunk", dest="slice_chunk", type="int", default=None,
+                      help="Single file mode: maximal number of slices propagated by a process at once, "
+                           "limits memory per process, default NUMBER_OF_SLICES/SLICE_PROCESSES")
+    parser.add_option("--scan-file", dest="scan_file", default=None,
+                      help="Python file with get_beamlines() definition returning a list of (name, beamline), "
+                           "every input file is propagated through all variants, results are stored in "
+                           "OUTPUT_DIRECTORY/name/, the common beamline prefix is propagated only once")
+    parser.add_option("--dry-run", dest="dry_run", action="store_true", default=False,
+                      help="Estimate mesh, memory and cost at every beamline element from the input mesh "
+                           "without propagating, output options are optional")
+    parser.add_option("--engine", dest="engine", type="choice", choices=['srw', 'fft'], default='srw',
+                      help="Propagation engine: srw (default) or fft, NumPy FFTs over all slices at once for drifts, "
+                           "apertures, lenses, elliptical mirrors and WF_dist")
+    parser.add_option("--fft-threads", dest="fft_threads", type="int", default=None,
+                      help="Number of FFT threads of the fft engine (needs scipy), -1 for all CPUs, default 1")
+    parser.add_option("--threads-per-worker", dest="threads_per_worker", default=None,
+                      help="Number of OpenMP/BLAS threads of every worker process, set before SRW is loaded, "
+                           "or auto: share the cores between workers and threads by the number of pulses, "
+                           "their size and the memory budget, auto also reduces the number of workers, "
+                           "default the library defaults")
+    parser.add_option("--shared-queue", dest="shared_queue", action="store_true", default=False,
+                      help="Batch mode on many nodes: run the same command on every node, pulses are claimed "
+                           "through lock files in OUTPUT_DIRECTORY/prop_queue on the shared filesystem")
+    parser.add_option("--lease-timeout", dest="lease_timeout", type="float",
+                      default=work_queue.DEFAULT_LEASE_TIMEOUT,
+                      help="Shared queue: pulses of a node, which did not renew its lock for this time [s], "
+                           "are propagated by another node, default %default")
+    parser.add_option("--watch", dest="watch", action="store_true", default=False,
+                      help="Batch mode: keep watching the input directory and propagate files as soon as they are "
+                           "complete, until the sentinel file appears or the timeout expires")
+    parser.add_option("--watch-sentinel", dest="watch_sentinel", default=watch.DEFAULT_SENTINEL,
+                      help="Name of the file in the input directory, which ends watching, default %default")
+    parser.add_option("--watch-timeout", dest="watch_timeout", type="float", default=None,
+                      help="End watching if no new file was complete for this time [s], default wait for the sentinel")
+    parser.add_option("--watch-interval", dest="watch_interval", type="float", default=watch.DEFAULT_POLL_INTERVAL,
+                      help="Time between scans of the input directory [s], default %default")
+    parser.add_option("--watch-stable-time", dest="watch_stable_time", type="float",
+                      default=watch.DEFAULT_STABLE_TIME,
+                      help="A file is complete if its size did not change for this time [s] and it can be opened, "
+                           "default %default")
+    parser.add_option("--watch-queue", dest="watch_queue", type="int", default=None,
+                      help="Maximal number of complete files waiting for a worker, default CPU_NUMBER")
 
     (options, args) = parser.parse_args()
     
@@ -331,20 +970,117 @@ def main():
         parser.error('Input filename or directiry not specified, use --input-file or --input-directory options')
         return 
     
-    if not (options.out_fname or options.out_dname):   # if filename is not given
+    if not (options.out_fname or options.out_dname or options.dry_run):   # if filename is not given
         parser.error('Output filename or directiry not specified, use --output-file or --output-directory options')
         return
     
-    if options.in_dname and options.out_dname:
+    if options.memory_budget is None:
+        physical_memory = beamline_cost.physical_memory()
+        memory_budget = 0.8 * physical_memory if physical_memory else None
+    elif options.memory_budget > 0:
+        memory_budget = options.memory_budget * 2**30
+    else:
+        memory_budget = None
+    
+    output_options = {'history': options.history,
+                      'layout': {'compression': options.compression,
+                                 'compression_level': options.compression_level,
+                                 'shuffle': options.shuffle,
+                                 'chunk_slices': options.h5_chunk_slices},
+                      'level': options.output_level}
+    
+    if options.fft_threads is not None:
+        import separable
+        separable.set_fft_threads(options.fft_threads)  # inherited by the forked workers
+    if options.engine != 'srw' and (options.profile or options.scan_file or options.slice_processes > 1 or
+                                    options.slice_chunk):
+        parser.error('--engine fft can not be combined with --profile, --scan-file or slice parallelism')
+    
+    cpu_number = int(options.cpu_number)
+    if options.threads_per_worker and not options.dry_run:
+        if options.threads_per_worker == 'auto':
+            input_files = glob(os.path.join(options.in_dname, 'FELsource_out*.h5')) if options.in_dname \
+                else [options.in_fname]
+            if options.in_dname and not options.scan_file:
+                pulses = None if options.watch or options.shared_queue else len(input_files)
+                cpu_number, threads = auto_thread_split(input_files, cpu_number, options.beamline_file,
+                                                        memory_budget, pulses)
+            else:  # one pulse at a time
+                threads = auto_thread_split(input_files, options.slice_processes, options.beamline_file)[1]
+        elif options.threads_per_worker.isdigit() and int(options.threads_per_worker) > 0:
+            threads = int(options.threads_per_worker)
+        else:
+            parser.error('--threads-per-worker must be a positive number or auto')
+        threads = thread_budget.configured_threads() or threads  # keep the setting of a restart
+        if not thread_budget.set_threads(threads):
+            print 'SRW is loaded, restarting with {} threads per worker'.format(threads)
+            thread_budget.restart()
+        print '{} threads per worker'.format(threads)
+        if options.engine == 'fft' and options.fft_threads is None:
+            import separable
+            separable.set_fft_threads(threads)
+    
+    if options.dry_run:
+        if options.in_dname:
+            input_files = glob(os.path.join(options.in_dname, 'FELsource_out*.h5'))
+        else:
+            input_files = [options.in_fname]
+        bl0 = load_get_beamline(options.beamline_file)()
+        seconds_per_unit = None
+        if options.out_dname:  # calibrate by the wall times of pulses already propagated
+            seconds_per_unit = beamline_cost.calibrate(manifest.Manifest(options.out_dname).records.values(),
+                                                       bl0, run_hash(bl0, options.engine, output_options))
+        beamline_cost.dry_run(input_files, bl0, cpu_number, memory_budget, seconds_per_unit)
+    
+    elif options.scan_file:
+        if not options.out_dname:
+            parser.error('Scan results are stored in variant subdirectories, use --output-directory option')
+        if options.in_dname:
+            input_files = glob(os.path.join(options.in_dname, 'FELsource_out*.h5'))
+        else:
+            input_files = [options.in_fname]
+        for in_fname in input_files:
+            scan_process(in_fname, options.out_dname, options.scan_file, options.profile, output_options)
+    
+    elif options.shared_queue:
+        if not (options.in_dname and options.out_dname):
+            parser.error('Shared queue needs --input-directory and --output-directory options')
+        if options.force:
+            parser.error('--force can not be combined with --shared-queue')
+        failed = queue_process(options.in_dname, options.out_dname, cpu_number,
+                               options.beamline_file, memory_budget, options.profile, output_options,
+                               options.lease_timeout, engine=options.engine, verify=options.verify)
+        if failed:
+            sys.exit(1)
+    
+    elif options.watch:
+        if not (options.in_dname and options.out_dname):
+            parser.error('Watch mode needs --input-directory and --output-directory options')
+        failed = watch_process(options.in_dname, options.out_dname, cpu_number,
+                               options.beamline_file, options.force, memory_budget, options.profile,
+                               output_options, options.watch_queue, options.watch_interval,
+                               options.watch_stable_time, options.watch_sentinel, options.watch_timeout,
+                               options.engine, options.verify)
+        if failed:
+            sys.exit(1)
+    
+    elif options.in_dname and options.out_dname:
         print 'Input directory {}, output directory {}, number of cores {}'.format(
-            options.in_dname, options.out_dname, options.cpu_number)
+            options.in_dname, options.out_dname, cpu_number)
         print 'Batch propagation started'
-        directory_process(options.in_dname, options.out_dname, int(options.cpu_number))
+        failed = directory_process(options.in_dname, options.out_dname, cpu_number,
+                                   options.beamline_file, options.force, memory_budget, options.profile,
+                                   output_options, options.engine, options.verify)
         print 'Batch propagation finished'
+        if failed:
+            sys.exit(1)
         
     elif options.in_fname and options.out_fname:
         print 'Input file {}, output file {}'.format(options.in_fname, options.out_fname)
-        propagate(options.in_fname, options.out_fname)
+        if options.profile and (options.slice_processes > 1 or options.slice_chunk):
+            parser.error('--profile can not be combined with --slice-processes or --slice-chunk')
+        propagate(options.in_fname, options.out_fname, load_get_beamline(options.beamline_file)(),
+                  options.profile, options.slice_processes, options.slice_chunk, output_options, options.engine)
 
 
 # In[ ]:
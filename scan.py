@@ -0,0 +1,151 @@
+"""
+Prefix sharing for beamline parameter scans.
+
+Scan variants usually differ only in the last elements of the beamline. The
+wavefront is propagated once through the longest common prefix of all variants
+and checkpointed on disk, every variant then resumes from the checkpoint and
+propagates only its own tail. Checkpoints are keyed by the input file and a
+hash of the prefix elements, so they are reused by later scans of the same
+input and upstream beamline.
+
+Configuration through environment variables:
+
+    PROP_SCAN_CACHE_DIR     checkpoint directory (default ~/.cache/prop/scan)
+    PROP_SCAN_CACHE_MAX_MB  size limit of the checkpoints in MB (default 20480)
+"""
+import os
+import errno
+import hashlib
+from array import array
+
+import numpy as np
+import wpg
+
+import beamline_cost
+import opd_cache
+
+CACHE_DIR = os.environ.get('PROP_SCAN_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'prop', 'scan'))
+MAX_CACHE_BYTES = int(float(os.environ.get('PROP_SCAN_CACHE_MAX_MB', 20480)) * 2**20)
+
+
+def _update_hash(sha, obj):
+    # hash content of SRW/WPG objects, default repr() contains memory addresses
+    if isinstance(obj, (array, np.ndarray)):
+        to_bytes = getattr(obj, 'tobytes', None) or obj.tostring  # array.array in python 2
+        sha.update(to_bytes())
+    elif isinstance(obj, (list, tuple)):
+        sha.update(b'[')
+        for item in obj:
+            _update_hash(sha, item)
+        sha.update(b']')
+    elif isinstance(obj, dict):
+        sha.update(b'{')
+        for key in sorted(obj):
+            _update_hash(sha, key)
+            _update_hash(sha, obj[key])
+        sha.update(b'}')
+    elif hasattr(obj, '__dict__') and not callable(obj):
+        sha.update(obj.__class__.__name__.encode('utf-8'))
+        _update_hash(sha, vars(obj))
+    else:
+        sha.update(repr(obj).encode('utf-8'))
+
+
+def element_hash(oe, pp):
+    """
+    Hash of an optical element with its propagation parameters
+
+    :param oe: optical element
+    :param pp: propagation parameters
+    :return: hex digest
+    """
+    sha = hashlib.sha1()
+    _update_hash(sha, oe)
+    _update_hash(sha, list(pp))
+    return sha.hexdigest()
+
+
+def common_prefix_length(beamlines):
+    """
+    Number of leading elements, which are identical in all beamlines
+
+    :param beamlines: list of Beamline
+    :return: length of the common prefix
+    """
+    hashes = [[element_hash(oe, pp) for oe, pp in beamline_cost.iter_elements(bl)] for bl in beamlines]
+    n = 0
+    while all(len(h) > n for h in hashes) and len(set(h[n] for h in hashes)) == 1:
+        n += 1
+    return n
+
+
+def split_beamline(bl, n):
+    """
+    Split the beamline into the first n elements and the rest
+
+    :param bl: Beamline
+    :param n: number of elements in the prefix
+    :return: (prefix, tail) Beamlines
+    """
+    prefix, tail = wpg.Beamline(), wpg.Beamline()
+    for i, (oe, pp) in enumerate(beamline_cost.iter_elements(bl)):
+        (prefix if i < n else tail).append(oe, pp)
+    return prefix, tail
+
+
+def checkpoint_name(in_fname, bl, n, cache_dir=None):
+    """
+    Checkpoint file of the wavefront propagated from in_fname through the first n elements of bl
+
+    :param in_fname: input wavefront file
+    :param bl: Beamline
+    :param n: number of elements in the prefix
+    :param cache_dir: checkpoint directory, default CACHE_DIR
+    :return: file name
+    """
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    st = os.stat(in_fname)
+    sha = hashlib.sha1()
+    _update_hash(sha, [os.path.abspath(in_fname), st.st_size, st.st_mtime])
+    for i, (oe, pp) in enumerate(beamline_cost.iter_elements(bl)):
+        if i >= n:
+            break
+        sha.update(element_hash(oe, pp).encode('ascii'))
+    return os.path.join(cache_dir, sha.hexdigest() + '.h5')
+
+
+def store_checkpoint(wf, fname, max_bytes=None):
+    """
+    Store wavefront checkpoint atomically and evict old checkpoints if the cache is too big
+
+    :param wf: wavefront
+    :param fname: checkpoint file from checkpoint_name
+    :param max_bytes: size limit of the checkpoints, default MAX_CACHE_BYTES
+    """
+    max_bytes = MAX_CACHE_BYTES if max_bytes is None else max_bytes
+    cache_dir = os.path.dirname(fname)
+    try:
+        os.makedirs(cache_dir)
+    except OSError as exc:
+        if not (exc.errno == errno.EEXIST and os.path.isdir(cache_dir)):
+            raise
+    tmp_fname = '{}.{}.partial'.format(fname, os.getpid())
+    wf.store_hdf5(tmp_fname)
+    os.rename(tmp_fname, fname)
+    opd_cache.evict(cache_dir, max_bytes, suffix='.h5')
+
+
+def load_checkpoint(fname):
+    """
+    Load wavefront from the checkpoint
+
+    :param fname: checkpoint file from checkpoint_name
+    :return: wavefront, or None if there is no checkpoint
+    """
+    if not os.path.exists(fname):
+        return None
+    wf = wpg.Wavefront()
+    wf.load_hdf5(fname)
+    os.utime(fname, None)  # mark as recently used
+    return wf
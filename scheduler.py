@@ -0,0 +1,370 @@
+"""
+Memory-aware scheduling of batch propagation.
+
+schedule() runs the pulses of a pulse source in a process pool. Pulses wait in
+a pending list until a worker is free and their estimated peak memory fits the
+budget beside the running pulses; smaller pulses fill the remaining budget, a
+pulse bigger than the whole budget runs alone. The batch modes differ only in
+their pulse source:
+
+    StaticSource  pulses known at the start (a directory), largest first
+    WatchSource   files reported complete by a watch.DirectoryWatcher
+    QueueSource   pulses claimed through a work_queue.WorkQueue shared by nodes
+
+A source offers pulses with poll(), may refuse a pulse when it is about to
+start (admit, e.g. claimed by another node in the meantime), is told about the
+result of every pulse (finish), may cancel running pulses (cancelled, e.g. a lost
+lease) and decides when the batch is over (finished).
+"""
+import os
+import signal
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import beamline_cost
+
+
+def output_name(in_fname, out_dname):
+    """
+    :param in_fname: input file FELsource_out*.h5
+    :param out_dname: output directory
+    :return: output file out_dname/prop_out*.h5
+    """
+    return os.path.join(out_dname, os.path.split(in_fname)[-1].replace('FELsource_out', 'prop_out'))
+
+
+def estimate_memory(bl, in_fname):
+    """
+    :param bl: beamline
+    :param in_fname: input file
+    :return: estimated peak memory of the pulse [bytes], 0 if the mesh can not be read
+    """
+    try:
+        return beamline_cost.estimate_peak_memory(bl, beamline_cost.read_mesh(in_fname))
+    except (IOError, KeyError) as exc:
+        print('Cannot estimate memory for {}: {}'.format(in_fname, exc))
+        return 0
+
+
+class StaticSource(object):
+    """
+    Pulses known at the start
+    """
+    idle_wait = 1.
+
+    def __init__(self, pulses):
+        """
+        :param pulses: list of (memory, (in_fname, out_fname))
+        """
+        self.pulses = sorted(pulses, key=lambda x: x[0], reverse=True)
+        self.total = len(pulses)
+
+    def poll(self, max_pulses):
+        """
+        :param max_pulses: maximal number of pulses offered
+        :return: list of (memory, (in_fname, out_fname)) offered for propagation
+        """
+        offered, self.pulses = self.pulses[:max_pulses], self.pulses[max_pulses:]
+        return offered
+
+    def admit(self, params):
+        """
+        :param params: (in_fname, out_fname) about to start
+        :return: True if the pulse is propagated
+        """
+        return True
+
+    def finish(self, params, error):
+        """
+        :param params: (in_fname, out_fname) of a finished pulse
+        :param error: None on success or the traceback text
+        """
+        pass
+
+    def finished(self):
+        """
+        :return: True if no more pulses will be offered
+        """
+        return not self.pulses
+
+    def cancelled(self):
+        """
+        :return: list of (params, reason) of running pulses to stop
+        """
+        return []
+
+
+class WatchSource(StaticSource):
+    """
+    Files reported complete by a watch.DirectoryWatcher
+    """
+
+    def __init__(self, watcher, out_dname, bl, is_done):
+        """
+        :param watcher: watch.DirectoryWatcher of the input directory
+        :param out_dname: output directory
+        :param bl: beamline, for the memory estimates
+        :param is_done: function(in_fname, out_fname) returning True for pulses to skip
+        """
+        self.watcher = watcher
+        self.out_dname = out_dname
+        self.bl = bl
+        self.is_done = is_done
+        self.total = None
+
+    def poll(self, max_pulses):
+        offered = []
+        for in_fname in self.watcher.poll(max_pulses):
+            out_fname = output_name(in_fname, self.out_dname)
+            if self.is_done(in_fname, out_fname):
+                print('Skipping, already done: {}'.format(out_fname))
+                continue
+            print('New file: {}'.format(in_fname))
+            offered.append((estimate_memory(self.bl, in_fname), (in_fname, out_fname)))
+        return offered
+
+    def finished(self):
+        return self.watcher.finished()
+
+
+class QueueSource(StaticSource):
+    """
+    Pulses of a directory shared with other nodes through a work_queue.WorkQueue
+    """
+
+    def __init__(self, work, input_files, out_dname, bl, bl_hash, done_manifest, poll_interval=30., verify=False):
+        """
+        :param work: work_queue.WorkQueue
+        :param input_files: input files
+        :param out_dname: output directory
+        :param bl: beamline, for the memory estimates
+        :param bl_hash: hash of the beamline and settings, part of the signature of the done and failed markers
+        :param done_manifest: manifest.Manifest of this node
+        :param poll_interval: time between checks of pulses claimed by other nodes [s]
+        :param verify: compare checksums of the outputs in the manifest, see manifest.Manifest.is_done
+        """
+        self.work = work
+        self.input_files = input_files
+        self.out_dname = out_dname
+        self.bl = bl
+        self.bl_hash = bl_hash
+        self.done_manifest = done_manifest
+        self.idle_wait = poll_interval
+        self.verify = verify
+        self.total = None
+        self.memory_estimates = {}
+        self.offered = set()
+        self.completed = set()
+        self.running = {}  # key: params
+        self.remaining = False  # pulses claimed by other nodes or not looked at
+
+    def key(self, in_fname):
+        return os.path.split(in_fname)[-1]
+
+    def signature(self, in_fname):
+        st = os.stat(in_fname)
+        return {'in_size': st.st_size, 'in_mtime': st.st_mtime, 'beamline_hash': self.bl_hash}
+
+    def poll(self, max_pulses):
+        offered = []
+        self.remaining = False
+        self.work.sync_clock()
+        self.done_manifest.reload()
+        for in_fname in self.input_files:
+            if len(offered) >= max_pulses:
+                self.remaining = True
+                break
+            if in_fname in self.completed or in_fname in self.offered:
+                continue
+            out_fname = output_name(in_fname, self.out_dname)
+            state = self.work.state(self.key(in_fname), self.signature(in_fname))
+            # an output deleted since is propagated again
+            if state == 'failed' or (state == 'done' and os.path.exists(out_fname)):
+                self.completed.add(in_fname)
+                continue
+            if state == 'locked':
+                self.remaining = True
+                continue
+            if in_fname not in self.memory_estimates:
+                self.memory_estimates[in_fname] = estimate_memory(self.bl, in_fname)
+            self.offered.add(in_fname)
+            offered.append((self.memory_estimates[in_fname], (in_fname, out_fname)))
+        return offered
+
+    def admit(self, params):
+        in_fname, out_fname = params
+        self.offered.discard(in_fname)
+        key = self.key(in_fname)
+        if not self.work.claim(key):
+            self.remaining = True
+            return False
+        if self.done_manifest.is_done(in_fname, out_fname, self.bl_hash, self.verify):
+            print('Skipping, already done: {}'.format(out_fname))
+            self.work.release(key, 'done', self.signature(in_fname))
+            self.completed.add(in_fname)
+            return False
+        print('Claimed by {}: {}'.format(self.work.owner, in_fname))
+        self.running[key] = params
+        return True
+
+    def finish(self, params, error):
+        in_fname = params[0]
+        key = self.key(in_fname)
+        del self.running[key]
+        if key in self.work.lost:
+            print('Lease lost, left to another node: {}'.format(in_fname))
+            self.work.release(key)
+            return
+        self.completed.add(in_fname)
+        if error is None:
+            self.work.release(key, 'done', self.signature(in_fname))
+        else:
+            self.work.release(key, 'failed', self.signature(in_fname), {'error': error})
+
+    def finished(self):
+        return not self.offered and not self.remaining
+
+    def cancelled(self):
+        return [(self.running[key], 'Lease lost, the pulse was taken over by another node')
+                for key in list(self.work.lost) if key in self.running]
+
+
+_started = None
+
+def _init_worker(started, initializer=None, initargs=()):
+    global _started
+    _started = started
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _run_task(task, params):
+    """
+    Run the task in a pool worker, reporting the worker process of the pulse first
+    """
+    _started.put((params, os.getpid()))
+    return task(params)
+
+
+def start_pool(context, processes, initializer=None, initargs=()):
+    """
+    Pool for schedule(), its workers report which pulse they run so that a pulse of a killed worker
+    (e.g. by the OOM killer) is reported as failed instead of waited for forever
+
+    :param context: multiprocessing context (multiprocessing itself in python 2)
+    :param processes: number of workers
+    :param initializer: function called in every worker at its start
+    :param initargs: arguments of the initializer
+    :return: pool
+    """
+    if hasattr(context, 'SimpleQueue'):
+        started = context.SimpleQueue()
+    else:
+        import multiprocessing.queues
+        started = multiprocessing.queues.SimpleQueue()
+    pool = context.Pool(processes=processes, initializer=_init_worker, initargs=(started, initializer, initargs))
+    pool.started = started
+    return pool
+
+
+def alive_workers(pool):
+    """
+    :param pool: multiprocessing pool
+    :return: set of pids of the running worker processes, None if the pool does not expose its workers
+    """
+    # multiprocessing has no public API for the workers of a pool
+    workers = getattr(pool, '_pool', None)
+    if workers is None:
+        return None
+    try:
+        return set(w.pid for w in workers if w.exitcode is None)
+    except AttributeError:
+        return None
+
+
+def schedule(pool, task, source, cpu_number, memory_budget=None, queue_size=None):
+    """
+    Run the pulses of the source in the pool within the memory budget.
+    Pulses cancelled by the source are stopped by killing their worker. The results of pulses
+    whose worker died are (in_fname, out_fname, error, None), if the workers of the pool can be
+    found (see alive_workers).
+    A pool with such lost pulses can not be closed and joined, only terminated.
+
+    :param pool: pool with initialized workers from start_pool
+    :param task: function(params) run in the pool, returns (in_fname, out_fname, error, stats)
+    :param source: pulse source, see StaticSource
+    :param cpu_number: maximal number of pulses running at once
+    :param memory_budget: memory budget for all running pulses [bytes], None for no limit
+    :param queue_size: maximal number of pulses waiting for a worker, default all pulses of a static source
+        and cpu_number for the others
+    :return: iterator over the task results in order of completion
+    """
+    if queue_size is None:
+        queue_size = source.total if source.total is not None else cpu_number
+    wake = queue.Queue()
+    pending = []  # (memory, params), in the order of the source
+    running = {}  # params: (memory, AsyncResult)
+    workers = {}  # params: pid of the worker
+    stopped = {}  # params: reason, pulses cancelled by the source
+    killed = set()
+    used_memory = 0
+    while True:
+        if len(pending) < queue_size:
+            pending.extend(source.poll(queue_size - len(pending)))
+        i = 0
+        while i < len(pending) and len(running) < cpu_number:
+            memory, params = pending[i]
+            if running and memory_budget is not None and used_memory + memory > memory_budget:
+                i += 1
+                continue
+            del pending[i]
+            if not source.admit(params):
+                continue
+            running[params] = (memory, pool.apply_async(_run_task, (task, params), callback=wake.put))
+            used_memory += memory
+
+        if not pending and not running and source.finished():
+            break
+        try:
+            # a timeout keeps the wait interruptible by Ctrl-C and finds dead workers
+            wake.get(timeout=1. if running else source.idle_wait)
+        except queue.Empty:
+            pass
+        while not pool.started.empty():
+            params, pid = pool.started.get()
+            workers[params] = pid
+        for params, reason in source.cancelled():
+            if params in running and params not in stopped:
+                stopped[params] = reason
+        for params in stopped:
+            if params in workers and params not in killed and not running[params][1].ready():
+                try:
+                    os.kill(workers[params], signal.SIGTERM)
+                except OSError:  # already dead
+                    pass
+                killed.add(params)
+        # a dead worker is replaced by the pool, its pulse is never finished
+        alive = alive_workers(pool)
+        for params in list(running):
+            memory, async_result = running[params]
+            if async_result.ready():
+                try:
+                    result = async_result.get()
+                except Exception as exc:  # e.g. an unpicklable result
+                    result = params + ('{}: {}'.format(exc.__class__.__name__, exc), None)
+            elif alive is not None and params in workers and workers[params] not in alive:
+                error = stopped.get(params) or \
+                    'Worker process {} died, e.g. killed by the OOM killer'.format(workers[params])
+                result = params + (error, None)
+            else:
+                continue
+            del running[params]
+            workers.pop(params, None)
+            stopped.pop(params, None)
+            killed.discard(params)
+            used_memory -= memory
+            yield result
+            source.finish(params, result[2])
@@ -0,0 +1,572 @@
+"""
+Separable quick-look propagation of KB-type beamlines.
+
+Rectangular apertures, drifts, lenses, a horizontal and a vertical elliptical
+mirror and mirror height errors depending on one coordinate act on x and y
+independently. For such beamlines every frequency slice of the field is
+approximated by a product E(x, y) = u(x) v(y) (the leading singular pair of the
+slice) and u and v are propagated as 1D fields, so a propagation step costs
+O(nx + ny) per slice instead of O(nx * ny). The 2D intensity is the outer
+product |v(y)|^2 |u(x)|^2. Only the reduction of the input field to the 1D
+factors touches the full 2D field, once.
+
+The fraction of the field energy captured by the product (separability of the
+source) is reported with the result, compare() validates the result against a
+2D SRW propagation of the same pulse.
+
+Propagation follows the Use_PP parameters of every element: the range (zoom)
+and resolution (sampling) of the mesh are changed before the element, drifts
+with semi_analytical_treatment=1 keep the quadratic phase of the wavefront
+analytically (radius of curvature) as SRW does. Elliptical mirrors are thin
+lenses with the focal length pq/(p+q) and the projected mirror length as aperture.
+
+Usage:
+python separable.py --input-file FELsource_out_0000001.h5 --reference prop_out_0000001.h5
+"""
+import os
+import time
+
+import numpy as np
+
+import beamline_cost
+import wf_metrics
+
+# photon energy [eV] times wavelength [m]
+HC_EV_M = 1.23984193e-6
+# transmission grids deviating less from a separable one are treated as separable
+OPD_TOLERANCE = 1e-12
+AMPLITUDE_TOLERANCE = 1e-6
+RANK1_ITERATIONS = 8
+# number of slices reduced to 1D factors at once
+CHUNK_SLICES = 16
+FFT_THREADS = 1
+# the mesh of a drift evaluated with the Fresnel integral covers the directions of this fraction of the energy
+FRESNEL_ENERGY_FRACTION = 0.9999
+
+try:
+    import scipy.fft as _scipy_fft
+except ImportError:
+    _scipy_fft = None
+
+
+class UnsupportedElement(ValueError):
+    """
+    The beamline has an optical element, which can not be decoded
+    """
+    pass
+
+
+class NotSeparable(UnsupportedElement):
+    """
+    The beamline has an element acting on x and y jointly
+    """
+    pass
+
+
+def describe_element(oe):
+    """
+    Decode an SRW optical element by its attributes
+
+    :param oe: optical element
+    :return: dict with 'type' (drift, aperture, mirror, transmission or lens) and the parameters
+    """
+    name = oe.__class__.__name__
+    if hasattr(oe, 'L'):
+        return {'type': 'drift', 'L': oe.L}
+    if hasattr(oe, 'ap_or_ob'):
+        return {'type': 'aperture', 'shape': oe.shape, 'ap_or_ob': oe.ap_or_ob,
+                'Dx': oe.Dx, 'Dy': oe.Dy, 'x': getattr(oe, 'x', 0.), 'y': getattr(oe, 'y', 0.)}
+    if hasattr(oe, 'angGraz') and hasattr(oe, 'p') and hasattr(oe, 'q'):
+        orient = 'x' if abs(getattr(oe, 'nvx', 0.)) > abs(getattr(oe, 'nvy', 0.)) else 'y'
+        return {'type': 'mirror', 'orient': orient, 'f': oe.p * oe.q / (oe.p + oe.q), 'angle': oe.angGraz,
+                'size_tang': getattr(oe, 'dt', None), 'size_sag': getattr(oe, 'ds', None)}
+    if getattr(oe, 'arTr', None) is not None:
+        mesh = oe.mesh
+        if getattr(mesh, 'ne', 1) != 1:
+            raise UnsupportedElement('{}: energy dependent transmission is not supported'.format(name))
+        tr = np.array(oe.arTr, dtype='float64').reshape(mesh.ny, mesh.nx, 2)
+        return {'type': 'transmission', 'amplitude': tr[:, :, 0], 'opd': tr[:, :, 1],
+                'x': np.linspace(mesh.xStart, mesh.xFin, mesh.nx),
+                'y': np.linspace(mesh.yStart, mesh.yFin, mesh.ny),
+                'outside_zero': getattr(oe, 'extTr', 0) == 0}
+    if hasattr(oe, 'Fx') and hasattr(oe, 'Fy'):
+        return {'type': 'lens', 'Fx': oe.Fx, 'Fy': oe.Fy, 'x': getattr(oe, 'x', 0.), 'y': getattr(oe, 'y', 0.)}
+    raise UnsupportedElement('{}: unsupported optical element'.format(name))
+
+
+def separate_transmission(desc, strict=True):
+    """
+    Split a transmission grid into a(x) b(y) exp(i k (opd_x(x) + opd_y(y)))
+
+    :param desc: transmission from describe_element
+    :param strict: raise NotSeparable if the grid is not separable within the tolerances,
+        otherwise the cuts through the center are used
+    :return: ((amplitude_x, opd_x), (amplitude_y, opd_y))
+    """
+    amplitude, opd = desc['amplitude'], desc['opd']
+    cy, cx = amplitude.shape[0] // 2, amplitude.shape[1] // 2
+    amplitude_x, opd_x = amplitude[cy, :], opd[cy, :]
+    center = amplitude[cy, cx]
+    amplitude_y = amplitude[:, cx] / center if center != 0 else amplitude[:, cx]
+    opd_y = opd[:, cx] - opd[cy, cx]
+    if strict:
+        amplitude_error = np.abs(amplitude - np.outer(amplitude_y, amplitude_x)).max()
+        opd_error = np.abs(opd - opd_y[:, None] - opd_x[None, :]).max()
+        if amplitude_error > AMPLITUDE_TOLERANCE or opd_error > OPD_TOLERANCE:
+            raise NotSeparable('transmission is not separable: amplitude error {:.2e}, OPD error {:.2e} m'.format(
+                amplitude_error, opd_error))
+    return (amplitude_x, opd_x), (amplitude_y, opd_y)
+
+
+def axis_operations(desc, strict=True):
+    """
+    Operations of an element on the x and y fields
+
+    :param desc: element from describe_element
+    :param strict: see separate_transmission
+    :return: (operations on x, operations on y), lists of tuples (name, parameters...)
+    """
+    kind = desc['type']
+    if kind == 'drift':
+        return [('drift', desc['L'])], [('drift', desc['L'])]
+    if kind == 'aperture':
+        if desc['shape'] != 'r' or desc['ap_or_ob'] != 'a':
+            raise NotSeparable('only rectangular apertures are separable, not {}/{}'.format(
+                desc['shape'], desc['ap_or_ob']))
+        return [('window', desc['x'], desc['Dx'])], [('window', desc['y'], desc['Dy'])]
+    if kind == 'lens':
+        return [('lens', desc['Fx'])], [('lens', desc['Fy'])]
+    if kind == 'mirror':
+        tangential = [('lens', desc['f'])]
+        if desc['size_tang']:
+            tangential.append(('window', 0., desc['size_tang'] * np.sin(desc['angle'])))
+        sagittal = [('window', 0., desc['size_sag'])] if desc['size_sag'] else []
+        return (tangential, sagittal) if desc['orient'] == 'x' else (sagittal, tangential)
+    (amplitude_x, opd_x), (amplitude_y, opd_y) = separate_transmission(desc, strict)
+    return ([('transmission', desc['x'], amplitude_x, opd_x, desc['outside_zero'])],
+            [('transmission', desc['y'], amplitude_y, opd_y, desc['outside_zero'])])
+
+
+def separable_beamline(bl, strict=True):
+    """
+    Decompose the beamline into 1D propagation steps
+
+    :param bl: Beamline
+    :param strict: see separate_transmission
+    :return: list of dicts with name, pp (see beamline_cost.pp_factors), x and y operations
+    :raise NotSeparable: if an element acts on x and y jointly, UnsupportedElement for unknown elements
+    """
+    steps = []
+    for oe, pp in beamline_cost.iter_elements(bl):
+        ops_x, ops_y = axis_operations(describe_element(oe), strict)
+        steps.append({'name': oe.__class__.__name__, 'pp': beamline_cost.pp_factors(pp),
+                      'x': ops_x, 'y': ops_y})
+    return steps
+
+
+def is_separable(bl):
+    """
+    :param bl: Beamline
+    :return: (True, None) or (False, reason)
+    """
+    try:
+        separable_beamline(bl)
+    except UnsupportedElement as exc:
+        return False, str(exc)
+    return True, None
+
+
+def set_fft_threads(threads):
+    """
+    Number of threads of the FFTs, used if scipy.fft is available (numpy.fft is single threaded)
+
+    :param threads: number of threads, -1 for all CPUs
+    """
+    global FFT_THREADS
+    FFT_THREADS = threads
+
+
+def fft(a, n=None):
+    """
+    FFT along the last axis, multithreaded and keeping single precision with scipy.fft
+
+    :param a: array
+    :param n: length of the transform, see numpy.fft.fft
+    :return: transformed array
+    """
+    if _scipy_fft is not None:
+        return _scipy_fft.fft(a, n, axis=-1, workers=FFT_THREADS)
+    return np.fft.fft(a, n, axis=-1)
+
+
+def ifft(a, n=None):
+    """
+    Inverse FFT along the last axis, see fft
+    """
+    if _scipy_fft is not None:
+        return _scipy_fft.ifft(a, n, axis=-1, workers=FFT_THREADS)
+    return np.fft.ifft(a, n, axis=-1)
+
+
+class Field1D(object):
+    """
+    Field along one axis, the last axis of w, for all slices, the first axis of w:
+    w(x) exp(i k x^2 inv_r / 2) on the mesh xmin..xmax
+    """
+
+    def __init__(self, w, xmin, xmax, wavelengths):
+        """
+        :param w: complex array [slices, ..., n]
+        :param xmin: first point of the mesh [m]
+        :param xmax: last point of the mesh [m]
+        :param wavelengths: wavelength of every slice [m]
+        """
+        self.w = w
+        self.xmin, self.xmax = xmin, xmax
+        self.wavelengths = np.asarray(wavelengths, dtype='float64')
+        self.inv_r = 0.
+
+    @property
+    def n(self):
+        return self.w.shape[-1]
+
+    @property
+    def step(self):
+        return (self.xmax - self.xmin) / max(self.n - 1, 1)
+
+    def coords(self):
+        return np.linspace(self.xmin, self.xmax, self.n)
+
+    def per_slice(self, values):
+        # shape values of the slices for broadcasting with w
+        return np.reshape(values, (-1,) + (1,) * (self.w.ndim - 1))
+
+    def wave_numbers(self):
+        return self.per_slice(2 * np.pi / self.wavelengths)
+
+    def phase_factor(self, phase):
+        # exp(i phase) in the precision of the field
+        return np.exp(1j * phase).astype(np.result_type(self.w.dtype, np.complex64), copy=False)
+
+
+def interp_rows(x, w, x_new):
+    # linear interpolation along the last axis, zero outside of x
+    t = (x_new - x[0]) / (x[1] - x[0])
+    inside = (t >= 0) & (t <= len(x) - 1)
+    i = np.clip(np.floor(t).astype(int), 0, len(x) - 2)
+    frac = np.clip(t - i, 0., 1.).astype(w.real.dtype)
+    res = w[..., i] * (1 - frac) + w[..., i + 1] * frac
+    res[..., ~inside] = 0
+    return res
+
+
+def resize(f, zoom, sampling):
+    """
+    Change range and resolution of the mesh around its center, as SRW does before an element
+
+    :param f: Field1D
+    :param zoom: range factor
+    :param sampling: resolution factor
+    """
+    if zoom == 1 and sampling == 1:
+        return
+    center, half = (f.xmin + f.xmax) / 2., (f.xmax - f.xmin) / 2. * zoom
+    x_new = np.linspace(center - half, center + half, max(int(round(f.n * zoom * sampling)), 2))
+    f.w = interp_rows(f.coords(), f.w, x_new)
+    f.xmin, f.xmax = x_new[0], x_new[-1]
+
+
+def apply_curvature(f):
+    """
+    Multiply w by the quadratic phase kept analytically
+
+    :param f: Field1D
+    """
+    if f.inv_r != 0:
+        f.w = f.w * f.phase_factor(0.5 * f.wave_numbers() * f.coords()**2 * f.inv_r)
+        f.inv_r = 0.
+
+
+def _absorb_curvature(f):
+    # fit the quadratic phase of w and move it into inv_r, so that w is smooth for resizing and propagation
+    x = f.coords()
+    x_mid = (x[1:] + x[:-1]) / 2.
+    gradient = np.angle(f.w[..., 1:] * np.conj(f.w[..., :-1])) / f.step
+    weight = np.abs(f.w[..., 1:] * f.w[..., :-1])
+    kx = f.wave_numbers() * x_mid
+    total = weight.sum(axis=-1, keepdims=True)
+    total[total == 0] = 1.
+    gradient = gradient - (weight * gradient).sum(axis=-1, keepdims=True) / total
+    kx = kx - (weight * kx).sum(axis=-1, keepdims=True) / total
+    denominator = (weight * kx * kx).sum()
+    if denominator <= 0:
+        return
+    delta = (weight * gradient * kx).sum() / denominator
+    f.w = f.w * f.phase_factor(-0.5 * f.wave_numbers() * x**2 * delta)
+    f.inv_r += delta
+
+
+def _angular_spectrum(f, distance):
+    fx = np.fft.fftfreq(f.n, f.step)
+    f.w = ifft(fft(f.w) * f.phase_factor(-np.pi * f.per_slice(f.wavelengths) * distance * fx**2))
+
+
+def _chirp_dft(f, a, alpha, n_out):
+    # sum_j a[..., j] exp(-i alpha j m) for m < n_out with an FFT convolution (Bluestein)
+    n_in = a.shape[-1]
+    j, m = np.arange(n_in), np.arange(n_out)
+    t = np.arange(-(n_in - 1), n_out)
+    size = 1 << int(np.ceil(np.log2(n_in + len(t) - 1)))
+    conv = ifft(fft(a * f.phase_factor(-0.5 * alpha * j**2), size) * fft(f.phase_factor(0.5 * alpha * t**2), size))
+    return f.phase_factor(-0.5 * alpha * m**2) * conv[..., n_in - 1:n_in - 1 + n_out]
+
+
+def _spectral_width(f):
+    # spatial frequency range holding FRESNEL_ENERGY_FRACTION of the energy of w, all slices together
+    spectrum = (np.abs(fft(f.w))**2).reshape(-1, f.n).sum(axis=0)
+    fx = np.abs(np.fft.fftfreq(f.n, f.step))
+    order = np.argsort(fx)
+    cumulative = np.cumsum(spectrum[order])
+    if cumulative[-1] <= 0:
+        return 1. / (f.xmax - f.xmin)
+    i = min(np.searchsorted(cumulative, FRESNEL_ENERGY_FRACTION * cumulative[-1]), f.n - 1)
+    return 2 * fx[order][i]
+
+
+def _fresnel(f, distance, magnification):
+    # Fresnel integral evaluated on a mesh around the focus: the geometric image of the mesh
+    # widened by the diffraction of the angular spectrum
+    x1 = f.coords()
+    width = f.xmax - f.xmin
+    wavelength = f.wavelengths.max()
+    span = min(f.wavelengths.min() * distance / f.step,
+               abs(magnification) * width + wavelength * distance * _spectral_width(f))
+    x2 = np.linspace(-span / 2., span / 2., f.n)
+    dx2 = x2[1] - x2[0]
+    c = f.per_slice(2 * np.pi / (f.wavelengths * distance))
+    g = f.w * f.phase_factor(0.5 * f.wave_numbers() * x1**2 * (f.inv_r + 1. / distance) -
+                             c * f.step * x2[0] * np.arange(f.n))
+    res = _chirp_dft(f, g, c * f.step * dx2, f.n)
+    res *= f.phase_factor(-c * x1[0] * x2)
+    res *= (f.step / np.sqrt(f.per_slice(f.wavelengths) * distance)).astype(res.real.dtype)
+    f.w = res
+    f.xmin, f.xmax = x2[0], x2[-1]
+    f.inv_r = 1. / distance
+
+
+def drift(f, distance, semi_analytical):
+    """
+    Free space propagation
+
+    :param f: Field1D
+    :param distance: drift length [m]
+    :param semi_analytical: treat the quadratic phase analytically (Use_PP semi_analytical_treatment)
+    """
+    if not semi_analytical:
+        apply_curvature(f)
+        _angular_spectrum(f, distance)
+        return
+    _absorb_curvature(f)
+    magnification = 1. + distance * f.inv_r
+    width = f.xmax - f.xmin
+    if abs(magnification) * f.step * width > f.wavelengths.min() * distance:
+        # far from the focus: the drift of a curved wavefront is a shorter drift of w on a scaled mesh
+        _angular_spectrum(f, distance / magnification)
+        f.w /= np.sqrt(abs(magnification))
+        if magnification < 0:
+            f.w = f.w[..., ::-1]
+        f.xmin, f.xmax = sorted([f.xmin * magnification, f.xmax * magnification])
+        f.inv_r /= magnification
+    else:
+        _fresnel(f, distance, magnification)
+
+
+def apply_operation(f, op, semi_analytical):
+    """
+    Apply an operation from axis_operations to the field
+
+    :param f: Field1D
+    :param op: (name, parameters...)
+    :param semi_analytical: Use_PP semi_analytical_treatment for drifts
+    """
+    name = op[0]
+    if name == 'drift':
+        drift(f, op[1], semi_analytical)
+    elif name == 'window':
+        center, width = op[1], op[2]
+        f.w[..., np.abs(f.coords() - center) > width / 2.] = 0
+    elif name == 'lens':
+        f.inv_r -= 1. / op[1]
+    elif name == 'transmission':
+        coords, amplitude, opd, outside_zero = op[1:]
+        x = f.coords()
+        amplitude = np.interp(x, coords, amplitude)
+        if outside_zero:
+            amplitude[(x < coords[0]) | (x > coords[-1])] = 0
+        f.w = f.w * amplitude.astype(f.w.real.dtype) * f.phase_factor(f.wave_numbers() * np.interp(x, coords, opd))
+    else:
+        raise ValueError('Unknown operation {}'.format(name))
+
+
+def _nonzero(norm):
+    # slices without field keep zero factors
+    norm[norm == 0] = 1.
+    return norm
+
+
+def factorize(field, iterations=RANK1_ITERATIONS):
+    """
+    Leading singular pair of every slice by power iteration: field[s] ~ v[s] (outer) u[s]
+
+    :param field: complex array [slices, ny, nx]
+    :param iterations: number of power iterations
+    :return: (u [slices, nx], v [slices, ny], captured energy [slices], total energy [slices])
+    """
+    b = np.conj(field.sum(axis=1))
+    b[np.abs(b).sum(axis=1) == 0] = 1.
+    a = np.zeros(field.shape[:2], dtype=field.dtype)
+    sigma = np.zeros(field.shape[0])
+    for i in range(iterations):
+        b /= _nonzero(np.linalg.norm(b, axis=1, keepdims=True))
+        a = np.einsum('syx,sx->sy', field, b)
+        a /= _nonzero(np.linalg.norm(a, axis=1, keepdims=True))
+        b = np.einsum('syx,sy->sx', np.conj(field), a)
+        sigma = np.linalg.norm(b, axis=1)
+    total = (np.abs(field)**2).sum(axis=(1, 2))
+    return np.conj(b), a, sigma**2, total
+
+
+def propagate_separable(wfr, bl, strict=True, chunk_slices=CHUNK_SLICES):
+    """
+    Propagate a wavefront in frequency domain through a separable beamline
+
+    :param wfr: wavefront in frequency domain, not modified
+    :param bl: Beamline
+    :param strict: see separate_transmission
+    :param chunk_slices: number of slices reduced to 1D factors at once
+    :return: dict with x, y (meshes), image (frequency integrated intensity [ny, nx]), spectrum
+        (power per slice), energies (photon energy of the slices), fwhm, separability
+        (fraction of the field energy captured by the 1D factors) and wall_time
+    """
+    t0 = time.time()
+    steps = separable_beamline(bl, strict)
+    srwl_wf = wfr._srwl_wf
+    mesh = srwl_wf.mesh
+    energies = np.linspace(mesh.eStart, mesh.eFin, mesh.ne)
+    wavelengths = HC_EV_M / energies
+
+    # both polarizations are propagated together, as rows of the same 1D fields
+    us, vs, rows_wavelengths = [], [], []
+    captured = total = 0.
+    for name in ['arEx', 'arEy']:
+        field = np.frombuffer(getattr(srwl_wf, name), dtype=np.float32).reshape(mesh.ny, mesh.nx, mesh.ne, 2)
+        for i0 in range(0, mesh.ne, chunk_slices):
+            i1 = min(i0 + chunk_slices, mesh.ne)
+            chunk = field[:, :, i0:i1, :]
+            chunk = (chunk[..., 0] + 1j * chunk[..., 1]).transpose(2, 0, 1)
+            u, v, chunk_captured, chunk_total = factorize(chunk)
+            us.append(u)
+            vs.append(v)
+            rows_wavelengths.append(wavelengths[i0:i1])
+            captured += chunk_captured.sum()
+            total += chunk_total.sum()
+    rows_wavelengths = np.concatenate(rows_wavelengths)
+    fx = Field1D(np.concatenate(us), mesh.xStart, mesh.xFin, rows_wavelengths)
+    fy = Field1D(np.concatenate(vs), mesh.yStart, mesh.yFin, rows_wavelengths)
+
+    for step in steps:
+        pp = step['pp']
+        semi_analytical = pp['semi_analytical_treatment']
+        resize(fx, pp['zoom_h'], pp['sampling_h'])
+        resize(fy, pp['zoom_v'], pp['sampling_v'])
+        for op in step['x']:
+            apply_operation(fx, op, semi_analytical)
+        for op in step['y']:
+            apply_operation(fy, op, semi_analytical)
+
+    intensity_x = np.abs(fx.w)**2
+    intensity_y = np.abs(fy.w)**2
+    image = np.dot(intensity_y.T, intensity_x)
+    power = intensity_x.sum(axis=1) * fx.step * intensity_y.sum(axis=1) * fy.step
+    spectrum = power.reshape(-1, mesh.ne).sum(axis=0)
+    return {'x': (fx.xmin, fx.xmax, fx.n), 'y': (fy.xmin, fy.xmax, fy.n), 'image': image,
+            'spectrum': spectrum, 'energies': energies,
+            'fwhm': wf_metrics.fwhm(image, fx.xmin, fx.xmax, fy.xmin, fy.xmax),
+            'separability': captured / total if total > 0 else 1.,
+            'wall_time': time.time() - t0}
+
+
+def compare(result, ref_fname):
+    """
+    Compare the separable result with a 2D SRW propagation of the same pulse (prop_out file)
+
+    :param result: dict from propagate_separable
+    :param ref_fname: output file of propagateSE.py
+    :return: dict with fwhm_x, fwhm_y, ref_fwhm_x, ref_fwhm_y, profile_error_x, profile_error_y
+        (total variation distance of the normalized projections, 0 is identical, 1 is disjoint)
+        and ref_wall_time (from the manifest, None if not recorded)
+    """
+    import manifest
+    params, metrics = wf_metrics.metrics_from_hdf5(ref_fname)
+    ref_fwhm = metrics.fwhm(params['xMin'], params['xMax'], params['yMin'], params['yMax'])
+    comparison = {'fwhm_x': result['fwhm']['fwhm_x'], 'fwhm_y': result['fwhm']['fwhm_y'],
+                  'ref_fwhm_x': ref_fwhm['fwhm_x'], 'ref_fwhm_y': ref_fwhm['fwhm_y']}
+    comparison['profile_error_x'] = wf_metrics.projection_distance(
+        result['image'], result['x'][:2], metrics.image_total, (params['xMin'], params['xMax']), 0)
+    comparison['profile_error_y'] = wf_metrics.projection_distance(
+        result['image'], result['y'][:2], metrics.image_total, (params['yMin'], params['yMax']), 1)
+    record = manifest.Manifest(os.path.dirname(os.path.abspath(ref_fname))).records.get(os.path.abspath(ref_fname))
+    comparison['ref_wall_time'] = record['wall_time'] if record else None
+    return comparison
+
+
+def main():
+    import imp
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--input-file", dest="in_fname", help="Input wavefront file")
+    parser.add_option("--beamline-file", dest="beamline_file", default=None,
+                      help="Python file with get_beamline() definition, default is the built-in beamline")
+    parser.add_option("--scan-file", dest="scan_file", default=None,
+                      help="Python file with get_beamlines() definition, all variants are propagated")
+    parser.add_option("--reference", dest="ref_fname", default=None,
+                      help="Output file of propagateSE.py for the same input and beamline, "
+                           "the separable result is validated against it")
+    parser.add_option("--no-strict", dest="strict", action="store_false", default=True,
+                      help="Use the central cuts of transmission grids, which are not exactly separable")
+    (options, args) = parser.parse_args()
+    if not options.in_fname:
+        parser.error('Input filename not specified, use --input-file option')
+
+    import wpg
+    from propagateSE import load_get_beamline
+    if options.scan_file:
+        variants = imp.load_source('scan_file', options.scan_file).get_beamlines()
+    else:
+        variants = [('beamline', load_get_beamline(options.beamline_file)())]
+
+    wf = wpg.Wavefront()
+    wf.load_hdf5(options.in_fname)
+    wpg.srwlib.srwl.SetRepresElecField(wf._srwl_wf, 'f')
+
+    print('{:<24} {:>12} {:>12} {:>10} {:>12}'.format('variant', 'FWHM x [um]', 'FWHM y [um]', 'time [s]',
+                                                      'separability'))
+    for name, bl in variants:
+        try:
+            result = propagate_separable(wf, bl, options.strict)
+        except UnsupportedElement as exc:
+            print('{:<24} not separable: {}'.format(name, exc))
+            continue
+        print('{:<24} {:>12.3f} {:>12.3f} {:>10.2f} {:>12.4f}'.format(
+            name, result['fwhm']['fwhm_x'] * 1e6, result['fwhm']['fwhm_y'] * 1e6, result['wall_time'],
+            result['separability']))
+        if options.ref_fname:
+            comparison = compare(result, options.ref_fname)
+            print('{:<24} {:>12.3f} {:>12.3f} {:>10}'.format(
+                '2D reference', comparison['ref_fwhm_x'] * 1e6, comparison['ref_fwhm_y'] * 1e6,
+                '{:.2f}'.format(comparison['ref_wall_time']) if comparison['ref_wall_time'] else '-'))
+            print('Profile difference (total variation): x {:.4f}, y {:.4f}'.format(
+                comparison['profile_error_x'], comparison['profile_error_y']))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Intra-pulse parallelism: propagation of frequency-slice chunks in separate processes.
+
+In frequency domain the slices of a wavefront are independent monochromatic
+fields. propagate_slices splits them into chunks, propagates every chunk through
+the same beamline in a worker process and puts the propagated field back
+together. Workers are forked after the wavefront is loaded and take their chunk
+from the inherited parent memory, so only the propagated chunks are sent back.
+The per-process memory is limited by the chunk size.
+
+Pool workers of the batch mode are daemonic and cannot start their own workers,
+so this mode is used for single-file runs.
+"""
+import copy
+import multiprocessing
+from array import array
+
+import numpy as np
+
+# wavefront and beamline inherited by forked workers
+_source_wf = None
+_source_beamline = None
+
+
+def _fork_context():
+    # the workers need the inherited memory, whatever the default start method is
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing  # python 2 always forks
+
+
+def _field(srwl_wf, arr):
+    # SRW stores the field as [y][x][slice][re, im]
+    mesh = srwl_wf.mesh
+    return np.frombuffer(arr, dtype=np.float32).reshape(mesh.ny, mesh.nx, mesh.ne, 2)
+
+
+def _copy_without_field(srwl_wf):
+    arEx, arEy = srwl_wf.arEx, srwl_wf.arEy
+    srwl_wf.arEx, srwl_wf.arEy = array('f'), array('f')
+    try:
+        return copy.deepcopy(srwl_wf)
+    finally:
+        srwl_wf.arEx, srwl_wf.arEy = arEx, arEy
+
+
+def _slice_step(mesh):
+    return (mesh.eFin - mesh.eStart) / (mesh.ne - 1) if mesh.ne > 1 else 0.
+
+
+def sub_wavefront(srwl_wf, i0, i1):
+    """
+    Copy slices [i0, i1) of the wavefront into a new SRW wavefront
+
+    :param srwl_wf: SRWLWfr in frequency domain
+    :param i0: first slice
+    :param i1: slice after the last one
+    :return: SRWLWfr
+    """
+    mesh = srwl_wf.mesh
+    de = _slice_step(mesh)
+    sub = _copy_without_field(srwl_wf)
+    sub.allocate(i1 - i0, mesh.nx, mesh.ny)
+    sub.mesh.eStart = mesh.eStart + i0 * de
+    sub.mesh.eFin = mesh.eStart + (i1 - 1) * de
+    for name in ['arEx', 'arEy']:
+        _field(sub, getattr(sub, name))[:] = _field(srwl_wf, getattr(srwl_wf, name))[:, :, i0:i1, :]
+    return sub
+
+
+def _propagate_chunk(bounds):
+    import wpg
+    i0, i1 = bounds
+    sub = sub_wavefront(_source_wf, i0, i1)
+    _source_beamline.propagate(wpg.Wavefront(sub))
+    return i0, i1, sub
+
+
+def _transverse_mesh(mesh):
+    # the chunks differ only in the slices
+    return (mesh.nx, mesh.ny, mesh.xStart, mesh.xFin, mesh.yStart, mesh.yFin)
+
+
+def chunk_bounds(n_slices, chunk_size):
+    """
+    Split slices into chunks
+
+    :param n_slices: number of slices
+    :param chunk_size: maximal number of slices in a chunk
+    :return: list of (i0, i1)
+    """
+    return [(i0, min(i0 + chunk_size, n_slices)) for i0 in range(0, n_slices, chunk_size)]
+
+
+def propagate_slices(wf, bl, processes, chunk_size=None):
+    """
+    Propagate wavefront in frequency domain through the beamline, slice chunks in parallel
+
+    :param wf: wavefront in frequency domain, propagated in place
+    :param bl: Beamline
+    :param processes: number of worker processes
+    :param chunk_size: maximal number of slices propagated by a worker at once,
+        default is an even split between the processes
+    """
+    global _source_wf, _source_beamline
+    srwl_wf = wf._srwl_wf
+    mesh = srwl_wf.mesh
+    n_slices, e_start, e_fin = mesh.ne, mesh.eStart, mesh.eFin
+    if chunk_size is None:
+        chunk_size = -(-n_slices // processes)
+    bounds = chunk_bounds(n_slices, max(int(chunk_size), 1))
+
+    _source_wf, _source_beamline = srwl_wf, bl
+    pool = _fork_context().Pool(processes=min(processes, len(bounds)))
+    try:
+        result = None
+        for i0, i1, sub in pool.imap_unordered(_propagate_chunk, bounds):
+            if result is None:
+                result = _copy_without_field(sub)
+                result.allocate(n_slices, sub.mesh.nx, sub.mesh.ny)
+                result.mesh.eStart, result.mesh.eFin = e_start, e_fin
+            elif _transverse_mesh(sub.mesh) != _transverse_mesh(result.mesh):
+                raise ValueError('Slices {}-{} propagated to mesh {}, other slices to {}'.format(
+                    i0, i1 - 1, _transverse_mesh(sub.mesh), _transverse_mesh(result.mesh)))
+            for name in ['arEx', 'arEy']:
+                _field(result, getattr(result, name))[:, :, i0:i1, :] = _field(sub, getattr(sub, name))
+            print('Slices {}-{} of {} propagated'.format(i0, i1 - 1, n_slices))
+        pool.close()
+    except BaseException:
+        # also on a failed chunk, join() of a running pool would raise and hide the error
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _source_wf, _source_beamline = None, None
+
+    # keep the identity of the SRW wavefront, the WPG wavefront refers to it
+    vars(srwl_wf).update(vars(result))
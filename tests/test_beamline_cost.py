@@ -0,0 +1,72 @@
+"""
+Tests of the mesh and memory estimates along a beamline, run with
+python -m pytest tests
+"""
+import unittest
+
+import beamline_cost
+
+
+class Drift(object):
+    pass
+
+
+class Aperture(object):
+    pass
+
+
+class Beamline(object):
+    """
+    Stand-in for wpg.Beamline, only propagation_options is used
+    """
+
+    def __init__(self, elements):
+        self.propagation_options = [{'optical_elements': [oe for oe, pp in elements],
+                                     'propagation_parameters': [pp for oe, pp in elements]}]
+
+
+def use_pp(zoom=1., sampling=1., semi_analytical_treatment=0):
+    # the layout of SRW propagation parameters as created by wpg.optical_elements.Use_PP
+    pp = [0, 0, 1., semi_analytical_treatment, 0, 1., 1., 1., 1., 0, 0, 0]
+    pp[5] = pp[7] = zoom
+    pp[6] = pp[8] = sampling
+    return pp
+
+
+MESH = {'nx': 100, 'ny': 50, 'nSlices': 10, 'xMin': -1e-4, 'xMax': 1e-4, 'yMin': -1e-4, 'yMax': 1e-4}
+
+
+class MeshChainTest(unittest.TestCase):
+
+    def test_mesh_chain(self):
+        bl = Beamline([(Aperture(), use_pp()), (Drift(), use_pp(zoom=2., sampling=0.5)),
+                       (Drift(), use_pp(zoom=3.))])
+        chain = beamline_cost.mesh_chain(bl, 100, 50)
+        self.assertEqual([(s['element'], s['resized'], s['nx'], s['ny']) for s in chain],
+                         [('Aperture', False, 100, 50), ('Drift', True, 100, 50), ('Drift', True, 300, 150)])
+        self.assertEqual((chain[2]['nx_in'], chain[2]['ny_in']), (100, 50))
+        self.assertEqual(chain[1]['pp']['zoom_h'], 2.)
+
+    def test_peak_memory(self):
+        bl = Beamline([(Drift(), use_pp(zoom=2.))])
+        points = 100 * 50 + 200 * 100  # both meshes while resizing
+        field_bytes = points * 10 * beamline_cost.FIELD_BYTES_PER_POINT
+        self.assertEqual(beamline_cost.estimate_peak_memory(bl, MESH),
+                         int(field_bytes * beamline_cost.MEMORY_OVERHEAD) + beamline_cost.PROCESS_BASE_BYTES)
+
+    def test_transmission_grid(self):
+        aperture = Aperture()
+        aperture.arTr = [0.] * 1000
+        bl = Beamline([(aperture, use_pp())])
+        self.assertEqual(beamline_cost.transmission_bytes(bl), 8000)
+
+    def test_estimate_steps(self):
+        bl = Beamline([(Drift(), use_pp(zoom=4., sampling=0.1))])
+        step, = beamline_cost.estimate_steps(bl, MESH)
+        self.assertEqual((step['nx'], step['ny']), (40, 20))
+        self.assertTrue(any('aliasing' in w for w in step['warnings']))
+        self.assertGreater(beamline_cost.total_cost(bl, MESH), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
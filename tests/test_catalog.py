@@ -0,0 +1,91 @@
+"""
+Tests of the pulse catalog, run with
+python -m pytest tests
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import catalog
+
+MESH = {'nx': 64, 'ny': 32, 'nSlices': 10, 'xMin': -1e-4, 'xMax': 1e-4, 'yMin': -1e-4, 'yMax': 1e-4,
+        'sliceMin': -1e-14, 'sliceMax': 1e-14, 'photonEnergy': 8e3}
+
+
+class CatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dname = tempfile.mkdtemp()
+        self.database = os.path.join(self.dname, 'catalog.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.dname)
+
+    def row(self, name, fwhm_x=1e-6, finished=None):
+        out_fname = os.path.join(self.dname, name)
+        with open(out_fname, 'w') as f:
+            f.write('wavefront')
+        metrics = {'pulse_energy': 1e-3, 'fwhm_x': fwhm_x, 'fwhm_y': 2e-6, 'centroid_x': 0., 'centroid_y': 0.}
+        row = catalog.make_row('FELsource_out_1.h5', out_fname, 'abc', MESH, metrics, engine='srw')
+        if finished is not None:
+            row['finished'] = finished
+        return row
+
+    def query(self, **kwargs):
+        db = catalog.Catalog(self.dname, self.database)
+        try:
+            db.merge()
+            return db.query(**kwargs)[1]
+        finally:
+            db.close()
+
+    def test_merge_shards(self):
+        catalog.append_rows(self.dname, [self.row('prop_out_1.h5'), self.row('prop_out_2.h5')],
+                            catalog.shard_name('node1:1'))
+        catalog.append_rows(self.dname, [self.row('prop_out_3.h5', fwhm_x=9e-6)], catalog.shard_name('node2:1'))
+        self.assertEqual(self.query(columns='count(*)'), [(3,)])
+        self.assertEqual(self.query(columns='out_fname', where='fwhm_x > ?', params=(5e-6,)),
+                         [(os.path.join(self.dname, 'prop_out_3.h5'),)])
+
+    def test_incremental(self):
+        shard = catalog.shard_name('node1:1')
+        catalog.append_rows(self.dname, [self.row('prop_out_1.h5')], shard)
+        db = catalog.Catalog(self.dname, self.database)
+        try:
+            self.assertEqual(db.merge(), 1)
+            self.assertEqual(db.merge(), 0)
+            catalog.append_rows(self.dname, [self.row('prop_out_2.h5')], shard)
+            self.assertEqual(db.merge(), 1)
+            self.assertEqual(db.query(columns='count(*)')[1], [(2,)])
+        finally:
+            db.close()
+
+    def test_newer_row_wins(self):
+        # shards are merged in name order, the newer row of another shard is kept
+        catalog.append_rows(self.dname, [self.row('prop_out_1.h5', fwhm_x=2e-6, finished=2.)],
+                            catalog.shard_name('node1:1'))
+        catalog.append_rows(self.dname, [self.row('prop_out_1.h5', fwhm_x=1e-6, finished=1.)],
+                            catalog.shard_name('node2:1'))
+        self.assertEqual(self.query(columns='fwhm_x'), [(2e-6,)])
+
+    def test_line_being_written(self):
+        shard = catalog.shard_name('node1:1')
+        catalog.append_rows(self.dname, [self.row('prop_out_1.h5')], shard)
+        line = json.dumps(self.row('prop_out_2.h5'), sort_keys=True) + '\n'
+        with open(os.path.join(self.dname, shard), 'a') as f:
+            f.write(line[:20])
+        db = catalog.Catalog(self.dname, self.database)
+        try:
+            self.assertEqual(db.merge(), 1)
+            with open(os.path.join(self.dname, shard), 'a') as f:
+                f.write(line[20:])
+            # the line is read from its start once it is complete
+            self.assertEqual(db.merge(), 1)
+            self.assertEqual(db.query(columns='count(*)')[1], [(2,)])
+        finally:
+            db.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+Tests of the output layouts and levels, run with
+python -m pytest tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from array import array
+
+import h5py
+import numpy as np
+
+import h5_layout
+import wf_metrics
+from test_wf_metrics import PARAMS, gaussian_field, write_wavefront
+
+
+class Mesh(object):
+    pass
+
+
+class SRWLWfr(object):
+    pass
+
+
+class Wavefront(object):
+    """
+    Stand-in for wpg.Wavefront: the SRW field buffers and the mesh, stored like Wavefront.store_hdf5
+    """
+
+    def __init__(self, ehor, ever):
+        self._srwl_wf = SRWLWfr()
+        self._srwl_wf.arEx = array('f', ehor.tobytes())
+        self._srwl_wf.arEy = array('f', ever.tobytes())
+        mesh = self._srwl_wf.mesh = Mesh()
+        mesh.ny, mesh.nx, mesh.ne = ehor.shape[:3]
+        mesh.xStart, mesh.xFin, mesh.yStart, mesh.yFin = PARAMS['xMin'], PARAMS['xMax'], PARAMS['yMin'], PARAMS['yMax']
+        mesh.eStart, mesh.eFin = PARAMS['sliceMin'], PARAMS['sliceMax']
+
+    def store_hdf5(self, fname):
+        srwl_wf = self._srwl_wf
+        mesh = srwl_wf.mesh
+        shape = (mesh.ny, mesh.nx, mesh.ne, 2)
+        params = dict(PARAMS, nx=mesh.nx, ny=mesh.ny, nSlices=mesh.ne)
+        write_wavefront(fname, np.frombuffer(srwl_wf.arEx, dtype=np.float32).reshape(shape),
+                        np.frombuffer(srwl_wf.arEy, dtype=np.float32).reshape(shape), params)
+        with h5py.File(fname, 'a') as h5:
+            h5['misc/xFWHM'] = 1e-6
+            h5['history/parent/info'] = 'source'
+
+
+class StoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dname = tempfile.mkdtemp()
+        self.ehor, self.ever = gaussian_field(PARAMS['nx'], PARAMS['ny'], PARAMS['nSlices'])
+        self.expected = wf_metrics.FieldMetrics(PARAMS['nx'], PARAMS['ny'], PARAMS['nSlices'])
+        self.expected.add(self.ehor, self.ever, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dname)
+
+    def store(self, layout, level):
+        fname = os.path.join(self.dname, 'prop_out_{}.h5'.format(level))
+        wf = Wavefront(self.ehor, self.ever)
+        h5_layout.store(wf, fname, layout, level)
+        # the wavefront in memory is left as it was
+        self.assertEqual((wf._srwl_wf.mesh.nx, len(wf._srwl_wf.arEx)), (PARAMS['nx'], self.ehor.size))
+        return fname
+
+    def check_file(self, fname, level):
+        params, metrics = wf_metrics.metrics_from_hdf5(fname)
+        self.assertEqual(params, PARAMS)
+        np.testing.assert_allclose(metrics.image_total, self.expected.image_total, rtol=1e-5)
+        np.testing.assert_allclose(metrics.power_total, self.expected.power_total, rtol=1e-5)
+        with h5py.File(fname, 'r') as h5:
+            self.assertEqual(h5['misc/xFWHM'][()], 1e-6)
+            self.assertIn('history/parent/info', h5)
+            if level != 'full':
+                self.assertEqual(h5['data'].attrs['output_level'], level)
+                self.assertNotIn('arrEhor', h5['data'])
+
+    def test_full(self):
+        fname = self.store({}, 'full')
+        self.check_file(fname, 'full')
+
+    def test_compressed(self):
+        fname = self.store({'compression': 'gzip', 'chunk_slices': 8}, 'full')
+        self.check_file(fname, 'full')
+        with h5py.File(fname, 'r') as h5:
+            dset = h5['data/arrEhor']
+            self.assertEqual(dset.compression, 'gzip')
+            self.assertEqual(dset.chunks, (PARAMS['ny'], PARAMS['nx'], 8, 2))
+            np.testing.assert_array_equal(dset[()], self.ehor)
+
+    def test_intensity(self):
+        fname = self.store({'compression': 'lzf'}, 'intensity')
+        self.check_file(fname, 'intensity')
+        with h5py.File(fname, 'r') as h5:
+            self.assertEqual(h5['data/intensity'].shape, (PARAMS['ny'], PARAMS['nx'], PARAMS['nSlices']))
+
+    def test_summary(self):
+        fname = self.store({}, 'summary')
+        self.check_file(fname, 'summary')
+
+    def test_copy_file_levels(self):
+        src_fname = os.path.join(self.dname, 'prop_out_full.h5')
+        Wavefront(self.ehor, self.ever).store_hdf5(src_fname)
+        for level in h5_layout.OUTPUT_LEVELS:
+            fname = os.path.join(self.dname, 'prop_out_copy_{}.h5'.format(level))
+            h5_layout.copy_file(src_fname, fname, {'compression': 'gzip'}, level)
+            self.check_file(fname, level)
+
+
+class ChunkShapeTest(unittest.TestCase):
+
+    def test_chunk_shape(self):
+        self.assertEqual(h5_layout.chunk_shape((512, 512, 100, 2), 4), (512, 512, 2, 2))
+        self.assertEqual(h5_layout.chunk_shape((512, 512, 100, 2), 4, 16), (512, 512, 16, 2))
+        self.assertEqual(h5_layout.chunk_shape((8, 8, 10), 4, 100), (8, 8, 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
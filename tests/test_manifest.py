@@ -0,0 +1,108 @@
+"""
+Tests of the completion manifest, run with
+python -m pytest tests
+"""
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import manifest
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dname = tempfile.mkdtemp()
+        self.in_fname = os.path.join(self.dname, 'FELsource_out_0000001.h5')
+        self.out_fname = os.path.join(self.dname, 'prop_out_0000001.h5')
+        for fname in [self.in_fname, self.out_fname]:
+            with open(fname, 'w') as f:
+                f.write('wavefront')
+            # whole seconds survive os.utime on all platforms
+            os.utime(fname, (1500000000, 1500000000))
+
+    def tearDown(self):
+        shutil.rmtree(self.dname)
+
+    def add(self, checksum=False, name=manifest.MANIFEST_NAME):
+        done = manifest.Manifest(self.dname, name)
+        out_checksum = manifest.file_checksum(self.out_fname) if checksum else None
+        done.add(manifest.make_record(self.in_fname, self.out_fname, 'abc', out_checksum, 1.))
+
+    def is_done(self, bl_hash='abc', verify=False):
+        return manifest.Manifest(self.dname).is_done(self.in_fname, self.out_fname, bl_hash, verify)
+
+    def touch(self, fname, content='changed!!'):
+        # same size, later modification time
+        with open(fname, 'w') as f:
+            f.write(content)
+        mtime = time.time() + 10.
+        os.utime(fname, (mtime, mtime))
+
+    def test_done(self):
+        self.assertFalse(self.is_done())
+        self.add()
+        self.assertTrue(self.is_done())
+
+    def test_other_beamline(self):
+        self.add()
+        self.assertFalse(self.is_done(bl_hash='other'))
+
+    def test_changed_input(self):
+        self.add()
+        self.touch(self.in_fname)
+        self.assertFalse(self.is_done())
+
+    def test_changed_output(self):
+        self.add()
+        self.touch(self.out_fname, 'wavefront')
+        self.assertFalse(self.is_done())
+
+    def test_missing_output(self):
+        self.add()
+        os.remove(self.out_fname)
+        self.assertFalse(self.is_done())
+
+    def test_verify(self):
+        self.add(checksum=True)
+        self.assertTrue(self.is_done(verify=True))
+        # corrupted in place, with the recorded size and modification time
+        st = os.stat(self.out_fname)
+        with open(self.out_fname, 'w') as f:
+            f.write('corrupted')
+        os.utime(self.out_fname, (st.st_atime, st.st_mtime))
+        self.assertTrue(self.is_done())
+        self.assertFalse(self.is_done(verify=True))
+
+    def test_verify_without_checksum(self):
+        self.add()
+        self.assertTrue(self.is_done())
+        self.assertFalse(self.is_done(verify=True))
+
+    def test_legacy_record(self):
+        record = manifest.make_record(self.in_fname, self.out_fname, 'abc',
+                                      manifest.file_checksum(self.out_fname), 1.)
+        for key in ['out_size', 'out_mtime']:
+            del record[key]
+        with open(os.path.join(self.dname, manifest.MANIFEST_NAME), 'w') as f:
+            f.write(json.dumps(record) + '\n')
+        self.assertTrue(self.is_done())
+        self.touch(self.out_fname)
+        self.assertFalse(self.is_done())
+
+    def test_node_manifests(self):
+        self.add(name='prop_manifest.node2.jsonl')
+        self.assertTrue(self.is_done())
+
+    def test_truncated_line(self):
+        self.add()
+        with open(os.path.join(self.dname, manifest.MANIFEST_NAME), 'a') as f:
+            f.write('{"in_fname": ')
+        self.assertTrue(self.is_done())
+
+
+if __name__ == '__main__':
+    unittest.main()
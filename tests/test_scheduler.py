@@ -0,0 +1,128 @@
+"""
+Tests of the memory-aware scheduling of batch propagation, run with
+python -m pytest tests
+"""
+import multiprocessing
+import os
+import signal
+import time
+import unittest
+
+import scheduler
+
+
+def _fork_context():
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing  # python 2 always forks
+
+
+def _task(params):
+    in_fname, out_fname = params
+    if in_fname == 'killed':
+        os.kill(os.getpid(), signal.SIGKILL)
+    time.sleep(30. if in_fname == 'cancelled' else 0.1)
+    return params + (None, {})
+
+
+class FakeSource(scheduler.StaticSource):
+    """
+    Static source recording the memory of the pulses running when a pulse is admitted
+    """
+
+    def __init__(self, pulses, cancel=()):
+        scheduler.StaticSource.__init__(self, pulses)
+        self.memory = dict((params, memory) for memory, params in pulses)
+        self.cancel = set(cancel)
+        self.running = set()
+        self.admitted = []  # (params, memory of the running pulses before the start)
+        self.finished_pulses = []
+
+    def admit(self, params):
+        self.admitted.append((params, sum(self.memory[p] for p in self.running)))
+        self.running.add(params)
+        return True
+
+    def finish(self, params, error):
+        self.running.discard(params)
+        self.finished_pulses.append((params, error))
+
+    def cancelled(self):
+        return [(params, 'Cancelled') for params in self.running if params in self.cancel]
+
+
+def _pulse(name, memory):
+    return memory, (name, name + '.out')
+
+
+def _schedule(source, cpu_number, memory_budget=None):
+    pool = scheduler.start_pool(_fork_context(), cpu_number)
+    try:
+        return dict((r[0], r) for r in scheduler.schedule(pool, _task, source, cpu_number, memory_budget))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class ScheduleTest(unittest.TestCase):
+
+    def test_all_pulses(self):
+        source = FakeSource([_pulse(str(i), 1) for i in range(5)])
+        results = _schedule(source, 2)
+        self.assertEqual(sorted(results), [str(i) for i in range(5)])
+        self.assertEqual(len(source.finished_pulses), 5)
+        self.assertTrue(all(error is None for params, error in source.finished_pulses))
+
+    def test_memory_budget(self):
+        pulses = [_pulse('a', 6), _pulse('b', 5), _pulse('c', 4), _pulse('d', 3), _pulse('e', 1)]
+        source = FakeSource(pulses)
+        _schedule(source, 4, memory_budget=10)
+        # largest first, smaller pulses fill the rest of the budget
+        self.assertEqual(source.admitted[:2], [(('a', 'a.out'), 0), (('c', 'c.out'), 6)])
+        for params, used in source.admitted:
+            self.assertLessEqual(used + source.memory[params], 10)
+        self.assertEqual(len(source.finished_pulses), 5)
+
+    def test_pulse_over_budget_alone(self):
+        source = FakeSource([_pulse('big', 20), _pulse('a', 1), _pulse('b', 1)])
+        _schedule(source, 3, memory_budget=10)
+        self.assertEqual(source.admitted[0], (('big', 'big.out'), 0))
+        # the others wait until the big pulse is finished
+        self.assertEqual(dict(source.admitted)[('a', 'a.out')], 0)
+        self.assertEqual(len(source.finished_pulses), 3)
+
+    def test_cancelled(self):
+        source = FakeSource([_pulse('cancelled', 1), _pulse('a', 1)], cancel=[('cancelled', 'cancelled.out')])
+        t0 = time.time()
+        results = _schedule(source, 2)
+        self.assertLess(time.time() - t0, 20.)
+        self.assertEqual(results['cancelled'][2], 'Cancelled')
+        self.assertIsNone(results['a'][2])
+
+
+class KilledWorkerTest(unittest.TestCase):
+
+    def test_killed_worker(self):
+        source = scheduler.StaticSource([(0, ('pulse', 'pulse.out')), (0, ('killed', 'killed.out'))])
+        pool = scheduler.start_pool(_fork_context(), 2)
+        try:
+            results = dict((r[0], r) for r in scheduler.schedule(pool, _task, source, 2))
+        finally:
+            pool.terminate()
+            pool.join()
+        self.assertEqual(results['pulse'], ('pulse', 'pulse.out', None, {}))
+        self.assertIn('died', results['killed'][2])
+        self.assertIsNone(results['killed'][3])
+
+    def test_alive_workers(self):
+        pool = scheduler.start_pool(_fork_context(), 2)
+        try:
+            self.assertEqual(len(scheduler.alive_workers(pool)), 2)
+        finally:
+            pool.terminate()
+            pool.join()
+        self.assertIsNone(scheduler.alive_workers(object()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+"""
+Tests of the separable quick-look propagation, run with
+python -m pytest tests
+"""
+import unittest
+
+import numpy as np
+
+import separable
+
+
+class FactorizeTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.u = rng.randn(3, 20) + 1j * rng.randn(3, 20)
+        self.v = rng.randn(3, 10) + 1j * rng.randn(3, 10)
+
+    def test_separable_field(self):
+        field = self.v[:, :, None] * self.u[:, None, :]
+        u, v, captured, total = separable.factorize(field)
+        np.testing.assert_allclose(captured, total, rtol=1e-6)
+        np.testing.assert_allclose(v[:, :, None] * u[:, None, :], field, rtol=1e-6, atol=1e-12)
+
+    def test_non_separable_field(self):
+        field = self.v[:, :, None] * self.u[:, None, :]
+        field[:, ::2, :] += self.v[:, ::2, None] * self.u[:, None, ::-1]
+        u, v, captured, total = separable.factorize(field)
+        self.assertTrue(np.all(captured < 0.99 * total))
+        self.assertTrue(np.all(captured > 0.))
+
+    def test_empty_slice(self):
+        field = self.v[:, :, None] * self.u[:, None, :]
+        field[1] = 0.
+        u, v, captured, total = separable.factorize(field)
+        self.assertEqual((captured[1], total[1]), (0., 0.))
+        self.assertFalse(np.isnan(u).any() or np.isnan(v).any())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+"""
+Tests of the single-pass field reductions, run with
+python -m pytest tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+import wf_metrics
+
+PARAMS = {'nx': 40, 'ny': 30, 'nSlices': 20, 'xMin': -2e-4, 'xMax': 2e-4, 'yMin': -1e-4, 'yMax': 1e-4,
+          'sliceMin': -1e-14, 'sliceMax': 1e-14, 'photonEnergy': 8e3}
+
+
+def gaussian_field(nx, ny, n_slices, sigma=0.2, seed=0):
+    """
+    :return: ehor, ever [ny, nx, n_slices, 2] float32, gaussian beam with a random temporal structure
+    """
+    rng = np.random.RandomState(seed)
+    x = np.linspace(-1., 1., nx)
+    y = np.linspace(-1., 1., ny)
+    xx, yy = np.meshgrid(x, y)
+    transverse = np.exp(-(xx**2 + yy**2) / (4 * sigma**2))
+    temporal = rng.randn(n_slices) + 1j * rng.randn(n_slices)
+    field = (transverse[:, :, None] * temporal[None, None, :]).astype(np.complex64)
+    ehor = field.view(np.float32).reshape(ny, nx, n_slices, 2)
+    return ehor, 0.1 * ehor
+
+
+def write_wavefront(fname, ehor, ever, params=PARAMS):
+    """
+    Write the field and the mesh in the layout of Wavefront.store_hdf5
+    """
+    with h5py.File(fname, 'w') as h5:
+        for key in ['nx', 'ny', 'nSlices', 'xMin', 'xMax', 'yMin', 'yMax', 'sliceMin', 'sliceMax']:
+            h5['params/Mesh/' + key] = params[key]
+        h5['params/photonEnergy'] = params['photonEnergy']
+        h5['data/arrEhor'] = ehor
+        h5['data/arrEver'] = ever
+
+
+class FieldMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ehor, self.ever = gaussian_field(PARAMS['nx'], PARAMS['ny'], PARAMS['nSlices'])
+
+    def test_chunks(self):
+        whole = wf_metrics.FieldMetrics(PARAMS['nx'], PARAMS['ny'], PARAMS['nSlices'])
+        whole.add(self.ehor, self.ever, 0)
+        chunked = wf_metrics.FieldMetrics(PARAMS['nx'], PARAMS['ny'], PARAMS['nSlices'])
+        for i0 in range(0, PARAMS['nSlices'], 7):
+            chunked.add(self.ehor[:, :, i0:i0 + 7, :], self.ever[:, :, i0:i0 + 7, :], i0)
+        for name in ['image_hor', 'image_total', 'power_hor', 'power_total', 'on_axis_hor']:
+            np.testing.assert_allclose(getattr(chunked, name), getattr(whole, name), rtol=1e-5)
+        self.assertAlmostEqual(chunked.max_hor, whole.max_hor, places=3)
+
+    def test_intensity(self):
+        metrics = wf_metrics.FieldMetrics(PARAMS['nx'], PARAMS['ny'], PARAMS['nSlices'])
+        metrics.add(self.ehor, self.ever, 0)
+        expected = (np.abs(self.ehor[..., 0] + 1j * self.ehor[..., 1])**2 +
+                    np.abs(self.ever[..., 0] + 1j * self.ever[..., 1])**2)
+        np.testing.assert_allclose(metrics.image_total, expected.sum(axis=-1), rtol=1e-5)
+        np.testing.assert_allclose(metrics.power_total, expected.sum(axis=(0, 1)), rtol=1e-5)
+
+    def test_fwhm_interpolated(self):
+        x = np.linspace(-1., 1., 201)
+        sigma = 0.1
+        image = np.exp(-x**2 / (2 * sigma**2))[None, :] * np.ones((3, 1))
+        res = wf_metrics.fwhm_interpolated(image, -1., 1., -1., 1.)
+        self.assertAlmostEqual(res['fwhm_x'], 2 * np.sqrt(2 * np.log(2)) * sigma, places=3)
+
+    def test_centroid(self):
+        image = np.zeros((3, 5))
+        image[2, 4] = 1.
+        metrics = wf_metrics.FieldMetrics(5, 3, 1)
+        metrics.image_total[:] = image
+        self.assertEqual(metrics.centroid(-1., 1., -1., 1.), {'x': 1., 'y': 1.})
+
+
+class MetricsFromHdf5Test(unittest.TestCase):
+
+    def setUp(self):
+        self.dname = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dname, 'prop_out_0000001.h5')
+        self.ehor, self.ever = gaussian_field(PARAMS['nx'], PARAMS['ny'], PARAMS['nSlices'])
+        write_wavefront(self.fname, self.ehor, self.ever)
+
+    def tearDown(self):
+        shutil.rmtree(self.dname)
+
+    def test_metrics_from_hdf5(self):
+        slices = []
+        params, metrics = wf_metrics.metrics_from_hdf5(
+            self.fname, chunk_slices=6, chunk_callback=lambda ehor, ever, i0: slices.append((i0, ehor.shape[2])))
+        self.assertEqual(params, PARAMS)
+        self.assertEqual(slices, [(0, 6), (6, 6), (12, 6), (18, 2)])
+        expected = wf_metrics.FieldMetrics(PARAMS['nx'], PARAMS['ny'], PARAMS['nSlices'])
+        expected.add(self.ehor, self.ever, 0)
+        np.testing.assert_allclose(metrics.image_total, expected.image_total, rtol=1e-5)
+        np.testing.assert_allclose(metrics.power_total, expected.power_total, rtol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
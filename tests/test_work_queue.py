@@ -0,0 +1,103 @@
+"""
+Tests of the shared-filesystem work queue, run with
+python -m pytest tests
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import work_queue
+
+SIGNATURE = {'in_size': 1, 'in_mtime': 2., 'beamline_hash': 'abc'}
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dname = tempfile.mkdtemp()
+        self.node1 = work_queue.WorkQueue(self.dname, lease_timeout=60., owner='node1:1')
+        self.node2 = work_queue.WorkQueue(self.dname, lease_timeout=60., owner='node2:1')
+
+    def tearDown(self):
+        shutil.rmtree(self.dname)
+
+    def expire(self, key):
+        # a lease last renewed long ago, e.g. by a crashed node
+        old = time.time() - 3600.
+        os.utime(os.path.join(self.dname, key + '.lock'), (old, old))
+
+    def test_claim(self):
+        self.assertEqual(self.node1.state('pulse', SIGNATURE), 'free')
+        self.assertTrue(self.node1.claim('pulse'))
+        self.assertEqual(self.node2.state('pulse', SIGNATURE), 'locked')
+        self.assertFalse(self.node2.claim('pulse'))
+        self.assertEqual(self.node1.held, set(['pulse']))
+        self.assertEqual(self.node2.held, set())
+
+    def test_release_done(self):
+        self.node1.claim('pulse')
+        self.node1.release('pulse', 'done', SIGNATURE)
+        self.assertEqual(self.node2.state('pulse', SIGNATURE), 'done')
+        self.assertEqual(self.node2.state('pulse', dict(SIGNATURE, beamline_hash='other')), 'free')
+        self.assertFalse(os.path.exists(os.path.join(self.dname, 'pulse.lock')))
+        self.assertEqual(self.node1.held, set())
+
+    def test_release_failed(self):
+        self.node1.claim('pulse')
+        self.node1.release('pulse', 'failed', SIGNATURE, {'error': 'Traceback'})
+        self.assertEqual(self.node2.state('pulse', SIGNATURE), 'failed')
+
+    def test_release_back_to_queue(self):
+        self.node1.claim('pulse')
+        self.node1.release('pulse')
+        self.assertEqual(self.node2.state('pulse', SIGNATURE), 'free')
+        self.assertTrue(self.node2.claim('pulse'))
+
+    def test_release_not_owner(self):
+        self.node1.claim('pulse')
+        self.node2.release('pulse', 'done', SIGNATURE)
+        self.assertEqual(self.node1.state('pulse', SIGNATURE), 'locked')
+        self.assertFalse(os.path.exists(os.path.join(self.dname, 'pulse.done')))
+
+    def test_takeover_expired(self):
+        self.node1.claim('pulse')
+        self.expire('pulse')
+        self.assertEqual(self.node2.state('pulse', SIGNATURE), 'free')
+        self.assertTrue(self.node2.claim('pulse'))
+        self.assertEqual([name for name in os.listdir(self.dname) if name.endswith('.stale')], [])
+
+        # the old owner finds the lease lost when renewing and leaves the pulse to the new owner
+        self.node1.renew()
+        self.assertEqual(self.node1.held, set())
+        self.assertEqual(self.node1.lost, set(['pulse']))
+        self.node1.release('pulse', 'failed', SIGNATURE)
+        self.assertEqual(self.node1.lost, set())
+        self.assertEqual(self.node2.state('pulse', SIGNATURE), 'locked')
+        self.node2.release('pulse', 'done', SIGNATURE)
+        self.assertEqual(self.node1.state('pulse', SIGNATURE), 'done')
+
+    def test_no_takeover_of_renewed(self):
+        self.node1.claim('pulse')
+        self.node1.renew()
+        self.assertFalse(self.node2.claim('pulse'))
+        self.assertEqual(self.node1.held, set(['pulse']))
+        self.assertEqual(self.node1.lost, set())
+
+    def test_renew(self):
+        self.node1.claim('pulse')
+        self.expire('pulse')
+        self.node1.renew()
+        self.assertEqual(self.node2.state('pulse', SIGNATURE), 'locked')
+
+    def test_close(self):
+        self.node1.sync_clock()
+        self.node1.claim('pulse')
+        self.node1.close()
+        self.assertEqual(self.node2.state('pulse', SIGNATURE), 'free')
+        self.assertEqual([name for name in os.listdir(self.dname) if name.startswith('.clock.node1')], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
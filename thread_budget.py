@@ -0,0 +1,100 @@
+"""
+Division of the CPU cores between worker processes and threads inside the workers.
+
+SRW (OpenMP, FFTW) and the BLAS libraries size their thread pools from the
+environment (OMP_NUM_THREADS etc.) when they are loaded. set_threads puts the
+number of threads per worker into the environment, inherited by the forked
+workers; if SRW is already loaded in the process, the setting takes effect only
+after restart() executes the script again with the new environment.
+
+auto_split chooses the number of workers and threads per worker for a batch:
+pulses run in parallel as far as there are pulses, cores and memory for them,
+the remaining cores are shared as threads by the running pulses. Small pulses
+get fewer threads, as the overhead of threads exceeds their gain below
+MIN_POINTS_PER_THREAD points per slice and thread.
+"""
+import multiprocessing
+import os
+import sys
+
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS',
+                   'VECLIB_MAXIMUM_THREADS']
+# set by set_threads, a restarted process finds the threads it was restarted with
+CONFIGURED_ENV = 'PROP_THREADS_PER_WORKER'
+MIN_POINTS_PER_THREAD = 2**16
+
+
+def srw_loaded():
+    """
+    :return: True if the SRW extension module is loaded in this process
+    """
+    return any(name == 'srwlpy' or name.endswith('.srwlpy') for name in list(sys.modules))
+
+
+def configured_threads():
+    """
+    :return: number of threads per worker set by set_threads before a restart, None if not set
+    """
+    value = os.environ.get(CONFIGURED_ENV)
+    return int(value) if value else None
+
+
+def set_threads(threads):
+    """
+    Set the number of threads of SRW and the numerical libraries loaded from now on
+
+    :param threads: number of threads per worker
+    :return: True if the setting takes effect in this process, False if SRW is loaded with another setting
+        and the process has to be restarted, see restart
+    """
+    in_effect = configured_threads() == threads or not srw_loaded()
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(threads)
+    os.environ[CONFIGURED_ENV] = str(threads)
+    return in_effect
+
+
+def restart():
+    """
+    Execute the running script again with the same arguments and the current environment, does not return
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+def auto_threads(workers, points_per_slice=None, cpu_count=None):
+    """
+    Threads per worker sharing the cores between the workers
+
+    :param workers: number of pulses propagated at once
+    :param points_per_slice: largest mesh of the pulses nx*ny, None for no limit
+    :param cpu_count: number of cores, default all
+    :return: number of threads
+    """
+    cpu_count = cpu_count or multiprocessing.cpu_count()
+    threads = max(cpu_count // max(workers, 1), 1)
+    if points_per_slice is not None:
+        threads = min(threads, max(points_per_slice // MIN_POINTS_PER_THREAD, 1))
+    return threads
+
+
+def auto_split(max_workers, pulses=None, memory_estimate=None, memory_budget=None, points_per_slice=None,
+               cpu_count=None):
+    """
+    Number of workers and threads per worker for a batch
+
+    :param max_workers: maximal number of workers, e.g. --cpu-number
+    :param pulses: number of pulses to propagate, None if unknown (watch mode, shared queue)
+    :param memory_estimate: estimated peak memory of the largest pulse [bytes], see beamline_cost
+    :param memory_budget: memory for all running pulses [bytes], None for no limit
+    :param points_per_slice: largest mesh of the pulses nx*ny
+    :param cpu_count: number of cores, default all
+    :return: (workers, threads)
+    """
+    workers = max(max_workers, 1)
+    if pulses is not None:
+        workers = min(workers, max(pulses, 1))
+    if memory_estimate and memory_budget is not None:
+        workers = min(workers, max(int(memory_budget // memory_estimate), 1))
+    return workers, auto_threads(workers, points_per_slice, cpu_count)
@@ -0,0 +1,383 @@
+"""
+Automatic tuning of the Use_PP zoom and sampling of a beamline.
+
+A representative input pulse is propagated through a high resolution reference:
+the beamline with the range (zoom) and the resolution (sampling) of the mesh
+increased at the first element, so that every later mesh is larger and finer
+by the same factors. Then the zoom and the sampling of every resizing element
+are changed in propagation order, in steps of STEP for the horizontal and the
+vertical direction together: decreased as long as the result stays within the
+tolerance of the reference, or increased until it gets within the tolerance,
+if the beamline as given is not accurate enough. A result is within the
+tolerance if the propagated energy and the FWHM of the integrated intensity at
+the end of the beamline (the focal spot, interpolated between the mesh points,
+see wf_metrics.fwhm_interpolated) agree with the reference.
+
+The tuned zoom and sampling are written as a beamline file for --beamline-file
+of propagateSE.py, which applies them to the original beamline, and printed as
+Use_PP calls. Every propagation is listed in a table with the relative cost
+(see beamline_cost), the run time and the errors.
+
+Usage:
+python tune_pp.py --input-file FELsource_out_0000001.h5 --max-slices 40 --output tuned_beamline.py
+"""
+import copy
+import json
+import os
+import time
+from array import array
+
+import numpy as np
+
+import beamline_cost
+import wf_metrics
+
+DEFAULT_ENERGY_TOLERANCE = 0.01
+DEFAULT_FWHM_TOLERANCE = 0.05
+DEFAULT_REFERENCE_ZOOM = 1.5
+DEFAULT_REFERENCE_SAMPLING = 2.
+# zoom and sampling are multiplied or divided by STEP
+STEP = 1.25
+MAX_STEPS = 8
+SWEEPS = 2
+# an increase is kept only if it reduces the error at least by this factor
+IMPROVEMENT = 0.8
+# candidates with fewer points per axis at any element are not tried
+MIN_POINTS = 32
+
+
+def select_slices(wfr, max_slices):
+    """
+    Keep every n-th frequency slice of a wavefront in frequency domain, to tune on a smaller pulse
+
+    :param wfr: wavefront in frequency domain, changed in place
+    :param max_slices: maximal number of slices kept
+    """
+    srwl_wf = wfr._srwl_wf
+    mesh = srwl_wf.mesh
+    step = -(-mesh.ne // max_slices)
+    if step <= 1:
+        return
+    ne = len(range(0, mesh.ne, step))
+    shape = (mesh.ny, mesh.nx, mesh.ne, 2)
+    for name in ['arEx', 'arEy']:
+        field = np.frombuffer(getattr(srwl_wf, name), dtype=np.float32).reshape(shape)
+        setattr(srwl_wf, name, array('f', field[:, :, ::step, :].tobytes()))
+    de = (mesh.eFin - mesh.eStart) / (mesh.ne - 1)
+    mesh.eFin = mesh.eStart + (ne - 1) * step * de
+    mesh.ne = ne
+
+
+def with_factors(bl, factors):
+    """
+    Copy of the beamline with changed propagation parameters
+
+    :param bl: Beamline
+    :param factors: dict element index: dict of zoom_h, sampling_h, zoom_v, sampling_v (see beamline_cost.pp_factors)
+    :return: Beamline
+    """
+    import wpg
+    res = wpg.Beamline()
+    for i, (oe, pp) in enumerate(beamline_cost.iter_elements(bl)):
+        pp = list(pp)
+        for key, value in factors.get(i, {}).items():
+            pp[beamline_cost.PP_INDEX[key]] = value
+        res.append(oe, pp)
+    return res
+
+
+def tuned_beamline(beamline_file, factors):
+    """
+    Beamline with tuned zoom and sampling, used by the beamline files written by write_beamline
+
+    :param beamline_file: python file with get_beamline() definition, None for the built-in beamline
+    :param factors: see with_factors
+    :return: Beamline
+    """
+    from propagateSE import load_get_beamline
+    return with_factors(load_get_beamline(beamline_file)(), factors)
+
+
+def wavefront_mesh(wfr):
+    """
+    :param wfr: wavefront
+    :return: dict with nx, ny, nSlices as from beamline_cost.read_mesh
+    """
+    mesh = wfr._srwl_wf.mesh
+    return {'nx': mesh.nx, 'ny': mesh.ny, 'nSlices': mesh.ne}
+
+
+def evaluate(wfr, bl, engine='srw'):
+    """
+    Propagate a copy of the wavefront and reduce the result
+
+    :param wfr: wavefront in frequency domain, not modified
+    :param bl: Beamline
+    :param engine: 'srw' or 'fft', see propagateSE.propagate_beamline
+    :return: dict with wall_time, nx, ny, energy, fwhm_x, fwhm_y
+    """
+    from propagateSE import propagate_beamline
+    wf = copy.deepcopy(wfr)
+    t0 = time.time()
+    propagate_beamline(wf, bl, engine=engine)
+    wall_time = time.time() - t0
+    mesh = wf._srwl_wf.mesh
+    metrics = wf_metrics.metrics_from_wavefront(wf)
+    del wf
+    dx = (mesh.xFin - mesh.xStart) / max(mesh.nx - 1, 1)
+    dy = (mesh.yFin - mesh.yStart) / max(mesh.ny - 1, 1)
+    res = {'wall_time': wall_time, 'nx': mesh.nx, 'ny': mesh.ny,
+           'energy': float(metrics.power_total.sum() * dx * dy)}
+    res.update(wf_metrics.fwhm_interpolated(metrics.image_total, mesh.xStart, mesh.xFin, mesh.yStart, mesh.yFin))
+    return res
+
+
+def compare(res, reference, energy_tolerance, fwhm_tolerance):
+    """
+    Errors of a result with respect to the reference
+
+    :param res: result of evaluate
+    :param reference: result of evaluate for the reference beamline
+    :param energy_tolerance: maximal relative error of the energy
+    :param fwhm_tolerance: maximal relative error of the FWHM
+    :return: dict with energy_error, fwhm_x_error, fwhm_y_error (relative), excess (largest error in units of
+        its tolerance) and accepted (excess <= 1)
+    """
+    ref_energy = reference['energy']
+    errors = {'energy_error': res['energy'] / ref_energy - 1 if ref_energy else float('nan')}
+    excess = [abs(errors['energy_error']) / energy_tolerance]
+    for axis in ['x', 'y']:
+        ref_fwhm = reference['fwhm_' + axis]
+        error = res['fwhm_' + axis] / ref_fwhm - 1 if ref_fwhm else float('nan')
+        errors['fwhm_{}_error'.format(axis)] = error
+        excess.append(abs(error) / fwhm_tolerance)
+    errors['excess'] = max(excess) if not any(np.isnan(excess)) else float('nan')
+    errors['accepted'] = bool(errors['excess'] <= 1)
+    return errors
+
+
+def _factors(base, exponents):
+    # zoom and sampling of the elements with exponents != 0, rounded to 4 digits
+    factors = {}
+    for (i, param), k in exponents.items():
+        if k == 0:
+            continue
+        f = factors.setdefault(i, {})
+        for axis in ['h', 'v']:
+            key = '{}_{}'.format(param, axis)
+            f[key] = float('{:.4g}'.format(base[i][key] * STEP**k))
+    return factors
+
+
+def _too_small(bl, mesh):
+    return any(min(step['nx'], step['ny']) < MIN_POINTS for step in beamline_cost.mesh_chain(bl, mesh['nx'], mesh['ny']))
+
+
+def tune(wfr, bl, engine='srw', energy_tolerance=DEFAULT_ENERGY_TOLERANCE, fwhm_tolerance=DEFAULT_FWHM_TOLERANCE,
+         reference_zoom=DEFAULT_REFERENCE_ZOOM, reference_sampling=DEFAULT_REFERENCE_SAMPLING, all_elements=False,
+         max_steps=MAX_STEPS, sweeps=SWEEPS, verbose=True):
+    """
+    Search the cheapest zoom and sampling of every resizing element within the tolerance of the reference
+
+    :param wfr: representative wavefront in frequency domain, not modified
+    :param bl: Beamline
+    :param engine: 'srw' or 'fft', see propagateSE.propagate_beamline
+    :param energy_tolerance: maximal relative error of the propagated energy
+    :param fwhm_tolerance: maximal relative error of the FWHM at the end of the beamline
+    :param reference_zoom: zoom of the reference at the first element
+    :param reference_sampling: sampling of the reference at the first element
+    :param all_elements: tune all elements, not only the ones, which resize the mesh
+    :param max_steps: maximal number of steps of one parameter
+    :param sweeps: maximal number of passes over the elements, a pass without change ends the search
+    :param verbose: print every propagation
+    :return: (factors, rows), factors of the tuned beamline (see with_factors), rows of the table (see format_row)
+    """
+    mesh = wavefront_mesh(wfr)
+    base = [beamline_cost.pp_factors(pp) for oe, pp in beamline_cost.iter_elements(bl)]
+    names = [oe.__class__.__name__ for oe, pp in beamline_cost.iter_elements(bl)]
+    base_cost = beamline_cost.total_cost(bl, mesh)
+    rows = []
+
+    def run(label, element, factors):
+        candidate = with_factors(bl, factors)
+        res = evaluate(wfr, candidate, engine)
+        f = beamline_cost.pp_factors(list(beamline_cost.iter_elements(candidate))[element][1]) \
+            if element is not None else {}
+        row = {'label': label, 'element': element, 'name': names[element] if element is not None else '',
+               'zoom_h': f.get('zoom_h'), 'sampling_h': f.get('sampling_h'),
+               'zoom_v': f.get('zoom_v'), 'sampling_v': f.get('sampling_v'),
+               'cost': beamline_cost.total_cost(candidate, mesh) / base_cost}
+        row.update(res)
+        row.update(compare(res, res if reference is None else reference, energy_tolerance, fwhm_tolerance))
+        rows.append(row)
+        if verbose:
+            print(format_row(row))
+        return row
+
+    if verbose:
+        print(format_header())
+    reference = None
+    reference_factors = {0: {'zoom_h': base[0]['zoom_h'] * reference_zoom,
+                             'zoom_v': base[0]['zoom_v'] * reference_zoom,
+                             'sampling_h': base[0]['sampling_h'] * reference_sampling,
+                             'sampling_v': base[0]['sampling_v'] * reference_sampling}}
+    reference = run('reference', 0, reference_factors)
+    current = run('original', None, {})
+
+    exponents = {}
+    tunable = [i for i, f in enumerate(base) if all_elements or
+               f['zoom_h'] != 1 or f['sampling_h'] != 1 or f['zoom_v'] != 1 or f['sampling_v'] != 1]
+    for sweep in range(sweeps):
+        changed = False
+        for i in tunable:
+            for param in ['sampling', 'zoom']:
+                direction = -1 if current['accepted'] else 1
+                for step in range(max_steps):
+                    trial = dict(exponents)
+                    trial[(i, param)] = trial.get((i, param), 0) + direction
+                    factors = _factors(base, trial)
+                    if _too_small(with_factors(bl, factors), mesh):
+                        break
+                    row = run('{} {}'.format(param, 'down' if direction < 0 else 'up'), i, factors)
+                    if direction < 0 and not row['accepted']:
+                        break
+                    if direction > 0 and not row['excess'] < IMPROVEMENT * current['excess']:
+                        # more points at this element do not help
+                        break
+                    exponents, current, changed = trial, row, True
+                    if direction > 0 and row['accepted']:
+                        break
+        if not changed:
+            break
+    factors = _factors(base, exponents)
+    row = dict(current, label='tuned', element=None, name='',
+               zoom_h=None, sampling_h=None, zoom_v=None, sampling_v=None)
+    rows.append(row)
+    if verbose:
+        print(format_row(row))
+    return factors, rows
+
+
+def format_header():
+    return '{:<13} {:>3} {:<16} {:>7} {:>8} {:>7} {:>8} {:>7} {:>9} {:>8} {:>8} {:>8} {:>4}'.format(
+        'step', 'el', 'element', 'zoom_h', 'samp_h', 'zoom_v', 'samp_v', 'cost', 'time [s]',
+        'energy', 'fwhm x', 'fwhm y', 'ok')
+
+
+def format_row(row):
+    """
+    :param row: row of the table from tune
+    :return: line of the speed/accuracy table, errors relative to the reference
+    """
+    def value(key, width=7, spec='.4g'):
+        if row.get(key) is None:
+            return '-'.rjust(width)
+        return format(row[key], spec).rjust(width)
+
+    return '{:<13} {:>3} {:<16} {} {} {} {} {:>7.3f} {:>9.2f} {} {} {} {:>4}'.format(
+        row['label'], '-' if row['element'] is None else row['element'], row['name'][:16],
+        value('zoom_h'), value('sampling_h', 8), value('zoom_v'), value('sampling_v', 8),
+        row['cost'], row['wall_time'], value('energy_error', 8, '+.4f'),
+        value('fwhm_x_error', 8, '+.4f'), value('fwhm_y_error', 8, '+.4f'),
+        {True: 'yes', False: 'no'}.get(row.get('accepted'), '-'))
+
+
+def format_pp(bl, factors):
+    """
+    :param bl: original Beamline
+    :param factors: tuned factors from tune
+    :return: Use_PP calls of the tuned elements, one per line
+    """
+    lines = []
+    for i, (oe, pp) in enumerate(beamline_cost.iter_elements(bl)):
+        if i not in factors:
+            continue
+        f = beamline_cost.pp_factors(pp)
+        f.update(factors[i])
+        lines.append('element {} ({}): Use_PP(semi_analytical_treatment={semi_analytical_treatment}, '
+                     'zoom_h={zoom_h:.4g}, sampling_h={sampling_h:.4g}, '
+                     'zoom_v={zoom_v:.4g}, sampling_v={sampling_v:.4g})'.format(i, oe.__class__.__name__, **f))
+    return '\n'.join(lines)
+
+
+BEAMLINE_TEMPLATE = '''"""
+Beamline tuned by tune_pp.py: {beamline} with the zoom and sampling of PP_FACTORS.
+Input pulse {input_file}, engine {engine}, energy tolerance {energy_tolerance:g}, FWHM tolerance {fwhm_tolerance:g}.
+"""
+BEAMLINE_FILE = {beamline_file!r}
+
+# element index: zoom and sampling
+PP_FACTORS = {factors!r}
+
+
+def get_beamline():
+    import tune_pp
+    return tune_pp.tuned_beamline(BEAMLINE_FILE, PP_FACTORS)
+'''
+
+
+def write_beamline(fname, beamline_file, factors, **info):
+    """
+    Write a beamline file applying the tuned factors to the original beamline
+
+    :param fname: output python file
+    :param beamline_file: original beamline file, None for the built-in beamline
+    :param factors: tuned factors from tune
+    :param info: input_file, engine, energy_tolerance and fwhm_tolerance for the docstring
+    """
+    if beamline_file is not None:
+        beamline_file = os.path.abspath(beamline_file)
+    with open(fname, 'w') as f:
+        f.write(BEAMLINE_TEMPLATE.format(beamline=beamline_file or 'built-in beamline of propagateSE.py',
+                                         beamline_file=beamline_file,
+                                         factors=dict((int(i), v) for i, v in factors.items()), **info))
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--input-file", dest="in_fname", help="Representative input wavefront file")
+    parser.add_option("--beamline-file", dest="beamline_file", default=None,
+                      help="Python file with get_beamline() definition, default the built-in beamline")
+    parser.add_option("--engine", dest="engine", choices=['srw', 'fft'], default='srw',
+                      help="Propagation engine: srw (default) or fft")
+    parser.add_option("--energy-tolerance", dest="energy_tolerance", type="float", default=DEFAULT_ENERGY_TOLERANCE,
+                      help="Maximal relative error of the propagated energy, default %default")
+    parser.add_option("--fwhm-tolerance", dest="fwhm_tolerance", type="float", default=DEFAULT_FWHM_TOLERANCE,
+                      help="Maximal relative error of the focal spot FWHM, default %default")
+    parser.add_option("--reference-zoom", dest="reference_zoom", type="float", default=DEFAULT_REFERENCE_ZOOM,
+                      help="Range of the reference mesh relative to the beamline, default %default")
+    parser.add_option("--reference-sampling", dest="reference_sampling", type="float",
+                      default=DEFAULT_REFERENCE_SAMPLING,
+                      help="Resolution of the reference mesh relative to the beamline, default %default")
+    parser.add_option("--max-slices", dest="max_slices", type="int", default=None,
+                      help="Tune on every n-th frequency slice of the pulse, at most this many slices")
+    parser.add_option("--all-elements", dest="all_elements", action="store_true", default=False,
+                      help="Tune all elements, not only the ones with zoom or sampling")
+    parser.add_option("--output", dest="out_fname", default='tuned_beamline.py',
+                      help="Tuned beamline file for --beamline-file, default %default")
+    parser.add_option("--json", dest="json_fname", default=None, help="Save the table to a JSON file")
+    (options, args) = parser.parse_args()
+    if not options.in_fname:
+        parser.error('Input filename not specified, use --input-file option')
+
+    from propagateSE import load_get_beamline, load_wavefront
+    bl = load_get_beamline(options.beamline_file)()
+    wf = load_wavefront(options.in_fname)
+    if options.max_slices is not None:
+        select_slices(wf, options.max_slices)
+
+    factors, rows = tune(wf, bl, options.engine, options.energy_tolerance, options.fwhm_tolerance,
+                         options.reference_zoom, options.reference_sampling, options.all_elements)
+    print(format_pp(bl, factors) or 'Beamline unchanged')
+    write_beamline(options.out_fname, options.beamline_file, factors, input_file=options.in_fname,
+                   engine=options.engine, energy_tolerance=options.energy_tolerance,
+                   fwhm_tolerance=options.fwhm_tolerance)
+    print('Tuned beamline saved to {}'.format(options.out_fname))
+    if options.json_fname:
+        with open(options.json_fname, 'w') as f:
+            json.dump({'factors': dict((str(i), v) for i, v in factors.items()), 'rows': rows},
+                      f, indent=1, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
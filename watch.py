@@ -0,0 +1,129 @@
+"""
+Watching the input directory for wavefront files written by the upstream stage.
+
+The FEL source stage writes FELsource_out*.h5 files one by one over hours.
+DirectoryWatcher polls the directory and reports a file once it is complete:
+its size and modification time did not change for stable_time seconds and it
+can be opened with h5py (HDF5 file locking refuses to open a file, which is still
+open for writing). Every file is reported once.
+
+Watching ends when the sentinel file appears in the directory (the upstream
+stage is done, all remaining files are reported as soon as they can be opened)
+or when the scans found no new complete file for timeout seconds. The time is
+counted from the first scan without a new file after the last reported one, so
+the time a caller does not poll (e.g. its workers are busy) does not count.
+"""
+import os
+import time
+from glob import glob
+
+DEFAULT_POLL_INTERVAL = 10.
+DEFAULT_STABLE_TIME = 30.
+DEFAULT_SENTINEL = 'FELsource_done'
+
+
+def can_open(fname):
+    """
+    Check if the HDF5 file can be opened for reading
+
+    :param fname: file name
+    :return: True if the file is a readable HDF5 file
+    """
+    import h5py
+    try:
+        with h5py.File(fname, 'r'):
+            return True
+    except (IOError, OSError):
+        return False
+
+
+class DirectoryWatcher(object):
+    """
+    Poller of complete files in a directory
+    """
+
+    def __init__(self, dname, pattern='FELsource_out*.h5', poll_interval=DEFAULT_POLL_INTERVAL,
+                 stable_time=DEFAULT_STABLE_TIME, sentinel=DEFAULT_SENTINEL, timeout=None):
+        """
+        :param dname: directory to watch
+        :param pattern: glob pattern of the files
+        :param poll_interval: minimal time between two scans of the directory [s]
+        :param stable_time: time without change of size and modification time of a complete file [s]
+        :param sentinel: name of the file, which signals the end of the upstream stage, None to disable
+        :param timeout: stop watching if the scans found no new complete file for this time [s],
+            None to wait forever
+        """
+        self.dname = dname
+        self.pattern = pattern
+        self.poll_interval = poll_interval
+        self.stable_time = stable_time
+        self.sentinel = sentinel
+        self.timeout = timeout
+        self.reported = set()
+        self._seen = {}  # file name: ((size, mtime), time the state was seen first)
+        self._last_scan = None
+        self._quiet_since = None  # time of the first scan without a new file since the last report
+
+    def sentinel_found(self):
+        return self.sentinel is not None and os.path.exists(os.path.join(self.dname, self.sentinel))
+
+    def _is_stable(self, fname, now, skip_wait):
+        try:
+            st = os.stat(fname)
+        except OSError:  # removed or renamed in the meantime
+            self._seen.pop(fname, None)
+            return False
+        state = (st.st_size, st.st_mtime)
+        if fname not in self._seen or self._seen[fname][0] != state:
+            self._seen[fname] = (state, now)
+            if not skip_wait:
+                return False
+        return skip_wait or now - self._seen[fname][1] >= self.stable_time
+
+    def poll(self, max_files=None):
+        """
+        Scan the directory, if the last scan was at least poll_interval ago
+
+        :param max_files: maximal number of reported files, the others are reported by the next calls
+        :return: list of newly complete files, oldest first
+        """
+        now = time.time()
+        if self._last_scan is not None and now - self._last_scan < self.poll_interval:
+            return []
+        self._last_scan = now
+        # upstream is done, files do not change anymore
+        skip_wait = self.sentinel_found()
+
+        candidates = [f for f in glob(os.path.join(self.dname, self.pattern)) if f not in self.reported]
+        candidates.sort(key=lambda f: os.path.getmtime(f) if os.path.exists(f) else now)
+        complete = []
+        for fname in candidates:
+            if max_files is not None and len(complete) >= max_files:
+                break
+            if self._is_stable(fname, now, skip_wait) and can_open(fname):
+                complete.append(fname)
+                self.reported.add(fname)
+                self._seen.pop(fname, None)
+        if complete:
+            self._quiet_since = None
+        elif self._quiet_since is None:
+            self._quiet_since = now
+        return complete
+
+    def pending(self):
+        """
+        :return: number of files found, but not reported yet
+        """
+        return len([f for f in glob(os.path.join(self.dname, self.pattern)) if f not in self.reported])
+
+    def finished(self):
+        """
+        Check if watching is over: the sentinel file exists and all files were reported,
+        or the scans found no new complete file for timeout seconds
+
+        :return: True if no more files are expected
+        """
+        if self.sentinel_found() and self._last_scan is not None and self.pending() == 0:
+            return True
+        return self.timeout is not None and self._quiet_since is not None and \
+            time.time() - self._quiet_since >= self.timeout
@@ -0,0 +1,295 @@
+"""
+Single-pass reductions of the wavefront field.
+
+FieldMetrics consumes the field chunk by chunk (a range of slices at a time) and
+accumulates everything the diagnostics need: time (frequency) integrated
+intensity, power per slice, on-axis intensity per slice and, from the
+integrated intensity, FWHM, centroid and pulse energy of the beam. The field is
+read from a file (metrics_from_hdf5) or from the SRW buffers of a wavefront in
+memory (metrics_from_wavefront). Peak memory is one chunk of the field
+instead of several copies of the full 3D intensity.
+
+The field layout is the one of WPG: [y][x][slice][re, im].
+"""
+import h5py
+import numpy as np
+
+DEFAULT_CHUNK_SLICES = 16
+
+
+class FieldMetrics(object):
+    """
+    Accumulator of field reductions
+    """
+
+    def __init__(self, nx, ny, nSlices):
+        """
+        :param nx: number of points in horizontal direction
+        :param ny: number of points in vertical direction
+        :param nSlices: number of slices
+        """
+        self.nx, self.ny, self.nSlices = nx, ny, nSlices
+        self.image_hor = np.zeros((ny, nx), dtype='float64')
+        self.image_total = np.zeros((ny, nx), dtype='float64')
+        self.power_hor = np.zeros(nSlices, dtype='float64')
+        self.power_total = np.zeros(nSlices, dtype='float64')
+        self.on_axis_hor = np.zeros(nSlices, dtype='float64')
+        self.max_hor = 0.
+
+    def add(self, ehor, ever, i0):
+        """
+        Add a chunk of slices
+
+        :param ehor: horizontal polarization field, array [ny, nx, slices, 2]
+        :param ever: vertical polarization field, array [ny, nx, slices, 2]
+        :param i0: index of the first slice of the chunk
+        """
+        intens_hor = intensity(ehor)
+        self._add_hor(intens_hor, i0)
+        intens_total = intens_hor
+        intens_total += intensity(ever)  # in place, the horizontal intensity is not needed anymore
+        self._add_total(intens_total, i0)
+
+    def add_intensity(self, intens_total, i0):
+        """
+        Add a chunk of slices of total intensity, for files without the polarization components
+        (output level 'intensity'). The horizontal quantities are then calculated from the total intensity.
+
+        :param intens_total: total intensity, array [ny, nx, slices]
+        :param i0: index of the first slice of the chunk
+        """
+        self._add_hor(intens_total, i0)
+        self._add_total(intens_total, i0)
+
+    def _add_hor(self, intens_hor, i0):
+        i1 = i0 + intens_hor.shape[2]
+        self.image_hor += intens_hor.sum(axis=-1)
+        self.power_hor[i0:i1] = intens_hor.sum(axis=(0, 1))
+        self.on_axis_hor[i0:i1] = intens_hor[self.ny // 2, self.nx // 2, :]
+        if intens_hor.size:
+            self.max_hor = max(self.max_hor, float(intens_hor.max()))
+
+    def _add_total(self, intens_total, i0):
+        i1 = i0 + intens_total.shape[2]
+        self.image_total += intens_total.sum(axis=-1)
+        self.power_total[i0:i1] = intens_total.sum(axis=(0, 1))
+
+    def on_axis_spectrum(self, sliceMin, sliceMax):
+        """
+        Intensity along z-axis (x=y=0) normalized to the maximal intensity, as get_intensity_on_axis in propagateSE
+
+        :param sliceMin: first slice coordinate
+        :param sliceMax: last slice coordinate
+        :return: array [nSlices, 2] of (slice coordinate, normalized intensity)
+        """
+        sz = np.zeros((self.nSlices, 2), dtype='float64')
+        sz[:, 0] = np.linspace(sliceMin, sliceMax, self.nSlices)
+        if self.max_hor > 0:
+            sz[:, 1] = self.on_axis_hor / self.max_hor
+        return sz
+
+    def fwhm(self, xMin, xMax, yMin, yMax):
+        """
+        FWHM of the integrated intensity through the image center, as calculate_fwhm in propagateSE
+
+        :return: {'fwhm_x':fwhm_x, 'fwhm_y': fwhm_y} in [m]
+        """
+        return fwhm(self.image_total, xMin, xMax, yMin, yMax)
+
+    def centroid(self, xMin, xMax, yMin, yMax):
+        """
+        Intensity weighted center of the integrated intensity
+
+        :return: {'x': x, 'y': y} in [m]
+        """
+        total = self.image_total.sum()
+        if total <= 0:
+            return {'x': 0., 'y': 0.}
+        x = np.linspace(xMin, xMax, self.nx)
+        y = np.linspace(yMin, yMax, self.ny)
+        return {'x': float(np.dot(self.image_total.sum(axis=0), x) / total),
+                'y': float(np.dot(self.image_total.sum(axis=1), y) / total)}
+
+    def pulse_energy(self, xMin, xMax, yMin, yMax, sliceMin, sliceMax):
+        """
+        Pulse energy of a wavefront in time domain, as in diagnostics.show_diagnostics
+
+        :return: energy [J]
+        """
+        dx = (xMax - xMin) / max(self.nx - 1, 1)
+        dy = (yMax - yMin) / max(self.ny - 1, 1)
+        dt = (sliceMax - sliceMin) / max(self.nSlices - 1, 1)
+        return float(self.power_total.sum() * dx * dy * 1e6 * dt)
+
+
+def intensity(field):
+    """
+    Intensity of the complex field
+
+    :param field: array [..., 2] of real and imaginary parts
+    :return: array [...] float32
+    """
+    re = field[..., 0]
+    im = field[..., 1]
+    res = re * re
+    res += im * im
+    return res
+
+
+def fwhm(image, xMin, xMax, yMin, yMax):
+    """
+    Calculate FWHM of the beam calculating number of point bigger then max/2 through center of the image
+
+    :param image: integrated intensity [ny, nx]
+    :return: {'fwhm_x':fwhm_x, 'fwhm_y': fwhm_y} in [m]
+    """
+    ny, nx = image.shape
+    dx = (xMax - xMin) / nx
+    dy = (yMax - yMin) / ny
+
+    x_center = image[ny // 2, :]
+    fwhm_x = np.count_nonzero(x_center > x_center.max() / 2) * dx
+
+    y_center = image[:, nx // 2]
+    fwhm_y = np.count_nonzero(y_center > y_center.max() / 2) * dy
+    return {'fwhm_x': fwhm_x, 'fwhm_y': fwhm_y}
+
+
+def _half_maximum_width(profile, coords):
+    # distance of the half maximum crossings around the peak, linearly interpolated between the points
+    peak = int(np.argmax(profile))
+    half = profile[peak] / 2.
+    if half <= 0:
+        return 0.
+    edges = []
+    for step in [-1, 1]:
+        i = peak
+        while 0 <= i + step < len(profile) and profile[i + step] > half:
+            i += step
+        j = i + step
+        if not 0 <= j < len(profile):
+            edges.append(coords[i])
+        else:
+            t = (profile[i] - half) / (profile[i] - profile[j])
+            edges.append(coords[i] + t * (coords[j] - coords[i]))
+    return float(abs(edges[1] - edges[0]))
+
+
+def fwhm_interpolated(image, xMin, xMax, yMin, yMax):
+    """
+    FWHM through the maximum of the image with sub-pixel resolution: the half maximum crossings
+    are interpolated between the mesh points, so that it can be compared between different meshes
+
+    :param image: integrated intensity [ny, nx]
+    :return: {'fwhm_x':fwhm_x, 'fwhm_y': fwhm_y} in [m]
+    """
+    ny, nx = image.shape
+    iy, ix = np.unravel_index(np.argmax(image), image.shape)
+    return {'fwhm_x': _half_maximum_width(image[iy, :], np.linspace(xMin, xMax, nx)),
+            'fwhm_y': _half_maximum_width(image[:, ix], np.linspace(yMin, yMax, ny))}
+
+
+def projection(image, axis, vmin, vmax):
+    """
+    Projection of the image normalized to unit area
+
+    :param image: integrated intensity [ny, nx]
+    :param axis: 0 for the horizontal projection (sum over y), 1 for the vertical one
+    :param vmin: first coordinate of the projected axis
+    :param vmax: last coordinate of the projected axis
+    :return: (coordinates, projection)
+    """
+    profile = image.sum(axis=axis)
+    coords = np.linspace(vmin, vmax, len(profile))
+    area = profile.sum() * abs(coords[1] - coords[0]) if len(profile) > 1 else profile.sum()
+    return coords, profile / area if area > 0 else profile
+
+
+def projection_distance(image, span, ref_image, ref_span, axis):
+    """
+    Difference of the normalized projections of two images on different meshes
+
+    :param image: integrated intensity [ny, nx]
+    :param span: (min, max) of the projected axis of image
+    :param ref_image: reference integrated intensity
+    :param ref_span: (min, max) of the projected axis of ref_image
+    :param axis: 0 for the horizontal projection, 1 for the vertical one
+    :return: total variation distance, 0 for identical and 1 for disjoint projections
+    """
+    ref_coords, ref_profile = projection(ref_image, axis, ref_span[0], ref_span[1])
+    coords, profile = projection(image, axis, span[0], span[1])
+    profile = np.interp(ref_coords, coords, profile, left=0., right=0.)
+    return float(0.5 * np.abs(profile - ref_profile).sum() * abs(ref_coords[1] - ref_coords[0]))
+
+
+def read_params(h5):
+    """
+    Read mesh and photon energy of a wavefront file
+
+    :param h5: open h5py file
+    :return: dict with nx, ny, nSlices, xMin, xMax, yMin, yMax, sliceMin, sliceMax, photonEnergy
+    """
+    params = {}
+    for key in ['nx', 'ny', 'nSlices', 'xMin', 'xMax', 'yMin', 'yMax', 'sliceMin', 'sliceMax']:
+        params[key] = h5['params/Mesh/' + key][()]
+    for key in ['nx', 'ny', 'nSlices']:
+        params[key] = int(params[key])
+    params['photonEnergy'] = h5['params/photonEnergy'][()]
+    return params
+
+
+def metrics_from_wavefront(wfr, chunk_slices=DEFAULT_CHUNK_SLICES):
+    """
+    Reduce the field of a wavefront in memory, chunk by chunk, without copying the field
+
+    :param wfr: wavefront
+    :param chunk_slices: number of slices reduced at once
+    :return: FieldMetrics
+    """
+    srwl_wf = wfr._srwl_wf
+    mesh = srwl_wf.mesh
+    shape = (mesh.ny, mesh.nx, mesh.ne, 2)
+    ehor = np.frombuffer(srwl_wf.arEx, dtype=np.float32).reshape(shape)
+    ever = np.frombuffer(srwl_wf.arEy, dtype=np.float32).reshape(shape)
+    metrics = FieldMetrics(mesh.nx, mesh.ny, mesh.ne)
+    for i0 in range(0, mesh.ne, chunk_slices):
+        i1 = min(i0 + chunk_slices, mesh.ne)
+        metrics.add(ehor[:, :, i0:i1, :], ever[:, :, i0:i1, :], i0)
+    return metrics
+
+
+def metrics_from_hdf5(fname, chunk_slices=DEFAULT_CHUNK_SLICES, chunk_callback=None):
+    """
+    Reduce the field of a wavefront file reading it in chunks of slices.
+    Reduced files (see h5_layout output levels) are supported: with the intensity cube the horizontal
+    quantities are the total ones, with the summary only the integrated image and the power are available.
+
+    :param fname: wavefront file
+    :param chunk_slices: number of slices read at once
+    :param chunk_callback: function(ehor, ever, i0) called with every chunk of the field for further
+        reductions in the same pass, not called for files without the field
+    :return: (params, FieldMetrics), params from read_params
+    """
+    with h5py.File(fname, 'r') as h5:
+        params = read_params(h5)
+        metrics = FieldMetrics(params['nx'], params['ny'], params['nSlices'])
+        data = h5['data']
+        if 'arrEhor' in data:
+            ehor, ever = data['arrEhor'], data['arrEver']
+            for i0 in range(0, params['nSlices'], chunk_slices):
+                i1 = min(i0 + chunk_slices, params['nSlices'])
+                ehor_chunk, ever_chunk = ehor[:, :, i0:i1, :], ever[:, :, i0:i1, :]
+                if chunk_callback is not None:
+                    chunk_callback(ehor_chunk, ever_chunk, i0)
+                metrics.add(ehor_chunk, ever_chunk, i0)
+        elif 'intensity' in data:
+            intens = data['intensity']
+            for i0 in range(0, params['nSlices'], chunk_slices):
+                i1 = min(i0 + chunk_slices, params['nSlices'])
+                metrics.add_intensity(intens[:, :, i0:i1], i0)
+        else:
+            metrics.image_total[:] = data['integrated_intensity'][()]
+            metrics.image_hor[:] = metrics.image_total
+            metrics.power_total[:] = h5['misc/power'][()]
+            metrics.power_hor[:] = metrics.power_total
+    return params, metrics
@@ -0,0 +1,248 @@
+"""
+Work queue on a shared filesystem for batch propagation on many nodes.
+
+Every node runs propagateSE.py with the same input and output directories and
+claims pulses through files in the queue directory (OUTPUT_DIRECTORY/prop_queue):
+
+    <key>.lock    claimed, created atomically with O_EXCL, the owner renews its
+                  modification time while the pulse is propagated (the lease)
+    <key>.done    propagated
+    <key>.failed  propagation failed, with the traceback
+
+Done and failed markers record the input file size and modification time and
+the beamline hash, a marker of a changed input or beamline is ignored. A lock
+not renewed for lease_timeout seconds belongs to a crashed node and is taken
+over: it is renamed aside and removed only if it is still the expired lock seen
+before, otherwise (another node took it over or the owner renewed it in the
+meantime) it is put back and the claim fails. The owner checks its locks when
+renewing them, a lease taken over by another node is lost and the pulse must be
+abandoned, see lost. Lease ages are
+measured with the clock of the file server, so the clocks of the nodes do not
+need to agree. No service is needed besides the shared filesystem; several
+processes on one machine behave like several nodes.
+"""
+import os
+import json
+import socket
+import threading
+import time
+
+QUEUE_DIR_NAME = 'prop_queue'
+DEFAULT_LEASE_TIMEOUT = 600.
+
+
+def default_owner():
+    """
+    :return: unique name of this process on the cluster, host:pid
+    """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    """
+    Lock file work queue in a shared directory
+    """
+
+    def __init__(self, dname, lease_timeout=DEFAULT_LEASE_TIMEOUT, owner=None):
+        """
+        :param dname: queue directory on the shared filesystem
+        :param lease_timeout: time after which a lock not renewed is taken over [s]
+        :param owner: name of this process, default host:pid
+        """
+        self.dname = dname
+        self.lease_timeout = lease_timeout
+        self.owner = owner or default_owner()
+        self.held = set()
+        self.lost = set()
+        self.clock_offset = None
+        self._lock = threading.Lock()
+        self._heartbeat = None
+        self._stop = threading.Event()
+        if not os.path.isdir(dname):
+            try:
+                os.makedirs(dname)
+            except OSError:  # created by another node in the meantime
+                if not os.path.isdir(dname):
+                    raise
+
+    def _path(self, key, suffix):
+        return os.path.join(self.dname, key + suffix)
+
+    def _clock_fname(self):
+        return self._path('.clock.' + self.owner.replace(os.sep, '_'), '')
+
+    def sync_clock(self):
+        """
+        Measure the offset of the file server clock, the modification time of a touched file.
+        Called once per pass over the pulses, not for every lock.
+        """
+        fname = self._clock_fname()
+        with open(fname, 'a'):
+            os.utime(fname, None)
+        self.clock_offset = os.stat(fname).st_mtime - time.time()
+
+    def server_time(self):
+        """
+        Current time of the file server, see sync_clock
+
+        :return: time [s]
+        """
+        if self.clock_offset is None:
+            self.sync_clock()
+        return time.time() + self.clock_offset
+
+    def state(self, key, signature):
+        """
+        State of a pulse
+
+        :param key: pulse name, e.g. the input file name
+        :param signature: dict identifying input and beamline, done and failed markers with
+            another signature are ignored
+        :return: 'done', 'failed', 'locked' or 'free'
+        """
+        for marker in ['done', 'failed']:
+            try:
+                with open(self._path(key, '.' + marker)) as f:
+                    if json.load(f).get('signature') == signature:
+                        return marker
+            except (IOError, OSError, ValueError):
+                pass
+        try:
+            age = self.server_time() - os.stat(self._path(key, '.lock')).st_mtime
+        except OSError:
+            return 'free'
+        return 'locked' if age < self.lease_timeout else 'free'
+
+    def _read_lock(self, key):
+        """
+        :param key: pulse name
+        :return: content of the lock file (owner, time), None if there is no lock
+        """
+        try:
+            with open(self._path(key, '.lock')) as f:
+                return json.load(f)
+        except (IOError, OSError):
+            return None
+        except ValueError:  # being written
+            return {}
+
+    def _owns(self, key):
+        """
+        :param key: pulse name
+        :return: True if the lock of the pulse belongs to this process
+        """
+        lock = self._read_lock(key)
+        return lock is not None and lock.get('owner') == self.owner
+
+    def claim(self, key):
+        """
+        Try to claim a pulse, taking over an expired lease
+
+        :param key: pulse name
+        :return: True if the pulse is claimed by this process
+        """
+        lock_fname = self._path(key, '.lock')
+        try:
+            seen = self._read_lock(key)
+            if seen and self.server_time() - os.stat(lock_fname).st_mtime >= self.lease_timeout:
+                stale_fname = '{}.{}.stale'.format(lock_fname, self.owner.replace(os.sep, '_'))
+                # another node may take over the same lock between the check and the rename,
+                # or the owner may renew it, then the renamed file is not the expired lock
+                os.rename(lock_fname, stale_fname)
+                try:
+                    with open(stale_fname) as f:
+                        stale = json.load(f)
+                except ValueError:
+                    stale = {}
+                if stale != seen or self.server_time() - os.stat(stale_fname).st_mtime < self.lease_timeout:
+                    try:
+                        os.link(stale_fname, lock_fname)  # unlike rename, never replaces a newer lock
+                    except OSError:
+                        pass
+                    os.remove(stale_fname)
+                    return False
+                os.remove(stale_fname)
+        except OSError:
+            pass
+        try:
+            fd = os.open(lock_fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except OSError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'owner': self.owner, 'time': time.time()}, f)
+        with self._lock:
+            self.held.add(key)
+            self.lost.discard(key)
+        return True
+
+    def renew(self):
+        """
+        Renew the leases of all pulses held by this process, leases taken over by another node are moved to lost
+        """
+        with self._lock:
+            held = list(self.held)
+        for key in held:
+            if not self._owns(key):
+                with self._lock:
+                    if key in self.held:
+                        self.held.discard(key)
+                        self.lost.add(key)
+                continue
+            try:
+                os.utime(self._path(key, '.lock'), None)
+            except OSError:
+                pass
+
+    def release(self, key, marker=None, signature=None, info=None):
+        """
+        Release a claimed pulse, the pulse of a lost lease belongs to another node and is left to it
+
+        :param key: pulse name
+        :param marker: None to give the pulse back to the queue, 'done' or 'failed'
+        :param signature: signature of the pulse, see state
+        :param info: additional content of the marker, e.g. the traceback
+        """
+        with self._lock:
+            self.held.discard(key)
+            self.lost.discard(key)
+        if not self._owns(key):
+            return
+        if marker is not None:
+            content = dict(info or {}, signature=signature, owner=self.owner, time=time.time())
+            tmp_fname = self._path(key, '.{}.{}.tmp'.format(marker, self.owner.replace(os.sep, '_')))
+            with open(tmp_fname, 'w') as f:
+                json.dump(content, f)
+            os.rename(tmp_fname, self._path(key, '.' + marker))
+        try:
+            os.remove(self._path(key, '.lock'))
+        except OSError:
+            pass
+
+    def start_heartbeat(self, interval=None):
+        """
+        Renew the leases in a background thread
+
+        :param interval: time between renewals [s], default a quarter of the lease timeout
+        """
+        interval = interval or self.lease_timeout / 4.
+
+        def beat():
+            while not self._stop.wait(interval):
+                self.renew()
+        self._heartbeat = threading.Thread(target=beat)
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+
+    def close(self):
+        """
+        Stop the heartbeat and give the pulses still held back to the queue
+        """
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        for key in list(self.held):
+            self.release(key)
+        try:
+            os.remove(self._clock_fname())
+        except OSError:
+            pass